@@ -0,0 +1,190 @@
+import argparse
+import gzip
+import json
+import os
+import random
+from loder_components.config import od_columns, wac_columns, rac_columns, xwalk_columns
+
+# state FIPS codes, the first 2 digits of every block geocode
+state_fips = {
+    "al": "01", "ak": "02", "az": "04", "ar": "05", "ca": "06", "co": "08", "ct": "09",
+    "de": "10", "dc": "11", "fl": "12", "ga": "13", "hi": "15", "id": "16", "il": "17",
+    "in": "18", "ia": "19", "ks": "20", "ky": "21", "la": "22", "me": "23", "md": "24",
+    "ma": "25", "mi": "26", "mn": "27", "ms": "28", "mo": "29", "mt": "30", "ne": "31",
+    "nv": "32", "nh": "33", "nj": "34", "nm": "35", "ny": "36", "nc": "37", "nd": "38",
+    "oh": "39", "ok": "40", "or": "41", "pa": "42", "ri": "44", "sc": "45", "sd": "46",
+    "tn": "47", "tx": "48", "ut": "49", "vt": "50", "va": "51", "wa": "53", "wv": "54",
+    "wi": "55", "wy": "56",
+}
+
+
+def county_name(state: str, county: str):
+    """Name of a synthetic county (by its 3-digit code), as it appears in xwalk.ctyname"""
+    return f"Synthetic {county} County, {state.upper()}"
+
+
+def county_codes(counties: int):
+    """The 3-digit codes of the synthetic counties in every state: 001, 003, ..."""
+    return [f"{county * 2 + 1:03d}" for county in range(counties)]
+
+
+def blocks(state: str, counties: int, per_county: int):
+    """Sorted synthetic block geocodes for a state: 5 per tract, 2 per block group"""
+    fips = state_fips[state]
+    return [
+        f"{fips}{county}{block // 5:06d}{block % 5 // 2 + 1}{block % 5:03d}"
+        for county in county_codes(counties)
+        for block in range(per_county)
+    ]
+
+
+def write_csv(path: str, header: list, rows):
+    """Writes rows (lists of strings) as a gzipped csv. Returns (rows, compressed bytes)"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    count = 0
+    with gzip.open(path, "wt", compresslevel=6, newline="") as f:
+        f.write(",".join(header) + "\n")
+        for row in rows:
+            f.write(",".join(row) + "\n")
+            count += 1
+    return count, os.path.getsize(path)
+
+
+def counts(rng: random.Random, n: int):
+    """n job counts, the first being the total"""
+    values = [rng.randint(0, 12) for _ in range(n - 1)]
+    return [str(sum(values[:3]) or 1)] + [str(v) for v in values]
+
+
+def generate(
+    out: str,
+    states: list = ("pa",),
+    year: int = 2021,
+    lode_no: str = "lodes8",
+    counties: int = 3,
+    per_county: int = 1000,
+    od_links: int = 5,
+    job_types: list = ("JT00",),
+    segments: list = ("S000",),
+    seed: int = 0,
+):
+    """Writes synthetic LODES files under out, laid out like the LEHD site.
+
+    Every file matches the column layout in config.py, with rows in geocode order
+    like the real ones. Scale is counties x per_county blocks per state; wac and
+    rac have a row for most blocks, od_main has about od_links rows per block and
+    od_aux a fifth of that. The same arguments always give the same files.
+
+    Returns {path relative to out: {"table", "rows", "bytes"}}, which is also saved
+    to out/manifest.json.
+    """
+    rng = random.Random(seed)
+    createdate = f"{year + 2}0101"
+    manifest = {}
+    all_blocks = {state: blocks(state, counties, per_county) for state in states}
+
+    def add(rel: str, table: str, header: list, rows):
+        rows, size = write_csv(os.path.join(out, rel), header, rows)
+        manifest[rel] = {"table": table, "rows": rows, "bytes": size}
+
+    for state in states:
+        base = os.path.join(lode_no.upper(), state)
+        geocodes = all_blocks[state]
+        others = [g for other in states if other != state for g in all_blocks[other]]
+        # od_aux needs homes out of state, so a one-state run borrows a neighbour
+        others = others or blocks("de" if state != "de" else "md", counties, per_county)
+
+        def xwalk_row(geocode: str):
+            row = {column: "" for column in xwalk_columns}
+            row.update(
+                {
+                    "tabblk2020": geocode,
+                    "st": geocode[:2],
+                    "st_usps": state.upper(),
+                    "stname": f"Synthetic {state.upper()}",
+                    "cty": geocode[:5],
+                    "ctyname": f'"{county_name(state, geocode[2:5])}"',
+                    "trct": geocode[:11],
+                    "trctname": f"Tract {geocode[5:11]}",
+                    "bgrp": geocode[:12],
+                    "bgrpname": f"Block Group {geocode[11]}",
+                    "zcta": f"{int(geocode[:2]) * 1000 + int(geocode[5:11]) // 4 % 1000:05d}",
+                    "cbsa": f"9{geocode[2:5]}0",
+                    "blklatdd": f"{39 + rng.random():.7f}",
+                    "blklondd": f"{-75 - rng.random():.7f}",
+                    "createdate": createdate,
+                }
+            )
+            return [row[column] for column in xwalk_columns]
+
+        add(f"{base}/{state}_xwalk.csv.gz", "xwalk", xwalk_columns, map(xwalk_row, geocodes))
+
+        for job_type in job_types:
+            for table, columns in [("wac", wac_columns), ("rac", rac_columns)]:
+                header = [columns[0]] + [c.upper() for c in columns[1:-1]] + ["createdate"]
+                for segment in segments:
+                    rows = (
+                        [geocode] + counts(rng, len(columns) - 2) + [createdate]
+                        for geocode in geocodes
+                        if rng.random() < 0.8
+                    )
+                    add(
+                        f"{base}/{table}/{state}_{table}_{segment}_{job_type}_{year}.csv.gz",
+                        table,
+                        header,
+                        rows,
+                    )
+
+            header = od_columns[:2] + [c.upper() for c in od_columns[2:-1]] + ["createdate"]
+            for scope, homes, links in [
+                ("od_main", geocodes, od_links),
+                ("od_aux", others, max(od_links // 5, 1)),
+            ]:
+                rows = (
+                    [work, home] + counts(rng, len(od_columns) - 3) + [createdate]
+                    for work in geocodes
+                    for home in sorted(rng.sample(homes, min(links, len(homes))))
+                )
+                add(f"{base}/od/{state}_{scope}_{job_type}_{year}.csv.gz", scope, header, rows)
+
+    with open(os.path.join(out, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """Scale options shared by this script and the runner"""
+    parser.add_argument("--data-dir", default=os.path.join("benchmarks", "data"))
+    parser.add_argument("--states", default="pa,nj", help="comma separated")
+    parser.add_argument("--year", type=int, default=2021)
+    parser.add_argument("--lode-no", default="lodes8")
+    parser.add_argument("--counties", type=int, default=3, help="counties per state")
+    parser.add_argument("--blocks", type=int, default=2000, help="blocks per county")
+    parser.add_argument("--od-links", type=int, default=5, help="od_main rows per work block")
+    parser.add_argument("--job-types", default="JT00,JT01", help="comma separated")
+    parser.add_argument("--segments", default="S000,SA01,SE01", help="comma separated")
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def generate_from_args(args):
+    return generate(
+        args.data_dir,
+        states=args.states.split(","),
+        year=args.year,
+        lode_no=args.lode_no,
+        counties=args.counties,
+        per_county=args.blocks,
+        od_links=args.od_links,
+        job_types=args.job_types.split(","),
+        segments=args.segments.split(","),
+        seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write synthetic LODES files")
+    add_arguments(parser)
+    manifest = generate_from_args(parser.parse_args())
+    rows = sum(entry["rows"] for entry in manifest.values())
+    size = sum(entry["bytes"] for entry in manifest.values())
+    print(f"wrote {len(manifest)} files, {rows:,} rows, {size / 1024**2:,.1f} MB")
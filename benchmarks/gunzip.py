@@ -0,0 +1,71 @@
+import argparse
+import json
+import os
+import time
+from loder_components.stream import open_gzip, gzip_backends, StampedCsv, CHUNK_SIZE
+from loder_components.batches import ArrowCopy
+from .generate import add_arguments, generate_from_args
+
+
+def inflate(path: str, table: str, backend: str, read_ahead: bool, stamp: str = None):
+    """Inflates one file the way a load does. Returns (decompressed bytes, inflate seconds)
+
+    stamp ("text" or "arrow") also turns the rows into COPY input with that parse engine"""
+    with open(path, "rb") as f:
+        source = open_gzip(iter(lambda: f.read(CHUNK_SIZE), b""), backend, read_ahead)
+        try:
+            if stamp == "arrow":
+                for _ in ArrowCopy(source, table, {"state": "pa"}, ["42001"]).chunks():
+                    pass
+            elif stamp:
+                # the COPY thread's own work, which read-ahead inflating overlaps with
+                for _ in StampedCsv(source, ["pa", "JT00"], [0], ["42001"], True).chunks():
+                    pass
+            else:
+                while source.read(CHUNK_SIZE):
+                    pass
+        finally:
+            source.close()
+    return source.decompressed_bytes, source.inflate_seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time every installed gzip backend on the synthetic LODES files"
+    )
+    add_arguments(parser)
+    parser.add_argument("--regenerate", action="store_true", help="rewrite the synthetic files")
+    parser.add_argument(
+        "--stamp",
+        choices=["text", "arrow"],
+        default=None,
+        help="also turn the rows into COPY input, with that parse engine",
+    )
+    args = parser.parse_args()
+
+    manifest_path = os.path.join(args.data_dir, "manifest.json")
+    if args.regenerate or not os.path.exists(manifest_path):
+        generate_from_args(args)
+    with open(manifest_path) as f:
+        tables = {os.path.join(args.data_dir, rel): entry["table"] for rel, entry in json.load(f).items()}
+    paths = sorted(tables)
+    compressed = sum(os.path.getsize(path) for path in paths)
+    print(f"{len(paths)} files, {compressed / 1024**2:,.1f} MB compressed, {os.cpu_count()} cpus")
+
+    print(f"{'backend':<10}{'read-ahead':>12}{'wall s':>9}{'inflate s':>11}{'MB/s out':>10}")
+    for backend in gzip_backends():
+        for read_ahead in [False, True]:
+            start = time.perf_counter()
+            out, inflating = 0, 0.0
+            for path in paths:
+                size, seconds = inflate(path, tables[path], backend, read_ahead, args.stamp)
+                out += size
+                inflating += seconds
+            wall = time.perf_counter() - start
+            print(
+                f"{backend:<10}{'on' if read_ahead else 'off':>12}{wall:>9.2f}{inflating:>11.2f}{out / 1024**2 / wall:>10.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
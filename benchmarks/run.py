@@ -0,0 +1,226 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import time
+from loder_components import db_update, duckdb_backend
+from loder_components.db_setup import PayLode
+from loder_components.downloader import Downloader
+from loder_components.stream import GZIP_BACKENDS
+from .generate import add_arguments, generate_from_args, county_name, county_codes
+from .serve import serve
+
+# the loder.py steps that get timed, in the order they run
+stages = ["load_xwalk", "load_data", "local_flag", "build_index", "build_regional_index"]
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process so far (ru_maxrss is KB on Linux)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def git_commit():
+    """Current commit, with -dirty if the tree has uncommitted changes"""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True, text=True
+        ).stdout.strip()
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def reset_db(args):
+    """Starts every run from an empty schema (or file), so nothing is skipped as already loaded"""
+    if args.sink == "duckdb":
+        if os.path.exists(args.duckdb_path):
+            os.remove(args.duckdb_path)
+        return
+    cursor, conn = db_update.db_connect()
+    cursor.execute("select 1 from pg_database where datname = %s", (args.db,))
+    if not cursor.fetchone():
+        cursor.execute(f"create database {args.db}")
+    cursor.close()
+    conn.close()
+    cursor, conn = db_update.db_connect(args.db)
+    cursor.execute(f"drop schema if exists {args.schema} cascade")
+    cursor.close()
+    conn.close()
+
+
+class Timer:
+    """Times one stage and records its throughput in results["stages"]"""
+
+    def __init__(self, results: dict, name: str, rows: int, size: int) -> None:
+        self.results = results
+        self.name = name
+        self.rows = rows
+        self.size = size
+
+    def __enter__(self):
+        print(f"--- {self.name}")
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        mb = self.size / 1024**2
+        self.results["stages"][self.name] = {
+            "seconds": round(seconds, 3),
+            "rows": self.rows,
+            "mb": round(mb, 3),
+            "rows_per_s": round(self.rows / seconds, 1) if seconds else None,
+            "mb_per_s": round(mb / seconds, 3) if seconds else None,
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+        }
+        print(f"--- {self.name}: {seconds:.2f}s")
+
+
+def run(args):
+    """Generates (or reuses) the synthetic files, serves them, and times a full load"""
+    states = args.states.split(",")
+    manifest_path = os.path.join(args.data_dir, "manifest.json")
+    results = {
+        "commit": git_commit(),
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "params": {k: v for k, v in vars(args).items() if k not in ["output", "compare"]},
+        "stages": {},
+    }
+
+    start = time.perf_counter()
+    if args.regenerate or not os.path.exists(manifest_path):
+        generate_from_args(args)
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    results["generate_seconds"] = round(time.perf_counter() - start, 3)
+
+    def totals(tables):
+        files = [entry for entry in manifest.values() if entry["table"] in tables]
+        return sum(e["rows"] for e in files), sum(e["bytes"] for e in files)
+
+    xwalk_rows, xwalk_bytes = totals(["xwalk"])
+    data_rows, data_bytes = totals(["od_main", "od_aux", "wac", "rac"])
+    counties = [
+        county_name(state, code)
+        for state in states
+        for code in county_codes(args.counties)[: args.region_counties]
+    ]
+
+    reset_db(args)
+    server = serve(args.data_dir)
+    lodes_url = f"http://127.0.0.1:{server.server_address[1]}"
+    backend = duckdb_backend if args.sink == "duckdb" else db_update
+    db = args.duckdb_path if args.sink == "duckdb" else args.db
+
+    def load(state: str, tables: list, region: list = None):
+        PayLode(
+            "True",
+            args.year,
+            state,
+            args.lode_no,
+            args.db,
+            counties,
+            "all",
+            args.schema,
+            jobs=args.jobs,
+            download_jobs=args.download_jobs,
+            tables=tables,
+            region=region,
+            profile=args.profile,
+            sink=args.sink,
+            duckdb_path=args.duckdb_path,
+            lodes_url=lodes_url,
+            commit_every=args.commit_every,
+            downloader=Downloader(parts=args.download_parts),
+            gzip_backend=args.gzip_backend,
+            parse_engine=args.parse_engine,
+        )
+
+    try:
+        with Timer(results, "load_xwalk", xwalk_rows, xwalk_bytes):
+            for state in states:
+                load(state, ["xwalk"])
+        region = backend.region_fips(db, counties, args.schema)
+        with Timer(results, "load_data", data_rows, data_bytes):
+            for state in states:
+                load(state, ["od_main", "od_aux", "wac", "rac"], region)
+    finally:
+        server.shutdown()
+    with Timer(results, "local_flag", data_rows, 0):
+        backend.local_flag(db, args.year, counties, args.schema)
+    with Timer(results, "build_index", data_rows + xwalk_rows, 0):
+        backend.build_index(db, counties, args.year, args.schema, jobs=args.index_jobs)
+    with Timer(results, "build_regional_index", data_rows, 0):
+        backend.build_regional_index(db, args.schema, jobs=args.index_jobs)
+
+    results["total_seconds"] = round(sum(s["seconds"] for s in results["stages"].values()), 3)
+    results["peak_rss_mb"] = round(peak_rss_mb(), 1)
+    return results
+
+
+def compare(baseline: dict, results: dict):
+    """Prints each stage's time and throughput next to a baseline run's"""
+    print(f"comparing {results.get('commit')} against {baseline.get('commit')}")
+    print(f"{'stage':<22}{'before s':>10}{'after s':>10}{'change':>9}{'rows/s after':>15}")
+    for stage in stages:
+        old = baseline["stages"].get(stage)
+        new = results["stages"].get(stage)
+        if not old or not new:
+            continue
+        change = (new["seconds"] - old["seconds"]) / old["seconds"] * 100 if old["seconds"] else 0
+        rate = new["rows_per_s"] or 0
+        print(
+            f"{stage:<22}{old['seconds']:>10.2f}{new['seconds']:>10.2f}{change:>+8.1f}%{rate:>15,.0f}"
+        )
+    print(f"peak RSS: {baseline.get('peak_rss_mb')} MB -> {results.get('peak_rss_mb')} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time a full load of synthetic LODES files")
+    add_arguments(parser)
+    parser.add_argument("--regenerate", action="store_true", help="rewrite the synthetic files")
+    parser.add_argument("--region-counties", type=int, default=1, help="regional counties per state")
+    parser.add_argument("--db", default="loder_bench", help="postgres db to load (created if needed)")
+    parser.add_argument("--schema", default="bench", help="dropped and recreated on every run")
+    parser.add_argument("--sink", choices=["postgres", "duckdb"], default="postgres")
+    parser.add_argument("--duckdb-path", default=os.path.join("benchmarks", "loder_bench.duckdb"))
+    parser.add_argument("--profile", choices=["standard", "compact", "keyed"], default="standard")
+    parser.add_argument("-j", "--jobs", type=int, default=1)
+    parser.add_argument("--download-jobs", type=int, default=None)
+    parser.add_argument("--index-jobs", type=int, default=4)
+    parser.add_argument("--commit-every", type=int, default=1)
+    parser.add_argument("--download-parts", type=int, default=4)
+    parser.add_argument("--gzip-backend", choices=["auto"] + GZIP_BACKENDS, default="auto")
+    parser.add_argument("--parse-engine", choices=["text", "arrow"], default="text")
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="where to save the results (default benchmarks/results/<commit>.json)",
+    )
+    parser.add_argument("--compare", default=None, help="a saved results file to compare against")
+    args = parser.parse_args()
+
+    results = run(args)
+    output = args.output or os.path.join(
+        "benchmarks", "results", f"{results['commit'] or 'results'}.json"
+    )
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"saved results to {output}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
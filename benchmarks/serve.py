@@ -0,0 +1,100 @@
+import argparse
+import functools
+import html
+import io
+import os
+import re
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    """Serves files without logging every request. Like the LEHD site, it answers
+    If-Modified-Since with a 304 for unchanged files, and single byte ranges
+    (Range: bytes=start-end, checked against If-Range) with a 206. Directory pages
+    list each file's size at the end of its row, the way apache's index pages do."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def end_headers(self):
+        self.send_header("Accept-Ranges", "bytes")
+        super().end_headers()
+
+    def list_directory(self, path):
+        try:
+            names = sorted(os.listdir(path))
+        except OSError:
+            self.send_error(404, "No permission to list directory")
+            return None
+        rows = []
+        for name in names:
+            full = os.path.join(path, name)
+            stat = os.stat(full)
+            href = html.escape(name + ("/" if os.path.isdir(full) else ""))
+            size = "-" if os.path.isdir(full) else str(stat.st_size)
+            date = self.date_time_string(int(stat.st_mtime))
+            rows.append(
+                f'<tr><td><a href="{href}">{href}</a></td><td align="right">{date}</td><td align="right">{size}</td></tr>'
+            )
+        body = f"<html><body><table>\n{chr(10).join(rows)}\n</table></body></html>\n".encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        return io.BytesIO(body)
+
+    def do_GET(self):
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        path = self.translate_path(self.path)
+        if match is None or not os.path.isfile(path):
+            return super().do_GET()
+        stat = os.stat(path)
+        last_modified = self.date_time_string(int(stat.st_mtime))
+        if self.headers.get("If-Range", last_modified) != last_modified:
+            return super().do_GET()
+        if self.headers.get("If-Modified-Since") == last_modified:
+            return super().do_GET()  # a 304, which comes before the range
+        start = int(match.group(1))
+        end = min(int(match.group(2) or stat.st_size - 1), stat.st_size - 1)
+        if start > end:
+            self.send_error(416)
+            return
+        self.send_response(206)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Range", f"bytes {start}-{end}/{stat.st_size}")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Last-Modified", last_modified)
+        self.end_headers()
+        with open(path, "rb") as f:
+            f.seek(start)
+            left = end - start + 1
+            while left:
+                chunk = f.read(min(left, 1024 * 1024))
+                self.wfile.write(chunk)
+                left -= len(chunk)
+
+
+def serve(root: str, port: int = 0):
+    """Serves root over http on 127.0.0.1 from a background thread.
+
+    Returns the server; its url is http://127.0.0.1:{server.server_address[1]}.
+    Call server.shutdown() when done."""
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", port), functools.partial(QuietHandler, directory=root)
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve synthetic LODES files locally")
+    parser.add_argument("--data-dir", default="benchmarks/data")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+    server = serve(args.data_dir, args.port)
+    print(f"serving {args.data_dir} at http://127.0.0.1:{args.port}, ctrl-c to stop")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -1,11 +1,17 @@
-from loder_components.db_setup import PayLode
-from loder_components.db_update import (
-    build_index,
-    local_flag,
-    build_regional_index,
-)
+from loder_components.db_setup import PayLode, LODES_URL
+from loder_components.cache import DownloadCache, DEFAULT_CACHE_DIR
+from loder_components.downloader import Downloader
+from loder_components.listing import Listings, DEFAULT_LISTING_DIR
+from loder_components.stream import GZIP_BACKENDS
+from loder_components.rollup import build_rollups, rollup_levels
+from loder_components.od_flows import build_od_flows, export_od_matrix, flow_contents
+from loder_components.parquet_sink import ParquetSink
+from loder_components import db_update, duckdb_backend
+from loder_components.metrics import metrics
 import os
 import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -14,14 +20,539 @@ DB = os.getenv("DB")
 NEWDB = os.getenv("NEWDB")
 SCHEMA = os.getenv("SCHEMA")
 LODES = os.getenv("LODES")
-YEAR = os.getenv("YEAR")
+# one year (2021) or a list of them ([2020, 2021])
+YEARS = json.loads(os.getenv("YEAR"))
 STATES = json.loads(os.getenv("STATES"))
 COUNTIES = json.loads(os.getenv("COUNTIES"))
 
+parser = argparse.ArgumentParser(description="Load LEHD LODES tables into Postgres")
+parser.add_argument(
+    "-j",
+    "--jobs",
+    type=int,
+    default=1,
+    help="number of concurrent COPY workers (db connections) per state",
+)
+parser.add_argument(
+    "--download-jobs",
+    type=int,
+    default=None,
+    help="number of concurrent downloads per state (defaults to --jobs)",
+)
+parser.add_argument(
+    "--download-parts",
+    type=int,
+    default=4,
+    help="parallel byte-range requests per large file (64MB+); 1 turns splitting off but still resumes",
+)
+parser.add_argument(
+    "--download-retries",
+    type=int,
+    default=5,
+    help="retries (with exponential backoff) for a download that drops or gets a 5xx/429",
+)
+parser.add_argument(
+    "--gzip-backend",
+    choices=["auto"] + GZIP_BACKENDS,
+    default="auto",
+    help="what inflates files on their way to COPY; auto picks isal, zlib-ng, igzip or pigz when installed, else zlib",
+)
+parser.add_argument(
+    "--parse-engine",
+    choices=["text", "arrow"],
+    default="text",
+    help="arrow parses and validates files in typed pyarrow batches before COPY (and writes --sink both's Parquet from the same batches)",
+)
+parser.add_argument(
+    "--years",
+    default=None,
+    help="comma separated years to load, instead of YEAR (e.g. 2020,2021)",
+)
+parser.add_argument(
+    "--parallel-states",
+    action="store_true",
+    help="load each state in its own process after creating the tables once",
+)
+parser.add_argument(
+    "--cache-dir",
+    default=None,
+    help=f"keep downloads in an on-disk cache here (e.g. {DEFAULT_CACHE_DIR})",
+)
+parser.add_argument(
+    "--cache-size",
+    type=float,
+    default=20,
+    help="size cap for the download cache in GB; least recently used files go first",
+)
+parser.add_argument(
+    "--offline",
+    action="store_true",
+    help="load only from the download cache, never touch the network",
+)
+parser.add_argument(
+    "--plan",
+    action="store_true",
+    help="print the files each state would load (from the LEHD directory listings, biggest first) and the bytes to download, and exit",
+)
+parser.add_argument(
+    "--no-listings",
+    action="store_true",
+    help="request every job type/segment file instead of only the ones in the LEHD directory listings",
+)
+parser.add_argument(
+    "--listing-max-age",
+    type=float,
+    default=24,
+    help="hours a cached directory listing is used before asking LEHD again",
+)
+parser.add_argument(
+    "--reflag",
+    action="store_true",
+    help="recompute dvrpc_reg/home_reg/work_reg from xwalk after loading (flags are normally set during the load)",
+)
+parser.add_argument(
+    "--partition",
+    action="store_true",
+    help="create the combined tables partitioned by state and job type (or scope for od)",
+)
+parser.add_argument(
+    "--profile",
+    choices=["standard", "compact", "keyed"],
+    default="standard",
+    help="column types for new tables; compact uses int4 counts, dates and text names, "
+    "keyed is compact with int8 block geocodes (and {table}_text views showing them as text)",
+)
+parser.add_argument(
+    "--migrate-compact",
+    action="store_true",
+    help="convert existing tables to the compact column types, print their sizes before and after, and exit",
+)
+parser.add_argument(
+    "--migrate-keyed",
+    action="store_true",
+    help="convert existing tables' block geocodes to int8 and add the {table}_text views, print sizes, and exit",
+)
+parser.add_argument(
+    "--binary-copy",
+    action="store_true",
+    help="send rows to Postgres in COPY's binary format (needs --profile compact or keyed)",
+)
+parser.add_argument(
+    "--index-jobs",
+    type=int,
+    default=4,
+    help="number of indexes to build at once, each on its own connection",
+)
+parser.add_argument(
+    "--index-mem",
+    default=None,
+    help="maintenance_work_mem for each index build, e.g. 1GB (server default if not set)",
+)
+parser.add_argument(
+    "--index-workers",
+    type=int,
+    default=None,
+    help="max_parallel_maintenance_workers for each index build",
+)
+parser.add_argument(
+    "--index-kinds",
+    default="",
+    help="extra indexes to build, comma separated: composite, brin, partial",
+)
+parser.add_argument(
+    "--rollups",
+    nargs="?",
+    const=",".join(rollup_levels),
+    default=None,
+    help=f"build wac/rac totals by geography after loading (default levels: {','.join(rollup_levels)})",
+)
+parser.add_argument(
+    "--od-flows",
+    nargs="?",
+    const="trct,cty",
+    default=None,
+    help="build od flow tables aggregated to these levels (default: trct,cty; also bgrp, zcta, cbsa)",
+)
+parser.add_argument(
+    "--export-od",
+    default=None,
+    help="write each od flow table as sparse .npz matrices (one per year and job type) into this folder",
+)
+parser.add_argument(
+    "--sink",
+    choices=["postgres", "parquet", "both", "duckdb"],
+    default="postgres",
+    help="write to Postgres, to partitioned Parquet files (no db needed), both, or a DuckDB file",
+)
+parser.add_argument(
+    "--parquet-dir",
+    default="parquet",
+    help="folder for the Parquet datasets (with --sink parquet or both)",
+)
+parser.add_argument(
+    "--duckdb-path",
+    default=None,
+    help="the DuckDB file to load into with --sink duckdb (default: {DB}.duckdb)",
+)
+parser.add_argument(
+    "--lodes-url",
+    default=LODES_URL,
+    help="where to download LODES from, e.g. a mirror or the benchmark server",
+)
+parser.add_argument(
+    "--region-only",
+    action="store_true",
+    help="only load rows that touch COUNTIES: od rows with the home or work block in them, wac/rac rows for their blocks",
+)
+parser.add_argument(
+    "--swap",
+    action="store_true",
+    help="build everything in a {SCHEMA}_next schema, then swap it in for SCHEMA in one short transaction (the old one is kept as {SCHEMA}_previous)",
+)
+parser.add_argument(
+    "--swap-back",
+    action="store_true",
+    help="make {SCHEMA}_previous live again (and the current data {SCHEMA}_previous), then exit",
+)
+parser.add_argument(
+    "--commit-every",
+    type=int,
+    default=1,
+    help="files each COPY connection loads per transaction (each file still rolls back on its own if it fails)",
+)
+parser.add_argument(
+    "--pg-set",
+    action="append",
+    default=[],
+    metavar="NAME=VALUE",
+    help="session setting for every db connection, on top of the bulk-load ones (repeatable, env: PG_SETTINGS)",
+)
+parser.add_argument(
+    "--no-bulk-session",
+    action="store_true",
+    help="keep the server's default session settings instead of the bulk-load ones (synchronous_commit=off etc.)",
+)
+parser.add_argument(
+    "--metrics",
+    default=os.getenv("LODER_METRICS"),
+    help="append per-file and per-stage timings to this JSON lines file (env: LODER_METRICS)",
+)
+parser.add_argument(
+    "--prometheus",
+    default=os.getenv("LODER_PROMETHEUS"),
+    help="write the run's totals to this Prometheus textfile at the end (env: LODER_PROMETHEUS)",
+)
+parser.add_argument(
+    "--profile-stages",
+    default=os.getenv("LODER_PROFILE", ""),
+    help="stages to run under cProfile, comma separated or 'all' (env: LODER_PROFILE)",
+)
+parser.add_argument(
+    "--tracemalloc-stages",
+    default=os.getenv("LODER_TRACEMALLOC", ""),
+    help="stages to trace allocations in, comma separated or 'all' (env: LODER_TRACEMALLOC)",
+)
+parser.add_argument(
+    "--profile-dir",
+    default=os.getenv("LODER_PROFILE_DIR", "profiles"),
+    help="where profiles are written (env: LODER_PROFILE_DIR)",
+)
+args = parser.parse_args()
+metrics.configure(
+    args.metrics,
+    args.prometheus,
+    [stage for stage in args.profile_stages.split(",") if stage],
+    [stage for stage in args.tracemalloc_stages.split(",") if stage],
+    args.profile_dir,
+)
+db_update.pool.configure(db_update.session_settings(args.pg_set, not args.no_bulk_session))
+if args.years:
+    YEARS = [int(year) for year in args.years.split(",")]
+if not isinstance(YEARS, list):
+    YEARS = [YEARS]
+if args.sink == "duckdb" and args.parallel_states:
+    parser.error("--parallel-states can't be used with --sink duckdb, a DuckDB file has one writer")
+if args.plan and args.no_listings:
+    parser.error("--plan needs the directory listings, drop --no-listings")
+if args.swap and args.sink != "postgres":
+    parser.error("--swap only works with --sink postgres")
+
+# with --swap every step writes to the shadow schema, and readers keep using the
+# live one until swap_schema renames them at the end. an unfinished shadow schema
+# is picked up where it left off, thanks to its load_manifest
+LIVE_SCHEMA = SCHEMA
+if args.swap:
+    SCHEMA = f"{LIVE_SCHEMA}_next"
+
+# flags and indexes run against whichever db the data went into; both modules
+# have the same functions, taking a db name (postgres) or a file path (duckdb)
+if args.sink == "duckdb":
+    backend = duckdb_backend
+    BACKEND_DB = args.duckdb_path or f"{DB}.duckdb"
+else:
+    backend = db_update
+    BACKEND_DB = DB
+
+
+def make_downloader():
+    """Builds the downloader from the cli args"""
+    return Downloader(parts=args.download_parts, retries=args.download_retries)
+
+
+def make_cache(downloader=None):
+    """Builds the download cache from the cli args, or None if caching is off"""
+    if args.cache_dir is None and not args.offline:
+        return None
+    return DownloadCache(
+        args.cache_dir or DEFAULT_CACHE_DIR,
+        max_bytes=int(args.cache_size * 1024**3),
+        offline=args.offline,
+        downloader=downloader,
+    )
+
+
+def make_listings(downloader=None):
+    """Builds the directory listings from the cli args, or None if they're off"""
+    if args.no_listings:
+        return None
+    return Listings(
+        os.path.join(args.cache_dir, "listings") if args.cache_dir else DEFAULT_LISTING_DIR,
+        max_age=args.listing_max_age * 3600,
+        offline=args.offline,
+        downloader=downloader,
+    )
+
+
+def find_region():
+    """County FIPS codes for COUNTIES, from whichever xwalk was loaded"""
+    if args.sink == "parquet":
+        return ParquetSink(args.parquet_dir).region(COUNTIES)
+    return backend.region_fips(BACKEND_DB, COUNTIES, SCHEMA)
+
+
+def load_state(state: str, setup: bool = True, tables: list = None, region: list = None):
+    """Runs PayLode for one state. Top level so worker processes can pickle it.
+
+    Returns (state, table, job_type, year) for every file that was actually loaded."""
+    downloader = make_downloader()
+    lode = PayLode(
+        NEWDB,
+        YEARS,
+        state,
+        LODES,
+        DB,
+        COUNTIES,
+        "all",
+        SCHEMA,
+        jobs=args.jobs,
+        download_jobs=args.download_jobs,
+        setup=setup,
+        cache=make_cache(downloader),
+        tables=tables,
+        region=region,
+        partition=args.partition,
+        profile=args.profile,
+        copy_format="binary" if args.binary_copy else "csv",
+        sink=args.sink,
+        parquet_dir=args.parquet_dir,
+        duckdb_path=BACKEND_DB,
+        lodes_url=args.lodes_url,
+        region_only=args.region_only,
+        commit_every=args.commit_every,
+        downloader=downloader,
+        gzip_backend=args.gzip_backend,
+        parse_engine=args.parse_engine,
+        listings=make_listings(downloader),
+    )
+    return [(state, task.table, task.job_type, task.year) for task in lode.loaded]
+
+
+def print_plan(tables: list):
+    """Prints what each state's load would fetch, in order, and the bytes to download.
+
+    Nothing is downloaded or loaded; only the directory listings are read."""
+    listings = make_listings(make_downloader())
+    files, total, unknown = 0, 0, 0
+    for state in STATES:
+        lode = PayLode(
+            NEWDB,
+            YEARS,
+            state,
+            LODES,
+            DB,
+            COUNTIES,
+            "all",
+            SCHEMA,
+            setup=False,
+            load=False,
+            lodes_url=args.lodes_url,
+            listings=listings,
+        )
+        tasks, unlisted = [], []
+        # the xwalk goes first on its own, like in a load
+        for group in tables:
+            tasks += lode.plan(group)
+            unlisted += lode.unlisted
+        size = sum(task.listed_bytes or 0 for task in tasks)
+        print(f"{state}: {len(tasks)} file(s), {size / 1024**2:,.1f} MB, {len(unlisted)} not listed")
+        for task in tasks:
+            listed = f"{task.listed_bytes:,}" if task.listed_bytes is not None else "?"
+            print(f"{listed:>16}  {task.url}")
+        files += len(tasks)
+        total += size
+        unknown += sum(task.listed_bytes is None for task in tasks)
+    print(f"{files} file(s) to download, {total / 1024**2:,.1f} MB")
+    if unknown:
+        print(f"{unknown} of them have no size in their listing and aren't counted")
+
+
+def run():
+    """Loads every state, then runs the db steps. Each step is a metrics stage"""
+    if args.migrate_compact:
+        db_update.migrate_to_compact(DB, LIVE_SCHEMA)
+        return
+    if args.migrate_keyed:
+        db_update.migrate_to_keyed(DB, LIVE_SCHEMA)
+        return
+    if args.swap_back:
+        db_update.swap_back(DB, LIVE_SCHEMA)
+        return
+    # every state's xwalk is loaded before anything else, because od_aux rows can
+    # point at regional counties in any of the states
+    XWALK = ["xwalk"]
+    DATA = ["od_main", "od_aux", "wac", "rac"]
+    if args.plan:
+        print_plan([XWALK, DATA])
+        return
+    if args.parallel_states:
+        # db, schema and tables are created once, then every state loads at once
+        PayLode(
+            NEWDB,
+            YEARS,
+            STATES[0],
+            LODES,
+            DB,
+            COUNTIES,
+            "all",
+            SCHEMA,
+            load=False,
+            partition=args.partition,
+            profile=args.profile,
+            sink=args.sink,
+            parquet_dir=args.parquet_dir,
+        )
+        with ProcessPoolExecutor(max_workers=len(STATES)) as pool:
+            n = len(STATES)
+            with metrics.stage("xwalk", states=STATES):
+                loaded = list(pool.map(load_state, STATES, [False] * n, [XWALK] * n))
+                region = find_region()
+            with metrics.stage("data", states=STATES):
+                loaded += pool.map(load_state, STATES, [False] * n, [DATA] * n, [region] * n)
+    else:
+        with metrics.stage("xwalk", states=STATES):
+            loaded = [load_state(state, tables=XWALK) for state in STATES]
+            region = find_region()
+        with metrics.stage("data", states=STATES):
+            for state in STATES:
+                loaded.append(load_state(state, setup=False, tables=DATA, region=region))
+    loaded = [file for files in loaded for file in files]
+    if args.sink == "parquet":
+        # indexes, flags and rollups are all db steps
+        return
+
+    index_options = {
+        "jobs": args.index_jobs,
+        "maintenance_work_mem": args.index_mem,
+        "parallel_workers": args.index_workers,
+        "kinds": [kind.strip() for kind in args.index_kinds.split(",") if kind.strip()],
+    }
+    with metrics.stage("index"):
+        backend.build_index(BACKEND_DB, COUNTIES, max(YEARS), SCHEMA, **index_options)
+    if args.reflag:
+        with metrics.stage("flag"):
+            backend.local_flag(BACKEND_DB, max(YEARS), COUNTIES, SCHEMA)
+    with metrics.stage("regional_index"):
+        backend.build_regional_index(BACKEND_DB, SCHEMA, **index_options)
+    if args.sink == "duckdb":
+        if args.rollups or args.od_flows:
+            print("rollups and od flow tables are only built in postgres, skipping them")
+        return
+
+    if args.rollups:
+        # only refresh what this run changed; a new xwalk changes every year and job type
+        states = sorted({state for state, _, _, _ in loaded})
+        years = sorted({year for _, table, _, year in loaded if table != "xwalk"})
+        job_types = sorted({job_type for _, table, job_type, _ in loaded if table != "xwalk"})
+        if any(table == "xwalk" for _, table, _, _ in loaded):
+            years, job_types = None, None
+        if args.reflag or args.swap:
+            # a shadow schema may have been started by an earlier run, build it all
+            states, years, job_types = None, None, None
+        with metrics.stage("rollups"):
+            build_rollups(
+                DB,
+                SCHEMA,
+                years,
+                levels=args.rollups.split(","),
+                states=states,
+                job_types=job_types,
+                jobs=args.index_jobs,
+            )
+
+    if args.od_flows:
+        od_levels = args.od_flows.split(",")
+        od_states = sorted({state for state, _, _, _ in loaded})
+        od_years = sorted({year for _, table, _, year in loaded if table.startswith("od")})
+        od_job_types = sorted({jt for _, table, jt, _ in loaded if table.startswith("od")})
+        if args.reflag or args.swap:
+            od_states, od_years, od_job_types = None, None, None
+        with metrics.stage("od_flows"):
+            build_od_flows(
+                DB,
+                SCHEMA,
+                od_years,
+                levels=od_levels,
+                states=od_states,
+                job_types=od_job_types,
+                jobs=args.index_jobs,
+            )
+        if args.export_od:
+            os.makedirs(args.export_od, exist_ok=True)
+            with metrics.stage("export_od"):
+                # everything the flow tables hold, not only what this run (re)built,
+                # so a run with nothing new still writes the whole set
+                contents = {level: flow_contents(DB, SCHEMA, level) for level in od_levels}
+                export_years = {year for pairs in contents.values() for year, _ in pairs}
+                # a single year keeps the file names it always had
+                several = len(export_years) > 1
+                for level in od_levels:
+                    for year, job_type in contents[level]:
+                        suffix = f"_{year}" if several else ""
+                        export_od_matrix(
+                            DB,
+                            SCHEMA,
+                            level,
+                            job_type,
+                            os.path.join(args.export_od, f"od_{level}_{job_type}{suffix}.npz"),
+                            year=year,
+                        )
+
+    if args.swap:
+        with metrics.stage("swap"):
+            db_update.swap_schema(DB, LIVE_SCHEMA, SCHEMA)
+
+    if args.metrics:
+        # server-side timings, when the db has pg_stat_statements
+        for stat in db_update.statement_stats(DB, SCHEMA):
+            metrics.record("server", **stat)
 
-for state in STATES:
-    PayLode(NEWDB, YEAR, state, LODES, DB, COUNTIES, "all", SCHEMA)
 
-build_index(DB, COUNTIES, YEAR, SCHEMA)
-local_flag(DB, YEAR, COUNTIES, SCHEMA)
-build_regional_index(DB, SCHEMA)
+if __name__ == "__main__":
+    try:
+        run()
+    finally:
+        opened, reused = db_update.pool.close_all()
+        if opened:
+            print(f"opened {opened} db connection(s), reused them {reused} time(s)")
+            metrics.record("pool", opened=opened, reused=reused)
+        metrics.write_prometheus()
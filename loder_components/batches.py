@@ -0,0 +1,366 @@
+import array
+import io
+import struct
+import sys
+from .config import od_columns, wac_columns, rac_columns, xwalk_columns
+from .stream import IterStream, binary_encoders
+
+BLOCK_SIZE = 16 * 1024 * 1024  # bytes of csv per parsed batch
+GEOCODE_WIDTH = 15  # digits in a block geocode
+PG_EPOCH_DAYS = 10957  # days from 1970-01-01 (arrow's epoch) to 2000-01-01 (postgres')
+
+# csv columns and which of them hold block geocodes, by kind of file
+layouts = {
+    "od_main": ("combined_od", od_columns, ["w_geocode", "h_geocode"]),
+    "od_aux": ("combined_od", od_columns, ["w_geocode", "h_geocode"]),
+    "wac": ("combined_wac", wac_columns, ["w_geocode"]),
+    "rac": ("combined_rac", rac_columns, ["h_geocode"]),
+    "xwalk": ("xwalk", xwalk_columns, ["tabblk2020"]),
+}
+
+
+class ValidationError(Exception):
+    """A LODES file with a value that doesn't fit its layout"""
+
+
+class _Reader(io.RawIOBase):
+    """Lets pyarrow read one of our streams (a GzipStream, ReadAhead, ...)"""
+
+    def __init__(self, source) -> None:
+        self.source = source
+
+    def readable(self):
+        return True
+
+    def read(self, size: int = -1):
+        return self.source.read(size)
+
+
+def column_types(table: str):
+    """The arrow type of each csv column of a kind of file"""
+    import pyarrow as pa
+
+    _, columns, geocodes = layouts[table]
+    if table == "xwalk":
+        return {
+            col: pa.float64() if col in ["blklatdd", "blklondd"] else pa.string()
+            for col in columns
+        }
+    return {
+        col: pa.string() if col in geocodes or col == "createdate" else pa.int32()
+        for col in columns
+    }
+
+
+def flag_names(table: str):
+    """The regional flag columns flag() adds, in order"""
+    if table in ["rac", "wac"]:
+        return ["dvrpc_reg"]
+    if table in ["od_main", "od_aux"]:
+        return ["dvrpc_reg", "home_reg", "work_reg"]
+    return []
+
+
+def batch_schema(table: str):
+    """Schema of the batches read_batches() and then flag() produce"""
+    import pyarrow as pa
+
+    fields = [pa.field(col, kind) for col, kind in column_types(table).items()]
+    return pa.schema(fields + [pa.field(name, pa.bool_()) for name in flag_names(table)])
+
+
+def read_batches(table: str, source, block_size: int = BLOCK_SIZE, url: str = None):
+    """Yields a LODES csv as typed, validated record batches, parsed by pyarrow.
+
+    source is the decompressed csv (any of our streams, or an open pyarrow stream).
+    Each batch is about block_size bytes of csv, parsed on pyarrow's threads, so the
+    cost scales with the number of batches rather than rows times columns. Counts
+    must be non-negative integers, geocodes 15 digits, createdate 8 digits and
+    nothing may be empty (the xwalk's text columns aside); the first bad value
+    raises a ValidationError naming its line."""
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+
+    _, columns, _ = layouts[table]
+    if not isinstance(source, pa.NativeFile):
+        source = pa.PythonFile(_Reader(source), mode="r")
+    line = 2  # of the first row in the next batch, after the header
+    try:
+        reader = pacsv.open_csv(
+            source,
+            # name the columns ourselves; the headers' capitalisation varies
+            read_options=pacsv.ReadOptions(
+                column_names=columns, skip_rows=1, block_size=block_size
+            ),
+            convert_options=pacsv.ConvertOptions(column_types=column_types(table)),
+        )
+        for batch in reader:
+            validate(table, batch, line, url)
+            line += batch.num_rows
+            yield batch
+    except pa.ArrowInvalid as e:
+        raise ValidationError(f"{url or table} near line {line:,}: {e}") from e
+
+
+def validate(table: str, batch, line: int = 2, url: str = None):
+    """Raises a ValidationError for the first value in a batch that doesn't fit.
+    line is the csv line of the batch's first row"""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    _, _, geocodes = layouts[table]
+
+    def fail(column: str, ok, problem: str):
+        row = pc.index(ok, False).as_py()
+        value = batch.column(column)[row].as_py()
+        raise ValidationError(f"{url or table} line {line + row:,}: {column} {value!r} {problem}")
+
+    def check(column: str, ok, problem: str):
+        ok = pc.fill_null(ok, False)
+        if not pc.all(ok).as_py():
+            fail(column, ok, problem)
+
+    for column in batch.schema.names:
+        values = batch.column(column)
+        if values.null_count:
+            fail(column, pc.is_valid(values), "is empty")
+        if column in geocodes or column == "createdate":
+            width = GEOCODE_WIDTH if column in geocodes else 8
+            check(
+                column,
+                pc.and_(pc.equal(pc.binary_length(values), width), pc.utf8_is_digit(values)),
+                f"isn't {width} digits",
+            )
+        elif pa.types.is_integer(values.type):
+            check(column, pc.greater_equal(values, 0), "is negative")
+
+
+def flag(table: str, batch, region: list):
+    """Adds dvrpc_reg (and home_reg/work_reg for od) to a batch, from the county FIPS
+    prefix of its geocodes"""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    if table == "xwalk":
+        return batch
+    region = pa.array(region or [], pa.string())
+
+    def local(column):
+        prefix = pc.utf8_slice_codeunits(batch.column(column), 0, 5)
+        return pc.is_in(prefix, value_set=region)
+
+    if table in ["rac", "wac"]:
+        col = "h_geocode" if table == "rac" else "w_geocode"
+        return pa.RecordBatch.from_arrays(
+            batch.columns + [local(col)], batch.schema.names + ["dvrpc_reg"]
+        )
+    home, work = local("h_geocode"), local("w_geocode")
+    return pa.RecordBatch.from_arrays(
+        batch.columns + [pc.or_(home, work), home, work],
+        batch.schema.names + ["dvrpc_reg", "home_reg", "work_reg"],
+    )
+
+
+# fixed width binary COPY encodings: arrow type to cast to, and its array typecode
+_fixed_types = {
+    "smallint": ("int16", "h"),
+    "integer": ("int32", "i"),
+    "bigint": ("int64", "q"),
+    "real": ("float32", "f"),
+    "double precision": ("float64", "d"),
+    "date": ("int32", "i"),
+}
+
+
+def _values(values, pg_type: str):
+    """A column's big-endian binary COPY values as (width, bytes), or None if they
+    don't all have the same width (and need encoding row by row)"""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    if pg_type == "boolean":
+        values = pc.cast(values, pa.uint8())
+        return 1, values.buffers()[1].to_pybytes()[values.offset :][: len(values)]
+    if pg_type in _fixed_types:
+        arrow_type, code = _fixed_types[pg_type]
+        if pg_type == "date":
+            if pa.types.is_string(values.type):
+                days = pc.strptime(pc.replace_substring(values, "-", ""), format="%Y%m%d", unit="s")
+                values = pc.cast(days, pa.date32())
+            values = pc.subtract(pc.cast(values, pa.int32()), PG_EPOCH_DAYS)
+        values = pc.cast(values, getattr(pa, arrow_type)())
+        width = values.type.bit_width // 8
+        data = array.array(code)
+        data.frombytes(values.buffers()[1].to_pybytes()[values.offset * width :][: len(values) * width])
+        if sys.byteorder == "little":
+            data.byteswap()
+        return width, data.tobytes()
+    if not pa.types.is_string(values.type):
+        values = pc.cast(values, pa.string())
+    lengths = pc.min_max(pc.binary_length(values)).as_py()
+    if len(values) == 0 or lengths["min"] != lengths["max"]:
+        return None
+    width = lengths["min"]
+    if width == 0:
+        return 0, b""  # sent as NULL, like an empty csv field
+    values = pc.cast(values, pa.binary(width))
+    return width, values.buffers()[1].to_pybytes()[values.offset * width :][: len(values) * width]
+
+
+def encode_binary(batch, types: list):
+    """Encodes a batch as rows of COPY's binary format (without the file header).
+
+    When every column has one width across the batch (always, for the validated
+    od/rac/wac files), a template row is repeated and each column's bytes are laid
+    into it with strided slice assignments, so the work is per column, not per
+    field. Otherwise (the xwalk's names) rows are encoded one by one."""
+    fields = [_values(batch.column(i), pg_type) for i, pg_type in enumerate(types)]
+    count = struct.pack(">h", len(types))
+    if any(field is None for field in fields):
+        return _encode_rows(batch, types, count)
+
+    # a template row holds the field count and every field's length; NULL for width 0
+    template = count + b"".join(
+        struct.pack(">i", width if width else -1) + b"\0" * width for width, _ in fields
+    )
+    size = len(template)
+    out = bytearray(template * batch.num_rows)
+    offset = len(count)
+    for width, data in fields:
+        offset += 4
+        for byte in range(width):
+            out[offset + byte :: size] = data[byte::width]
+        offset += width
+    return bytes(out)
+
+
+def _encode_rows(batch, types: list, count: bytes):
+    encoders = [binary_encoders[t] for t in types]
+    out = []
+    for row in zip(*(column.to_pylist() for column in batch.columns)):
+        fields = [count]
+        for encode, value in zip(encoders, row):
+            if isinstance(value, bool):
+                value = "t" if value else "f"
+            if value is None or value == "":
+                fields.append(b"\xff\xff\xff\xff")  # NULL
+            else:
+                data = encode(str(value))
+                fields.append(struct.pack(">i", len(data)) + data)
+        out.append(b"".join(fields))
+    return b"".join(out)
+
+
+def encode_csv(batch):
+    """Writes a batch as csv lines (no header) with pyarrow's writer. Empty strings
+    go out as NULLs, like the empty fields of the source csv would"""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pacsv
+
+    columns = []
+    for values in batch.columns:
+        if pa.types.is_string(values.type):
+            empty = pc.equal(values, "")
+            if pc.any(empty).as_py():
+                values = pc.if_else(empty, pa.scalar(None, pa.string()), values)
+        columns.append(values)
+    batch = pa.RecordBatch.from_arrays(columns, batch.schema.names)
+    sink = pa.BufferOutputStream()
+    pacsv.write_csv(batch, sink, pacsv.WriteOptions(include_header=False))
+    return sink.getvalue().to_pybytes()
+
+
+class ArrowCopy(IterStream):
+    """COPY input built from typed pyarrow batches instead of by slicing lines.
+
+    The batch engine's counterpart to StampedCsv (and BinaryCopy): each file is
+    parsed and validated in big batches (see read_batches), flagged and filtered
+    with pyarrow compute, given its per-file constants as repeated columns, and
+    written out as csv by pyarrow or as binary COPY rows (see encode_binary).
+    No python object is made per field. columns is the table columns the output
+    fills, in order.
+
+    Attributes
+    ----------
+        source : file-like
+            decompressed csv bytes, e.g. from open_gzip
+        table : str
+            kind of file: od_main, od_aux, wac, rac or xwalk
+        constants : dict
+            column name to the value every row gets
+        region : list
+            county FIPS codes that count as local
+        region_only : bool
+            drop rows where no geocode is local (counted in dropped)
+        block_size : int
+            bytes of csv per batch
+        url : str
+            where the file came from, for validation errors
+        on_batch : callable
+            on_batch(batch) gets every flagged, filtered batch before its constants
+            are added, e.g. to write the same rows to Parquet
+    """
+
+    def __init__(
+        self,
+        source,
+        table: str,
+        constants: dict = None,
+        region: list = (),
+        region_only: bool = False,
+        block_size: int = BLOCK_SIZE,
+        url: str = None,
+        on_batch=None,
+    ) -> None:
+        super().__init__()
+        self.source = source
+        self.table = table
+        self.constants = dict(constants or {})
+        self.region = list(region)
+        self.region_only = region_only and table != "xwalk"
+        self.block_size = block_size
+        self.url = url
+        self.on_batch = on_batch
+        self.types = None
+        self.columns = batch_schema(table).names + list(self.constants)
+        self.rows = 0
+        self.dropped = 0
+
+    def binary(self, types: list):
+        """Switches the output to COPY's binary format. types is the data_type of each
+        of columns"""
+        unsupported = [t for t in types if t not in binary_encoders]
+        if unsupported:
+            raise Exception(
+                f"binary COPY can't encode {sorted(set(unsupported))} columns, use the compact profile or csv"
+            )
+        self.types = list(types)
+        return self
+
+    def chunks(self):
+        import pyarrow as pa
+
+        if self.types is None:
+            yield (",".join(self.columns) + "\n").encode("utf-8")  # for COPY's HEADER
+        else:
+            yield b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+        for batch in read_batches(self.table, self.source, self.block_size, self.url):
+            batch = flag(self.table, batch, self.region)
+            if self.region_only:
+                kept = batch.filter(batch.column("dvrpc_reg"))
+                self.dropped += batch.num_rows - kept.num_rows
+                batch = kept
+            self.rows += batch.num_rows
+            if self.on_batch is not None:
+                self.on_batch(batch)
+            if batch.num_rows == 0:
+                continue
+            batch = pa.RecordBatch.from_arrays(
+                batch.columns
+                + [pa.repeat(pa.scalar(value), batch.num_rows) for value in self.constants.values()],
+                self.columns,
+            )
+            yield encode_csv(batch) if self.types is None else encode_binary(batch, self.types)
+        if self.types is not None:
+            yield struct.pack(">h", -1)
@@ -0,0 +1,169 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from .downloader import downloader as default_downloader
+from .stream import CHUNK_SIZE
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "loder")
+DEFAULT_MAX_BYTES = 20 * 1024**3  # 20GB, a bit more than PA+NJ for one year
+
+
+class DownloadCache:
+    """On-disk cache of downloaded LODES files.
+
+    File bodies are stored once under the sha256 of their content (blobs/), and an
+    index/ entry per URL points at a blob along with the ETag and Last-Modified the
+    server sent. Lookups revalidate with If-None-Match/If-Modified-Since, so an
+    unchanged file costs a 304 instead of a transfer. When the cache grows past
+    max_bytes, the least recently used entries are evicted.
+
+    Attributes
+    ----------
+        path : str
+            directory the cache lives in (created if needed)
+        max_bytes : int
+            size cap for all cached blobs together
+        offline : bool
+            never touch the network, only serve what's already cached
+        downloader : Downloader
+            fetches stale files (retrying, and resuming big ones from blobs/)
+    """
+
+    def __init__(
+        self,
+        path: str = DEFAULT_CACHE_DIR,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        offline: bool = False,
+        downloader=None,
+    ) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.downloader = downloader or default_downloader
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(self.path, "blobs"), exist_ok=True)
+        os.makedirs(os.path.join(self.path, "index"), exist_ok=True)
+
+    def __index_path(self, url: str):
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.path, "index", f"{key}.json")
+
+    def __blob_path(self, digest: str):
+        return os.path.join(self.path, "blobs", f"{digest}.gz")
+
+    def __read_entry(self, url: str):
+        """Returns the index entry for a url, or None if it isn't cached."""
+        try:
+            with open(self.__index_path(url)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def __write_entry(self, url: str, entry: dict):
+        """Atomically replaces the index entry for a url."""
+        index_path = self.__index_path(url)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(index_path))
+        with os.fdopen(fd, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp, index_path)
+
+    def __verify(self, entry: dict):
+        """True if the entry's blob exists and still hashes to its name."""
+        blob = self.__blob_path(entry["sha256"])
+        digest = hashlib.sha256()
+        try:
+            with open(blob, "rb") as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                    digest.update(chunk)
+        except OSError:
+            return False
+        return digest.hexdigest() == entry["sha256"]
+
+    def __touch(self, url: str, entry: dict):
+        entry["last_used"] = time.time()
+        self.__write_entry(url, entry)
+
+    def entry(self, url: str):
+        """Returns what the cache knows about url (sha256, bytes, etag, last_modified), or None."""
+        return self.__read_entry(url)
+
+    def open(self, url: str):
+        """Returns url's body as an open binary file, downloading it if the cache is stale.
+
+        Returns None if the server says the file doesn't exist (or, offline, if it
+        was never cached); other failures raise once the downloader gives up. The
+        file is opened before anything is evicted, so it stays readable even if its
+        blob is dropped while it's being loaded."""
+        entry = self.__read_entry(url)
+        if entry is not None and not self.__verify(entry):
+            print(f"cached copy of {url} is corrupt, discarding it")
+            entry = None
+
+        if self.offline:
+            if entry is None:
+                return None
+            self.__touch(url, entry)
+            return open(self.__blob_path(entry["sha256"]), "rb")
+
+        headers = {}
+        if entry is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        fetched = self.downloader.get(url, headers, os.path.join(self.path, "blobs"))
+        if fetched.status == "not_modified" and entry is not None:
+            self.__touch(url, entry)
+            return open(self.__blob_path(entry["sha256"]), "rb")
+        if fetched.status != "ok":
+            return None
+
+        # move the body to its content address
+        sha256 = fetched.sha256
+        fetched.fileobj.keep()
+        fetched.fileobj.close()
+        os.replace(fetched.path, self.__blob_path(sha256))
+        self.__write_entry(
+            url,
+            {
+                "url": url,
+                "sha256": sha256,
+                "bytes": fetched.bytes,
+                "etag": fetched.etag,
+                "last_modified": fetched.last_modified,
+                "last_used": time.time(),
+            },
+        )
+        fileobj = open(self.__blob_path(sha256), "rb")
+        self.evict()
+        return fileobj
+
+    def evict(self):
+        """Drops least recently used entries until the blobs fit under max_bytes."""
+        with self.lock:
+            index_dir = os.path.join(self.path, "index")
+            entries = []
+            for name in os.listdir(index_dir):
+                try:
+                    with open(os.path.join(index_dir, name)) as f:
+                        entries.append((name, json.load(f)))
+                except (OSError, ValueError):
+                    continue
+
+            # blobs can be shared by several urls, so count each one once
+            blob_sizes = {entry["sha256"]: entry["bytes"] for _, entry in entries}
+            total = sum(blob_sizes.values())
+            entries.sort(key=lambda item: item[1].get("last_used", 0))
+            while total > self.max_bytes and entries:
+                name, entry = entries.pop(0)
+                os.remove(os.path.join(index_dir, name))
+                if not any(e["sha256"] == entry["sha256"] for _, e in entries):
+                    try:
+                        os.remove(self.__blob_path(entry["sha256"]))
+                    except OSError:
+                        pass
+                    total -= blob_sizes[entry["sha256"]]
@@ -40,30 +40,15 @@ od_table = """
     si02 int,
     si03 int,
     createdate char(8),
+    year smallint,
     job_type char(4),
     state char(2),
     dvrpc_reg bool,
-    scope varchar
+    scope varchar,
+    home_reg bool,
+    work_reg bool
     """
 
-od_temp_table = f"""
-    SELECT
-        w_geocode,
-        h_geocode,
-        s000,
-        sa01,
-        sa02,
-        sa03,
-        se01,
-        se02,
-        se03,
-        si01,
-        si02,
-        si03,
-        createdate
-    FROM {SCHEMA}.combined_od WITH NO DATA;
-
-"""
 
 wac_table = """
     w_geocode char(15),
@@ -119,6 +104,7 @@ wac_table = """
     CFS04 numeric,
     CFS05 numeric,
     createdate char(8),
+    year smallint,
     state char(2),
     job_type char(4),
     segment char(4),
@@ -127,67 +113,6 @@ wac_table = """
     """
 
 
-wac_temp_table = f"""
-      select 
-        w_geocode,
-        C000,
-        CA01,
-        CA02,
-        CA03,
-        CE01,
-        CE02,
-        CE03,
-        CNS01,
-        CNS02,
-        CNS03,
-        CNS04,
-        CNS05,
-        CNS06,
-        CNS07,
-        CNS08,
-        CNS09,
-        CNS10,
-        CNS11,
-        CNS12,
-        CNS13,
-        CNS14,
-        CNS15,
-        CNS16,
-        CNS17,
-        CNS18,
-        CNS19,
-        CNS20,
-        CR01,
-        CR02,
-        CR03,
-        CR04,
-        CR05,
-        CR07,
-        CT01,
-        CT02,
-        CD01,
-        CD02,
-        CD03,
-        CD04,
-        CS01,
-        CS02,
-        CFA01,
-        CFA02,
-        CFA03,
-        CFA04,
-        CFA05,
-        CFS01,
-        CFS02,
-        CFS03,
-        CFS04,
-        CFS05,
-        createdate
-    FROM {SCHEMA}.combined_wac
-    WITH NO DATA;
-
-"""
-
-
 rac_table = """
     h_geocode char(15),
     C000 numeric,
@@ -232,61 +157,13 @@ rac_table = """
     CS01 numeric,
     CS02 numeric,
     createdate CHAR(8),
+    year smallint,
     state char(2),
     job_type char(4),
     segment char(4),
     dvrpc_reg bool
 """
 
-rac_temp_table = f"""
-    
-  select 
-    h_geocode,
-    C000,
-    CA01,
-    CA02,
-    CA03,
-    CE01,
-    CE02,
-    CE03,
-    CNS01,
-    CNS02,
-    CNS03,
-    CNS04,
-    CNS05,
-    CNS06,
-    CNS07,
-    CNS08,
-    CNS09,
-    CNS10,
-    CNS11,
-    CNS12,
-    CNS13,
-    CNS14,
-    CNS15,
-    CNS16,
-    CNS17,
-    CNS18,
-    CNS19,
-    CNS20,
-    CR01,
-    CR02,
-    CR03,
-    CR04,
-    CR05,
-    CR07,
-    CT01,
-    CT02,
-    CD01,
-    CD02,
-    CD03,
-    CD04,
-    CS01,
-    CS02,
-    createdate 
-    FROM {SCHEMA}.combined_rac
-    WITH NO DATA;
-"""
 
 xwalk = """
     tabblk2020 char(15) not null,
@@ -335,11 +212,409 @@ xwalk = """
     """
 
 
-xwalk_temp_table = f"""
-    SELECT *
-    FROM {SCHEMA}.xwalk WITH NO DATA;
+# column order of each csv file, for loading with explicit column lists
+od_columns = [
+    "w_geocode",
+    "h_geocode",
+    "s000",
+    "sa01",
+    "sa02",
+    "sa03",
+    "se01",
+    "se02",
+    "se03",
+    "si01",
+    "si02",
+    "si03",
+    "createdate",
+]
 
-"""
+wac_columns = [
+    "w_geocode",
+    "c000",
+    "ca01",
+    "ca02",
+    "ca03",
+    "ce01",
+    "ce02",
+    "ce03",
+    "cns01",
+    "cns02",
+    "cns03",
+    "cns04",
+    "cns05",
+    "cns06",
+    "cns07",
+    "cns08",
+    "cns09",
+    "cns10",
+    "cns11",
+    "cns12",
+    "cns13",
+    "cns14",
+    "cns15",
+    "cns16",
+    "cns17",
+    "cns18",
+    "cns19",
+    "cns20",
+    "cr01",
+    "cr02",
+    "cr03",
+    "cr04",
+    "cr05",
+    "cr07",
+    "ct01",
+    "ct02",
+    "cd01",
+    "cd02",
+    "cd03",
+    "cd04",
+    "cs01",
+    "cs02",
+    "cfa01",
+    "cfa02",
+    "cfa03",
+    "cfa04",
+    "cfa05",
+    "cfs01",
+    "cfs02",
+    "cfs03",
+    "cfs04",
+    "cfs05",
+    "createdate",
+]
+
+rac_columns = [
+    "h_geocode",
+    "c000",
+    "ca01",
+    "ca02",
+    "ca03",
+    "ce01",
+    "ce02",
+    "ce03",
+    "cns01",
+    "cns02",
+    "cns03",
+    "cns04",
+    "cns05",
+    "cns06",
+    "cns07",
+    "cns08",
+    "cns09",
+    "cns10",
+    "cns11",
+    "cns12",
+    "cns13",
+    "cns14",
+    "cns15",
+    "cns16",
+    "cns17",
+    "cns18",
+    "cns19",
+    "cns20",
+    "cr01",
+    "cr02",
+    "cr03",
+    "cr04",
+    "cr05",
+    "cr07",
+    "ct01",
+    "ct02",
+    "cd01",
+    "cd02",
+    "cd03",
+    "cd04",
+    "cs01",
+    "cs02",
+    "createdate",
+]
+
+xwalk_columns = [
+    "tabblk2020",
+    "st",
+    "st_usps",
+    "stname",
+    "cty",
+    "ctyname",
+    "trct",
+    "trctname",
+    "bgrp",
+    "bgrpname",
+    "cbsa",
+    "cbsaname",
+    "zcta",
+    "zctaname",
+    "stplc",
+    "stplcname",
+    "ctycsub",
+    "ctycsubname",
+    "stcd116",
+    "stcd116name",
+    "stsldl",
+    "stsldlname",
+    "stsldu",
+    "stslduname",
+    "stschool",
+    "stschoolname",
+    "stsecon",
+    "stseconname",
+    "trib",
+    "tribname",
+    "tsub",
+    "tsubname",
+    "stanrc",
+    "stanrcname",
+    "necta",
+    "nectaname",
+    "mil",
+    "milname",
+    "stwib",
+    "stwibname",
+    "blklatdd",
+    "blklondd",
+    "createdate",
+]
+
+# the "compact" profile stores counts as int4 instead of numeric, createdate as a
+# date, and xwalk names as text instead of char(100). fixed-width columns come
+# first so rows pack without alignment padding.
+
+compact_od_table = """
+    s000 int4,
+    sa01 int4,
+    sa02 int4,
+    sa03 int4,
+    se01 int4,
+    se02 int4,
+    se03 int4,
+    si01 int4,
+    si02 int4,
+    si03 int4,
+    createdate date,
+    year smallint,
+    dvrpc_reg bool,
+    home_reg bool,
+    work_reg bool,
+    w_geocode char(15) not null,
+    h_geocode char(15) not null,
+    job_type char(4),
+    state char(2),
+    scope varchar
+    """
+
+compact_wac_table = """
+    c000 int4,
+    ca01 int4,
+    ca02 int4,
+    ca03 int4,
+    ce01 int4,
+    ce02 int4,
+    ce03 int4,
+    cns01 int4,
+    cns02 int4,
+    cns03 int4,
+    cns04 int4,
+    cns05 int4,
+    cns06 int4,
+    cns07 int4,
+    cns08 int4,
+    cns09 int4,
+    cns10 int4,
+    cns11 int4,
+    cns12 int4,
+    cns13 int4,
+    cns14 int4,
+    cns15 int4,
+    cns16 int4,
+    cns17 int4,
+    cns18 int4,
+    cns19 int4,
+    cns20 int4,
+    cr01 int4,
+    cr02 int4,
+    cr03 int4,
+    cr04 int4,
+    cr05 int4,
+    cr07 int4,
+    ct01 int4,
+    ct02 int4,
+    cd01 int4,
+    cd02 int4,
+    cd03 int4,
+    cd04 int4,
+    cs01 int4,
+    cs02 int4,
+    cfa01 int4,
+    cfa02 int4,
+    cfa03 int4,
+    cfa04 int4,
+    cfa05 int4,
+    cfs01 int4,
+    cfs02 int4,
+    cfs03 int4,
+    cfs04 int4,
+    cfs05 int4,
+    createdate date,
+    year smallint,
+    dvrpc_reg bool,
+    w_geocode char(15),
+    state char(2),
+    job_type char(4),
+    segment char(4)
+    """
+
+compact_rac_table = """
+    c000 int4,
+    ca01 int4,
+    ca02 int4,
+    ca03 int4,
+    ce01 int4,
+    ce02 int4,
+    ce03 int4,
+    cns01 int4,
+    cns02 int4,
+    cns03 int4,
+    cns04 int4,
+    cns05 int4,
+    cns06 int4,
+    cns07 int4,
+    cns08 int4,
+    cns09 int4,
+    cns10 int4,
+    cns11 int4,
+    cns12 int4,
+    cns13 int4,
+    cns14 int4,
+    cns15 int4,
+    cns16 int4,
+    cns17 int4,
+    cns18 int4,
+    cns19 int4,
+    cns20 int4,
+    cr01 int4,
+    cr02 int4,
+    cr03 int4,
+    cr04 int4,
+    cr05 int4,
+    cr07 int4,
+    ct01 int4,
+    ct02 int4,
+    cd01 int4,
+    cd02 int4,
+    cd03 int4,
+    cd04 int4,
+    cs01 int4,
+    cs02 int4,
+    createdate date,
+    year smallint,
+    dvrpc_reg bool,
+    h_geocode char(15),
+    state char(2),
+    job_type char(4),
+    segment char(4)
+    """
+
+compact_xwalk = """
+    blklatdd float8,
+    blklondd float8,
+    createdate date,
+    tabblk2020 char(15) not null,
+    st char(2),
+    st_usps char(2),
+    stname text,
+    cty char(5),
+    ctyname text,
+    trct char(11),
+    trctname text,
+    bgrp char(12),
+    bgrpname text,
+    cbsa char(5),
+    cbsaname text,
+    zcta char(5),
+    zctaname text,
+    stplc char(7),
+    stplcname text,
+    ctycsub char(10),
+    ctycsubname text,
+    stcd116 char(4),
+    stcd116name text,
+    stsldl char(5),
+    stsldlname text,
+    stsldu char(5),
+    stslduname text,
+    stschool char(7),
+    stschoolname text,
+    stsecon char(7),
+    stseconname text,
+    trib char(5),
+    tribname text,
+    tsub char(7),
+    tsubname text,
+    stanrc char(7),
+    stanrcname text,
+    necta char(5),
+    nectaname text,
+    mil char(22),
+    milname text,
+    stwib char(8),
+    stwibname text
+    """
+
+# the "keyed" profile is compact with block geocodes stored as int8 instead of
+# char(15): 8 bytes instead of 16 per geocode, smaller indexes, and joins and region
+# tests that compare integers. geocodes start with the state FIPS, so leading zeros
+# are dropped and come back with lpad (see the {table}_text views db_update makes).
+geocode_columns = ["w_geocode", "h_geocode", "tabblk2020"]
+
+
+def _keyed(ddl: str):
+    """A compact DDL with its geocodes as int8, moved to the front so they stay aligned"""
+    lines = [line.strip().rstrip(",") for line in ddl.strip().splitlines()]
+    keys = [line.replace("char(15)", "int8") for line in lines if line.split()[0] in geocode_columns]
+    rest = [line for line in lines if line.split()[0] not in geocode_columns]
+    return "\n    " + ",\n    ".join(keys + rest) + "\n    "
+
+
+table_profiles = {
+    "standard": {
+        "od": od_table,
+        "wac": wac_table,
+        "rac": rac_table,
+        "xwalk": xwalk,
+    },
+    "compact": {
+        "od": compact_od_table,
+        "wac": compact_wac_table,
+        "rac": compact_rac_table,
+        "xwalk": compact_xwalk,
+    },
+    "keyed": {
+        "od": _keyed(compact_od_table),
+        "wac": _keyed(compact_wac_table),
+        "rac": _keyed(compact_rac_table),
+        "xwalk": _keyed(compact_xwalk),
+    },
+}
+
+manifest_table = """
+    url text primary key,
+    state char(2),
+    year int,
+    job_type varchar,
+    segment varchar,
+    scope varchar,
+    bytes bigint,
+    row_count bigint,
+    checksum char(64),
+    etag text,
+    last_modified text,
+    status varchar,
+    loaded_at timestamptz,
+    dropped_rows bigint,
+    row_filter text
+    """
 
 
 naics_cols = [
@@ -1,20 +1,32 @@
-import requests
-import gzip
-import csv
-from io import BytesIO, TextIOWrapper, StringIO
+import time
 from .config import (
     job_types,
     workforce_types,
-    od_table,
-    od_temp_table,
-    wac_table,
-    wac_temp_table,
-    rac_table,
-    rac_temp_table,
-    xwalk,
-    xwalk_temp_table,
+    od_columns,
+    wac_columns,
+    rac_columns,
+    xwalk_columns,
+    table_profiles,
+    manifest_table,
 )
-from .db_update import db_connect
+from .db_update import db_connect, region_fips, has_column, create_geocode_views
+from .pipeline import LoadTask, run_pipeline, download, NOT_MODIFIED
+from .stream import open_gzip, pick_gzip_backend, StampedCsv, BinaryCopy, CHUNK_SIZE
+from .parquet_sink import ParquetSink
+from .batches import ArrowCopy
+from .duckdb_backend import DuckDBSink
+from .metrics import metrics
+
+LODES_URL = "https://lehd.ces.census.gov/data/lodes"
+
+# the table each kind of file goes into, and the columns its csv has (in order)
+target_tables = {
+    "od_main": ("combined_od", od_columns),
+    "od_aux": ("combined_od", od_columns),
+    "rac": ("combined_rac", rac_columns),
+    "wac": ("combined_wac", wac_columns),
+    "xwalk": ("xwalk", xwalk_columns),
+}
 
 
 class PayLode:
@@ -24,8 +36,9 @@ class PayLode:
     ----------
         create_db : str
             tell program to create a new db, or use an existing one. was originally bool in .env but that evaluates to string.
-        year : int
-            year of the lodes/lehd table you want to pull
+        year : int or list
+            year(s) of the lodes/lehd tables you want to pull. rows get a year column,
+            and the xwalk (which isn't per year) is loaded once
         state: str
             state you are interested in, in shorthand (i.e., "pa" for Pennsylvania)
         lode_no : str
@@ -38,6 +51,59 @@ class PayLode:
             "pick" lets you pick tables via a TUI, "all" just brings in all tables
         schema: str
             the schema you want to put data in (existing or not)
+        jobs: int
+            number of concurrent COPY workers, each with its own db connection
+        download_jobs: int
+            number of concurrent download workers (defaults to jobs)
+        setup: bool
+            create the db, schema and tables. turn off when another process already did
+        load: bool
+            download and insert this state's files. turn off to only run setup
+        cache: DownloadCache
+            optional on-disk download cache; files are fetched through it when given
+        downloader: Downloader
+            how files are fetched without a cache: retries, and parallel resumable
+            byte ranges for big ones (a shared default when not given)
+        tables: list
+            which of od_main, od_aux, wac, rac and xwalk to load (default all of them)
+        region: list
+            county FIPS codes (first 5 digits of a block geocode) that count as local.
+            looked up from xwalk after it's loaded when not given
+        partition: bool
+            create the combined tables partitioned by year, then state, then job_type
+            (rac/wac) or scope (od). a year and state's partitions are created when it's loaded
+        profile: str
+            "standard", "compact" or "keyed" (compact with int8 block geocodes, and
+            {table}_text views that show them as text) column types for new tables
+            (see config.table_profiles)
+        copy_format: str
+            "csv", or "binary" to send rows in COPY's binary format (compact or keyed profile)
+        sink: str
+            where the data goes: "postgres", "parquet" (no db at all), "both", or
+            "duckdb" (a single-file DuckDB database, no server needed)
+        parquet_dir: str
+            folder for the Parquet datasets when sink is "parquet" or "both"
+        duckdb_path: str
+            the .duckdb file when sink is "duckdb" (defaults to {db_name}.duckdb)
+        lodes_url: str
+            where the LODES folders live. point it at a mirror or the benchmark server
+        region_only: bool
+            only keep rows that touch the region: od rows with the home or work block
+            in it, and wac/rac rows for its blocks. xwalk is always loaded whole
+        commit_every: int
+            files each COPY connection loads per transaction. every file still gets a
+            savepoint, so a bad one is rolled back without losing the rest of its batch
+        gzip_backend: str
+            what inflates files on their way to COPY: "auto" (the fastest installed),
+            or one of stream.GZIP_BACKENDS (isal, zlib-ng, igzip, pigz, zlib, gzip)
+        parse_engine: str
+            how rows get to COPY: "text" slices each line and appends the constants,
+            "arrow" parses and validates files in typed pyarrow batches (see
+            batches.ArrowCopy) and, with sink "both", writes the Parquet from the same
+            batches instead of reading the file a second time
+        listings: Listings
+            LEHD directory listings to plan the load from: files that aren't listed
+            are skipped instead of requested, and the biggest files go first (see plan)
     """
 
     def __init__(
@@ -50,24 +116,99 @@ class PayLode:
         counties: list,
         pick_or_all: str = "pick",
         schema: str = "public",
+        jobs: int = 1,
+        download_jobs: int = None,
+        setup: bool = True,
+        load: bool = True,
+        cache=None,
+        tables: list = None,
+        region: list = None,
+        partition: bool = False,
+        profile: str = "standard",
+        copy_format: str = "csv",
+        sink: str = "postgres",
+        parquet_dir: str = None,
+        duckdb_path: str = None,
+        lodes_url: str = LODES_URL,
+        region_only: bool = False,
+        commit_every: int = 1,
+        downloader=None,
+        gzip_backend: str = "auto",
+        parse_engine: str = "text",
+        listings=None,
     ) -> None:
         self.create_db = create_db
         self.schema = schema
         self.state = state
         self.lode_no = lode_no
         self.db_name = db_name
-        self.base_url = f"https://lehd.ces.census.gov/data/lodes/{self.lode_no.upper()}/{self.state}/"
+        self.base_url = f"{lodes_url.rstrip('/')}/{self.lode_no.upper()}/{self.state}/"
         self.pick_or_all = pick_or_all
-        self.year = year
+        self.years = sorted({int(y) for y in year}) if isinstance(year, (list, tuple)) else [int(year)]
         self.job_types, self.workforce_types = self.__pick_tables()
         self.counties = counties
-        self.__create_db()
-        self.__create_tables()
-        self.__populate_tables("od_main")
-        self.__populate_tables("od_aux")
-        self.__populate_tables("wac")
-        self.__populate_tables("rac")
-        self.__populate_tables("xwalk")
+        self.jobs = jobs
+        self.download_jobs = download_jobs or jobs
+        self.cache = cache
+        self.downloader = downloader
+        self.tables = tables or ["xwalk", "od_main", "od_aux", "wac", "rac"]
+        self.region = region
+        self.partition = partition
+        if profile not in table_profiles:
+            raise Exception(f"profile must be one of {list(table_profiles)}")
+        self.profile = profile
+        self.copy_format = copy_format
+        self.region_only = region_only
+        self.commit_every = max(commit_every, 1)
+        self.gzip_backend = pick_gzip_backend(gzip_backend)
+        if parse_engine not in ["text", "arrow"]:
+            raise Exception('parse_engine must be "text" or "arrow"')
+        if parse_engine == "arrow":
+            try:
+                import pyarrow  # noqa: F401
+            except ImportError:
+                raise ImportError("the arrow parse engine needs pyarrow: pip install pyarrow")
+        self.parse_engine = parse_engine
+        self.listings = listings
+        self.unlisted = []  # LoadTasks the last plan() left out, as they aren't in the listings
+        self.loaded = []  # LoadTasks actually (re)loaded by this run
+        self.batches = {}  # id(cursor): LoadTasks copied since that connection last committed
+        self.batch_failures = []  # (LoadTask, exception) for batches whose COMMIT failed
+        if sink not in ["postgres", "parquet", "both", "duckdb"]:
+            raise Exception("sink must be postgres, parquet, both, or duckdb")
+        self.postgres = sink in ["postgres", "both"]
+        self.parquet = ParquetSink(parquet_dir) if sink in ["parquet", "both"] else None
+        self.duckdb = None
+        if sink == "duckdb":
+            self.duckdb = DuckDBSink(duckdb_path or f"{db_name}.duckdb", schema, profile)
+        if setup and self.postgres:
+            self.__create_db()
+            self.__create_tables()
+            if self.partition:
+                self.__create_year_partitions()
+        if setup and self.duckdb is not None:
+            self.duckdb.create_tables()
+        try:
+            if load:
+                if self.partition and self.postgres:
+                    self.__create_partitions()
+                # xwalk goes first so dvrpc_reg can be set as the other tables are copied in
+                if "xwalk" in self.tables:
+                    self.__populate_tables(["xwalk"])
+                others = [table for table in self.tables if table != "xwalk"]
+                if others:
+                    if self.region is None and self.postgres:
+                        self.region = region_fips(self.db_name, self.counties, self.schema)
+                    elif self.region is None and self.duckdb is not None:
+                        self.region = self.duckdb.region(self.counties)
+                    elif self.region is None:
+                        self.region = self.parquet.region(self.counties)
+                    self.__populate_tables(others)
+        finally:
+            if self.duckdb is not None:
+                # a duckdb file has one writer, let the next state (or step) open it,
+                # even after a failed load
+                self.duckdb.close()
 
     def __create_db(self):
         """Create the DB."""
@@ -130,157 +271,633 @@ class PayLode:
         if self.schema != "public":
             cursor.execute(f"create schema if not exists {self.schema}")
 
+        partition_by = "partition by list (year)" if self.partition else ""
+        if self.partition:
+            self.__check_partitioned(cursor)
+        ddl = table_profiles[self.profile]
+
         q1 = f"""
-            create table if not exists {self.schema}.combined_od ({od_table});
+            create table if not exists {self.schema}.combined_od ({ddl["od"]}) {partition_by};
         """
 
         q2 = f"""
-            create table if not exists {self.schema}.combined_wac ({wac_table});
+            create table if not exists {self.schema}.combined_wac ({ddl["wac"]}) {partition_by};
         """
 
         q3 = f"""
-            create table if not exists {self.schema}.combined_rac ({rac_table});
+            create table if not exists {self.schema}.combined_rac ({ddl["rac"]}) {partition_by};
         """
         q4 = f"""
-            create table if not exists {self.schema}.xwalk ({xwalk});
+            create table if not exists {self.schema}.xwalk ({ddl["xwalk"]});
+        """
+        q6 = f"""
+            create table if not exists {self.schema}.load_manifest ({manifest_table});
+        """
+
+        # od tables made before the home/work flags existed
+        q5 = f"""
+            alter table {self.schema}.combined_od
+                add column if not exists home_reg bool,
+                add column if not exists work_reg bool;
+        """
+        # manifests made before the region-only filter existed
+        q7 = f"""
+            alter table {self.schema}.load_manifest
+                add column if not exists dropped_rows bigint,
+                add column if not exists row_filter text;
         """
 
-        for value in [q1, q2, q3, q4]:
+        for value in [q1, q2, q3, q4, q5, q6, q7]:
             cursor.execute(value)
+        self.__add_year(cursor)
+        create_geocode_views(cursor, self.schema)
         cursor.close()
         conn.close()
 
-    def __populate_tables(self, table: str):
-        """Populates the created tables with data. Prints any bad URLS (usually just places w/out data)"""
+    def __add_year(self, cursor):
+        """Adds the year column to combined tables made before multi-year loading.
 
-        errors = []  # save any faulty urls here
+        Their rows all come from the one year in load_manifest, so that's given as
+        the column's default while it's added: Postgres stores it once instead of
+        rewriting the table, and every existing row reads it."""
+        cursor.execute(
+            f"""
+            SELECT DISTINCT year FROM {self.schema}.load_manifest
+            WHERE scope <> 'xwalk' AND status = 'loaded'
+            """
+        )
+        years = [row[0] for row in cursor.fetchall()]
+        for table in ["combined_od", "combined_wac", "combined_rac"]:
+            if has_column(cursor, self.schema, table, "year"):
+                continue
+            if len(years) > 1:
+                raise Exception(
+                    f"{self.schema}.{table} has no year column but load_manifest has {years}, add it by hand"
+                )
+            print(f"adding a year column to {self.schema}.{table}...")
+            default = f"default {years[0]}" if years else ""
+            cursor.execute(f"alter table {self.schema}.{table} add column year smallint {default}")
+            cursor.execute(f"alter table {self.schema}.{table} alter column year drop default")
+
+    def __check_partitioned(self, cursor):
+        """Stops early if combined tables already exist without partitioning"""
+        cursor.execute(
+            f"""
+            select c.relname from pg_class c
+            join pg_namespace n on n.oid = c.relnamespace
+            where n.nspname = %(schema)s
+            and c.relname in ('combined_od', 'combined_wac', 'combined_rac')
+            and c.relkind <> 'p'
+            """,
+            {"schema": self.schema},
+        )
+        plain = [row[0] for row in cursor.fetchall()]
+        if plain:
+            raise Exception(
+                f"{plain} already exist in {self.schema} as regular tables. drop them or use a new schema to partition"
+            )
 
-        def handle_sql_insert(value):
-            last_part = value.split("/")[-1].replace(".csv.gz", "")
-            job_type, segment = self.__derive_type_and_seg(last_part)
+    def __state_first(self, cursor, table: str):
+        """True if combined_{table} was partitioned before multi-year loading, with
+        state at the top instead of year"""
+        cursor.execute(
+            "select pg_get_partkeydef(to_regclass(%s))", (f"{self.schema}.combined_{table}",)
+        )
+        return (cursor.fetchone()[0] or "").lower() == "list (state)"
 
-            if table in ["rac", "wac"]:
-                return f"""
-                    INSERT INTO {self.schema}.combined_{table}
-                    SELECT *, '{self.state}', '{job_type}', '{segment}' FROM temp_table;
-                """
-            elif table in ["od_main", "od_aux"]:
-                return f"""
-                    INSERT INTO {self.schema}.combined_od
-                    SELECT *, '{job_type}', '{self.state}', 'false', '{table}' FROM temp_table;
-                """
-            elif table in ["xwalk"]:
-                return f"""
-                INSERT INTO {self.schema}.{table}
-                SELECT * from temp_table;
-                """
-            else:
-                return None
-
-        if table == "od_main" or table == "od_aux":
-            temp_table = od_temp_table
-        elif table == "rac":
-            temp_table = rac_temp_table
-        elif table == "wac":
-            temp_table = wac_temp_table
-        elif table == "xwalk":
-            temp_table = xwalk_temp_table
-        else:
-            raise Exception("table must be od_main, od_aux, rac, or wac")
+    def __create_year_partitions(self):
+        """Creates each year's partition of the combined tables, partitioned by state.
 
-        urls = self.__create_urls(f"{table}")
+        This runs once, with the tables, rather than in every state's load: with
+        --parallel-states the states would all create the same year partitions at
+        once, and IF NOT EXISTS doesn't stop concurrent CREATE TABLEs from colliding."""
         cursor, conn = db_connect(self.db_name, self.schema)
+        for table in ["od", "wac", "rac"]:
+            if self.__state_first(cursor, table):
+                continue
+            for year in self.years:
+                cursor.execute(
+                    f"""
+                    create table if not exists {self.schema}.combined_{table}_{year}
+                    partition of {self.schema}.combined_{table}
+                    for values in ({year}) partition by list (state);
+                    """
+                )
+        cursor.close()
+        conn.close()
 
-        # Check if the dictionary is nested
-        if isinstance(urls, dict) and isinstance(next(iter(urls.values())), dict):
-            iter_keys = urls.items()
-        else:
-            iter_keys = [
-                (None, value) for value in urls.values()
-            ]  # For flat dictionaries
-
-        for outer_key, inner_dict in iter_keys:
-            if outer_key is not None:  # For nested dictionaries
-                inner_loop = inner_dict.items()
-            else:  # For flat dictionaries
-                inner_loop = [(None, inner_dict)]
-
-            for inner_key, value in inner_loop:
-                print(f"processing the {self.state} csv from {value}...")
-                sql_insert = handle_sql_insert(value)
-                if sql_insert:
-                    r = requests.get(value)
-                    if r.status_code == 200:
-                        compressed_file = BytesIO(r.content)
-                        decompressed_file = gzip.GzipFile(fileobj=compressed_file)
-                        reader = csv.reader(TextIOWrapper(decompressed_file, "utf-8"))
-
-                        next(reader, None)  # Skip header
-
-                        cursor.execute(
-                            f"""
-                            CREATE TEMP TABLE temp_table AS
-                            {temp_table}
-                        """
-                        )
-
-                        buffer = StringIO()
-                        for row in reader:
-                            buffer.write("\t".join(row) + "\n")
-
-                        buffer.seek(0)
-
-                        sql_copy = """
-                            COPY temp_table FROM stdin WITH DELIMITER '\t'
-                        """
-                        cursor.copy_expert(sql=sql_copy, file=buffer)
-
-                        cursor.execute(sql_insert)
-
-                        cursor.execute("DROP TABLE temp_table;")
+    def __create_partitions(self):
+        """Creates this state's partitions for each year, under the year partitions
+        made at setup: state, then job_type (rac/wac) or scope (od), e.g.
+        combined_wac_2021_pa_jt00.
 
-                    else:
-                        errors.append(value)
+        Tables partitioned before multi-year loading have state at the top instead;
+        they keep that layout (combined_wac_pa_jt00), with every year in each leaf.
 
+        Indexes built on the combined tables are created on every partition, so each
+        leaf gets its own small indexes and queries on year/state/job_type/scope are pruned."""
+        cursor, conn = db_connect(self.db_name, self.schema)
+        sub_partitions = {
+            "od": ("scope", ["od_main", "od_aux"]),
+            "wac": ("job_type", list(self.job_types)),
+            "rac": ("job_type", list(self.job_types)),
+        }
+        for table, (column, values) in sub_partitions.items():
+            if self.__state_first(cursor, table):
+                parents = [(f"combined_{table}", f"combined_{table}_{self.state}")]
+            else:
+                parents = [
+                    (f"combined_{table}_{year}", f"combined_{table}_{year}_{self.state}")
+                    for year in self.years
+                ]
+            for grandparent, parent in parents:
+                self.__create_state_partition(cursor, grandparent, parent, column, values)
         cursor.close()
-        conn.commit()
         conn.close()
-        if len(errors) == 0:
-            print(f"all {table} tables imported successfully!")
-        elif len(errors) > 0:
-            print(f"the following URLS might not exist: {errors}")
-            for error in errors:
-                error = error.split("_")
-                job = error[3]
-                seg = error[2]
-                print(
-                    f"there may be no '{job_types[job]}' in the '{workforce_types[seg]}' segment"
-                )
-            print(
-                "you can check to see if the tables actually exist at the endpoints below:"
+
+    def __create_state_partition(self, cursor, grandparent: str, parent: str, column: str, values: list):
+        """Creates one state's partition of grandparent, and its job_type/scope leaves"""
+        cursor.execute(
+            f"""
+            create table if not exists {self.schema}.{parent}
+            partition of {self.schema}.{grandparent}
+            for values in ('{self.state}') partition by list ({column});
+            """
+        )
+        for value in values:
+            cursor.execute(
+                f"""
+                create table if not exists {self.schema}.{parent}_{value.lower()}
+                partition of {self.schema}.{parent} for values in ('{value}');
+                """
             )
-            print(f"https://lehd.ces.census.gov/data/lodes/LODES8/{self.state}/od/")
-            print(f"https://lehd.ces.census.gov/data/lodes/LODES8/{self.state}/rac/")
-            print(f"https://lehd.ces.census.gov/data/lodes/LODES8/{self.state}/wac/")
-            print(f"the rest of the {table} tables were imported successfully.")
 
-    def handle_sql_insert(self, value, table, derive_type_and_seg_func, state):
-        """Paramaterized queries to insert data into table"""
-        last_part = value.split("/")[-1].replace(".csv.gz", "")
-        job_type, segment = derive_type_and_seg_func(last_part)
+    def __stamp(self, task: LoadTask, source, parquet=None):
+        """Wraps a decompressed file so each row carries its per-file constants.
+
+        Returns the stamped stream and the table columns its rows fill, in order.
+        The regional flags are worked out here from the county FIPS prefix of each
+        geocode, so local_flag doesn't have to rewrite the tables afterwards. With
+        the arrow engine, parquet (a ParquetFile) gets the same batches."""
+        table, columns = target_tables[task.table]
+        region = self.region or []
+        if task.table in ["rac", "wac"]:
+            constants = {
+                "state": self.state,
+                "job_type": task.job_type,
+                "segment": task.segment,
+                "year": task.year,
+            }
+        elif task.table in ["od_main", "od_aux"]:
+            constants = {
+                "job_type": task.job_type,
+                "state": self.state,
+                "scope": task.table,
+                "year": task.year,
+            }
+        else:
+            constants = {}
+
+        if self.parse_engine == "arrow":
+            stamped = ArrowCopy(
+                source,
+                task.table,
+                constants,
+                region,
+                self.region_only,
+                url=task.url,
+                on_batch=parquet.write if parquet is not None else None,
+            )
+            return stamped, stamped.columns
+        if task.table in ["rac", "wac"]:
+            stamped = StampedCsv(
+                source, list(constants.values()), [0], region, region_only=self.region_only
+            )
+            extra = list(constants) + ["dvrpc_reg"]
+        elif task.table in ["od_main", "od_aux"]:
+            # h_geocode is the second field, w_geocode the first
+            stamped = StampedCsv(
+                source,
+                list(constants.values()),
+                [1, 0],
+                region,
+                True,
+                region_only=self.region_only,
+            )
+            extra = list(constants) + ["home_reg", "work_reg", "dvrpc_reg"]
+        else:
+            stamped = StampedCsv(source)
+            extra = []
+        return stamped, columns + extra
 
-        if table in ["rac", "wac"]:
+    def __column_types(self, cursor, table: str, columns: list):
+        """Returns the data_type of each column, for encoding binary COPY rows"""
+        cursor.execute(
+            """
+            select column_name, data_type from information_schema.columns
+            where table_schema = %(schema)s and table_name = %(table)s
+            """,
+            {"schema": self.schema, "table": table},
+        )
+        types = dict(cursor.fetchall())
+        return [types[column] for column in columns]
+
+    def __sql_delete(self, task: LoadTask):
+        """Removes the rows a previous load of this file put in its combined table"""
+        if task.table in ["rac", "wac"]:
             return f"""
-                INSERT INTO {self.schema}.combined_{table}
-                SELECT *, '{state}', '{job_type}', '{segment}' FROM temp_table;
+                DELETE FROM {self.schema}.combined_{task.table}
+                WHERE state = '{self.state}' AND job_type = '{task.job_type}' AND segment = '{task.segment}'
+                AND year = {task.year};
             """
-        elif table in ["od_main", "od_aux"]:
+        elif task.table in ["od_main", "od_aux"]:
             return f"""
-                INSERT INTO {self.schema}.combined_od
-                SELECT *, '{job_type}', '{state}', 'false', '{table}' FROM temp_table;
+                DELETE FROM {self.schema}.combined_od
+                WHERE state = '{self.state}' AND job_type = '{task.job_type}' AND scope = '{task.table}'
+                AND year = {task.year};
             """
         else:
+            return f"""
+                DELETE FROM {self.schema}.xwalk WHERE st_usps = '{self.state.upper()}';
+            """
+
+    def __row_filter(self, task: LoadTask):
+        """Describes the rows this run keeps from a file, to store in load_manifest.
+        None means every row; a file loaded under a different filter is reloaded."""
+        if not self.region_only or task.table == "xwalk":
             return None
+        return "region:" + ",".join(sorted(self.region or []))
+
+    def __is_current(self, task: LoadTask, previous: dict):
+        """True if a manifest row says the file is loaded, with this run's filter"""
+        return (
+            previous is not None
+            and previous["status"] == "loaded"
+            and previous["row_filter"] == self.__row_filter(task)
+        )
+
+    def __record(
+        self,
+        cursor,
+        task: LoadTask,
+        status: str,
+        row_count: int = None,
+        dropped_rows: int = None,
+    ):
+        """Upserts a file's row in load_manifest"""
+        cursor.execute(
+            f"""
+            INSERT INTO {self.schema}.load_manifest
+            VALUES (%(url)s, %(state)s, %(year)s, %(job_type)s, %(segment)s, %(scope)s,
+                %(bytes)s, %(row_count)s, %(checksum)s, %(etag)s, %(last_modified)s,
+                %(status)s, now(), %(dropped_rows)s, %(row_filter)s)
+            ON CONFLICT (url) DO UPDATE SET
+                bytes = excluded.bytes,
+                row_count = excluded.row_count,
+                checksum = excluded.checksum,
+                etag = excluded.etag,
+                last_modified = excluded.last_modified,
+                status = excluded.status,
+                loaded_at = excluded.loaded_at,
+                dropped_rows = excluded.dropped_rows,
+                row_filter = excluded.row_filter;
+            """,
+            {
+                "url": task.url,
+                "state": self.state,
+                "year": task.year,
+                "job_type": task.job_type,
+                "segment": task.segment,
+                "scope": task.table,
+                "bytes": task.bytes,
+                "row_count": row_count,
+                "checksum": task.checksum,
+                "etag": task.etag,
+                "last_modified": task.last_modified,
+                "status": status,
+                "dropped_rows": dropped_rows,
+                "row_filter": self.__row_filter(task),
+            },
+        )
+
+    def __load_file(self, cursor, task: LoadTask, fileobj):
+        """Sends one downloaded .csv.gz to Postgres and/or Parquet.
+
+        With both sinks the file is read twice (once, with the arrow engine);
+        downloads are spooled or cached files, so it can be rewound."""
+        if self.duckdb is not None:
+            columns = target_tables[task.table][1]
+            row_filter = self.__row_filter(task)
+            if self.duckdb.write(task, self.state, fileobj, self.region, columns, row_filter):
+                self.loaded.append(task)
+            return
+        tee = None
+        if self.parse_engine == "arrow" and self.postgres and self.parquet is not None:
+            # write the Parquet from the batches COPY parses, instead of parsing again
+            tee = self.parquet.open(task, self.state)
+        try:
+            copied = self.postgres and self.__copy_file(cursor, task, fileobj, tee)
+        except BaseException:
+            if tee is not None:
+                tee.abort()
+            raise
+        if tee is not None:
+            if copied:
+                tee.commit()
+                # its time is part of the copy event's
+                metrics.record(
+                    "parquet",
+                    url=task.url,
+                    table=task.table,
+                    state=self.state,
+                    year=task.year,
+                    rows=tee.rows,
+                    seconds=None,
+                )
+                return
+            tee.abort()
+        if self.parquet is not None and (copied or not self.parquet.exists(task, self.state)):
+            print(f"writing the {self.state} parquet for {task.url}...")
+            fileobj.seek(0)
+            start = time.perf_counter()
+            rows = self.parquet.write(
+                task, self.state, fileobj, self.region, self.__row_filter(task) is not None
+            )
+            metrics.record(
+                "parquet",
+                url=task.url,
+                table=task.table,
+                state=self.state,
+                year=task.year,
+                rows=rows,
+                seconds=round(time.perf_counter() - start, 3),
+            )
+            if not self.postgres:
+                self.loaded.append(task)
+
+    def __copy_file(self, cursor, task: LoadTask, fileobj, parquet=None):
+        """COPYs one downloaded .csv.gz straight into its combined table.
+
+        Each file loads under its own savepoint together with its load_manifest row,
+        so a file is either fully loaded and recorded or not there at all. The
+        transaction is committed every commit_every files on this connection. Files
+        already loaded with the same checksum are skipped, and changed ones have
+        their old rows deleted first. Returns False if the file was skipped."""
+        previous = self.manifest.get(task.url)
+        if self.__is_current(task, previous) and previous["checksum"] == task.checksum:
+            print(f"skipping {task.url}, already loaded and unchanged")
+            return False
+
+        print(f"processing the {self.state} csv from {task.url}...")
+        start = time.perf_counter()
+        batch = self.batches.setdefault(id(cursor), [])
+        if not batch:
+            cursor.execute("BEGIN;")
+        cursor.execute("SAVEPOINT file;")
+        try:
+            # a failed reload can leave a row marked failed over the old file's rows,
+            # so whatever its status, a manifest row means there may be rows to delete
+            if previous is not None:
+                cursor.execute(self.__sql_delete(task))
+            # inflate the file (a few blocks ahead, on another thread or process) and
+            # stamp its rows as COPY reads them, nothing is buffered whole
+            table = target_tables[task.table][0]
+            source = open_gzip(iter(lambda: fileobj.read(CHUNK_SIZE), b""), self.gzip_backend)
+            stamped, columns = self.__stamp(task, source, parquet)
+            stream = stamped
+            if self.copy_format == "binary":
+                types = self.__column_types(cursor, table, columns)
+                if self.parse_engine == "arrow":
+                    stamped.binary(types)
+                else:
+                    stream = BinaryCopy(stamped, types)
+                options = "FORMAT binary"
+            else:
+                options = "FORMAT csv, HEADER"
+            sql_copy = f"""
+                COPY {self.schema}.{table} ({", ".join(columns)}) FROM stdin WITH ({options})
+            """
+            copy_start = time.perf_counter()
+            try:
+                cursor.copy_expert(sql=sql_copy, file=stream, size=CHUNK_SIZE)
+            finally:
+                source.close()
+            copy_seconds = time.perf_counter() - copy_start
+            rows = cursor.rowcount
+            if self.region_only and task.table != "xwalk":
+                print(
+                    f"dropped {stamped.dropped:,} of {rows + stamped.dropped:,} rows outside the region from {task.url}"
+                )
+
+            self.__record(cursor, task, "loaded", rows, stamped.dropped)
+            cursor.execute("RELEASE SAVEPOINT file;")
+            # the stream's time is spent in python (waiting on the inflater, stamping,
+            # encoding); the rest of the COPY is the server parsing and writing rows.
+            # inflating itself runs alongside, so decompress_seconds overlaps the others
+            metrics.record(
+                "copy",
+                url=task.url,
+                table=task.table,
+                state=self.state,
+                year=task.year,
+                format=self.copy_format,
+                rows=rows,
+                dropped_rows=stamped.dropped,
+                compressed_bytes=source.compressed_bytes,
+                decompressed_bytes=source.decompressed_bytes,
+                gzip_backend=self.gzip_backend,
+                parse_engine=self.parse_engine,
+                decompress_seconds=round(source.inflate_seconds, 3),
+                decompress_wait_seconds=round(source.seconds, 3),
+                stamp_seconds=round(stream.seconds - source.seconds, 3),
+                copy_seconds=round(copy_seconds - stream.seconds, 3),
+                seconds=round(time.perf_counter() - start, 3),
+            )
+        except Exception:
+            cursor.execute("ROLLBACK TO SAVEPOINT file;")
+            self.__record(cursor, task, "failed")
+            if not batch:
+                cursor.execute("COMMIT;")
+            raise
+        batch.append(task)
+        if len(batch) >= self.commit_every:
+            return self.__commit(cursor)
+        return True
+
+    def __commit(self, cursor):
+        """Commits the files copied on this connection since its last commit.
+        Returns False if the COMMIT failed, taking the whole batch with it"""
+        batch = self.batches.pop(id(cursor), [])
+        if not batch:
+            return True
+        start = time.perf_counter()
+        try:
+            cursor.execute("COMMIT;")
+        except Exception as e:
+            # the manifest rows went with the data, so the next run loads these again
+            self.batch_failures += [(task, e) for task in batch]
+            return False
+        metrics.record("commit", files=len(batch), seconds=round(time.perf_counter() - start, 3))
+        self.loaded += batch
+        return True
+
+    def __finish(self, cursor):
+        """Commits a COPY worker's last, partial batch"""
+        if cursor is not None:
+            self.__commit(cursor)
+
+    def __create_tasks(self, table: str):
+        """Flattens the urls for a table into LoadTasks"""
+        if table not in target_tables:
+            raise Exception("table must be od_main, od_aux, rac, wac, or xwalk")
+
+        # the xwalk is per state, not per year, so it's only fetched once
+        years = [None] if table == "xwalk" else self.years
+        tasks = []
+        for year in years:
+            urls = self.__create_urls(table, year)
+            for value in urls.values():
+                inner = value.values() if isinstance(value, dict) else [value]
+                for url in inner:
+                    last_part = url.split("/")[-1].replace(".csv.gz", "")
+                    job_type, segment = self.__derive_type_and_seg(last_part)
+                    tasks.append(LoadTask(url, table, job_type, segment, year))
+        return tasks
+
+    def plan(self, tables: list = None):
+        """Returns the LoadTasks for tables (default self.tables), in the order they'll run.
+
+        With listings, files missing from LEHD's directory listings are left out (and
+        kept in self.unlisted), each task's listed_bytes is filled in, and the biggest
+        files are scheduled first so a large one doesn't finish long after the rest.
+        Files under a listing that can't be had (offline, never cached) stay in."""
+        tasks = []
+        for table in tables or self.tables:
+            tasks += self.__create_tasks(table)
+        self.unlisted = []
+        if self.listings is None:
+            return tasks
+
+        planned = []
+        for task in tasks:
+            folder, name = task.url.rsplit("/", 1)
+            files = self.listings.files(f"{folder}/")
+            if files is None:
+                planned.append(task)
+            elif name in files:
+                task.listed_bytes = files[name]
+                planned.append(task)
+            else:
+                self.unlisted.append(task)
+        planned.sort(key=lambda task: task.listed_bytes or 0, reverse=True)
+        return planned
+
+    def __fetch(self, task: LoadTask):
+        """Gets a file from the download cache if there is one, otherwise straight from LEHD.
+
+        Without a cache, files that were loaded before are requested conditionally
+        using the ETag/Last-Modified in load_manifest, so unchanged ones aren't downloaded."""
+        if self.cache is not None:
+            fileobj = self.cache.open(task.url)
+            entry = self.cache.entry(task.url)
+            if fileobj is not None and entry is not None:
+                task.bytes = entry["bytes"]
+                task.checksum = entry["sha256"]
+                task.etag = entry["etag"]
+                task.last_modified = entry["last_modified"]
+            return fileobj
+
+        headers = {}
+        previous = self.manifest.get(task.url)
+        if self.__is_current(task, previous):
+            if previous["etag"]:
+                headers["If-None-Match"] = previous["etag"]
+            if previous["last_modified"]:
+                headers["If-Modified-Since"] = previous["last_modified"]
+        return download(task, headers, self.downloader)
+
+    def __read_manifest(self):
+        """Returns this state's load_manifest rows (for every year), keyed by url"""
+        if self.duckdb is not None:
+            return self.duckdb.manifest(self.state)
+        if not self.postgres:
+            return {}
+        cursor, conn = db_connect(self.db_name, self.schema)
+        cursor.execute(
+            f"""
+            SELECT url, status, checksum, etag, last_modified, row_filter
+            FROM {self.schema}.load_manifest
+            WHERE state = %(state)s
+            """,
+            {"state": self.state},
+        )
+        manifest = {
+            url: {
+                "status": status,
+                "checksum": checksum,
+                "etag": etag,
+                "last_modified": last_modified,
+                "row_filter": row_filter,
+            }
+            for url, status, checksum, etag, last_modified, row_filter in cursor.fetchall()
+        }
+        cursor.close()
+        conn.close()
+        return manifest
+
+    def __populate_tables(self, tables: list):
+        """Populates the created tables with data. Prints any bad URLS (usually just places w/out data)
+
+        Every file for every table in tables goes through one download/COPY pipeline,
+        so the network and the db stay busy across table boundaries."""
+
+        tasks = self.plan(tables)
+        if self.unlisted:
+            print(
+                f"skipping {len(self.unlisted)} {self.state} file(s) that aren't in the LEHD directory listings"
+            )
+        self.manifest = self.__read_manifest()
+
+        missing, failed, unchanged = run_pipeline(
+            tasks,
+            (lambda: db_connect(self.db_name, self.schema)) if self.postgres else None,
+            self.__load_file,
+            download_jobs=self.download_jobs,
+            copy_jobs=self.jobs,
+            fetch=self.__fetch,
+            finish=self.__finish,
+        )
+        failed += self.batch_failures
+        self.batch_failures = []
+
+        if unchanged:
+            print(f"{len(unchanged)} {self.state} file(s) haven't changed since they were loaded")
+
+        for table in tables:
+            errors = [task for task in missing if task.table == table]
+            if len(errors) == 0:
+                print(f"all {table} tables imported successfully!")
+            elif len(errors) > 0:
+                print(f"the following URLS might not exist: {[e.url for e in errors]}")
+                for error in errors:
+                    if error.segment in workforce_types:
+                        print(
+                            f"there may be no '{job_types[error.job_type]}' in the '{workforce_types[error.segment]}' segment"
+                        )
+                    else:
+                        print(f"there may be no '{job_types[error.job_type]}' in {table}")
+                print(
+                    "you can check to see if the tables actually exist at the endpoints below:"
+                )
+                print(f"{self.base_url}od/")
+                print(f"{self.base_url}rac/")
+                print(f"{self.base_url}wac/")
+                print(f"the rest of the {table} tables were imported successfully.")
+
+        if failed:
+            for task, e in failed:
+                print(f"failed to load {task.url}: {e}")
+            raise RuntimeError(f"{len(failed)} {self.state} file(s) failed to load")
 
     def __derive_type_and_seg(self, key):
         """Returns the Job Type or Workforce Segmentation from the URL (key)"""
@@ -298,13 +915,13 @@ class PayLode:
             except IndexError:
                 raise ValueError("Invalid URL format")
 
-    def __create_urls(self, table: str):
+    def __create_urls(self, table: str, year: int = None):
         """Builds URLS based on needed params to access csv.gz endpoints"""
         if table == "od_aux" or table == "od_main":
             table_base = self.base_url + "od/"
             urls = {}
             for key in self.job_types:
-                url = f"{self.state}_{table}_{key}_{self.year}.csv.gz"
+                url = f"{self.state}_{table}_{key}_{year}.csv.gz"
                 combined = table_base + url
                 urls[key] = combined
         elif table == "rac" or table == "wac":
@@ -313,7 +930,7 @@ class PayLode:
             for key in self.job_types:
                 urls[key] = {}
                 for key2 in self.workforce_types:
-                    url = f"{self.state}_{table}_{key2}_{key}_{self.year}.csv.gz"
+                    url = f"{self.state}_{table}_{key2}_{key}_{year}.csv.gz"
                     combined = table_base + url
                     urls[key][key2] = combined
         elif table == "xwalk":
@@ -1,6 +1,10 @@
-import psycopg2
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from .config import wac_columns, rac_columns, xwalk_columns, geocode_columns
+from .metrics import metrics
+from .pool import ConnectionPool, BULK_SETTINGS, parse_settings
 
 load_dotenv()
 
@@ -8,95 +12,690 @@ HOST = os.getenv("HOST")
 PORT = os.getenv("PORT")
 UN = os.getenv("UN")
 PW = os.getenv("PW")
+# extra session settings on top of the bulk-load ones, e.g. "work_mem=256MB,statement_timeout=0"
+PG_SETTINGS = os.getenv("PG_SETTINGS", "")
+
+
+def session_settings(extra: list = (), bulk: bool = True):
+    """The settings every pooled connection starts with: BULK_SETTINGS (unless bulk
+    is off), then PG_SETTINGS, then extra ("name=value" strings)"""
+    pairs = [pair for pair in PG_SETTINGS.split(",") if pair.strip()] + list(extra)
+    return {**(BULK_SETTINGS if bulk else {}), **parse_settings(pairs)}
+
+
+# one pool for the whole run, shared by every db_connect caller
+pool = ConnectionPool(
+    {"user": UN, "password": PW, "host": HOST, "port": PORT}, session_settings()
+)
 
 
 def db_connect(db: str = "postgres", schema: str = "public"):
-    """Boilerplate for connection params"""
-    conn = psycopg2.connect(
-        dbname=db,
-        user=UN,
-        password=PW,
-        host=HOST,
-        port=PORT,
-        options=f"-c search_path={schema}",
+    """Boilerplate for connection params.
+
+    Connections come from the run's pool, in autocommit with the bulk-load session
+    settings; conn.close() hands the connection back for the next caller."""
+    return pool.connect(db, schema)
+
+
+def build_indexes(
+    db_name: str,
+    indexes: list,
+    jobs: int = 1,
+    maintenance_work_mem: str = None,
+    parallel_workers: int = None,
+):
+    """Runs CREATE INDEX statements concurrently, each on its own connection.
+
+    Builds on the same table only take SHARE locks, so they don't block each other.
+    maintenance_work_mem and max_parallel_maintenance_workers are set per session
+    when given (mind that jobs x maintenance_work_mem has to fit in the server's RAM).
+
+    Parameters
+    ----------
+        indexes : list
+            (label, create index statement) pairs
+        jobs : int
+            how many indexes to build at once
+
+    Returns
+    -------
+        dict of label: seconds it took to build
+    """
+
+    def build(label: str, q: str):
+        cursor, conn = db_connect(db_name)
+        if maintenance_work_mem:
+            cursor.execute("set maintenance_work_mem = %s", (maintenance_work_mem,))
+        if parallel_workers is not None:
+            cursor.execute(
+                "set max_parallel_maintenance_workers = %s", (parallel_workers,)
+            )
+        print(f"building {label}...")
+        start = time.perf_counter()
+        cursor.execute(q)
+        elapsed = time.perf_counter() - start
+        print(f"built {label} in {elapsed:.1f}s")
+        metrics.record("index", target=label, seconds=round(elapsed, 3))
+        cursor.close()
+        conn.close()
+        return elapsed
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        futures = {label: executor.submit(build, label, q) for label, q in indexes}
+        return {label: future.result() for label, future in futures.items()}
+
+
+def build_index(
+    db_name: str,
+    counties: list,
+    year: int,
+    schema: str,
+    jobs: int = 1,
+    maintenance_work_mem: str = None,
+    parallel_workers: int = None,
+    kinds: list = (),
+):
+    """Build an index to speed up later queries
+
+    Besides the b-tree geocode indexes, kinds can add:
+        composite : (job_type, segment, geocode) on wac/rac and (job_type, scope, geocode)
+            on od, for the usual "one job type and segment" filter
+        brin : tiny block-range indexes on the geocodes. each file is loaded in
+            geocode order, so these work well for range scans on unpartitioned tables
+    """
+    indexes = [
+        (
+            "index for rac table",
+            f"create index if not exists rac_index on {schema}.combined_rac(h_geocode);",
+        ),
+        (
+            "index for wac table",
+            f"create index if not exists wac_index on {schema}.combined_wac(w_geocode);",
+        ),
+        (
+            "index for geography crosswalk",
+            f"create index if not exists xwalk_index on {schema}.xwalk({xwalk_columns[0]});",
+        ),
+        (
+            "home index for od table",
+            f"create index if not exists idx_home on {schema}.combined_od(h_geocode);",
+        ),
+        (
+            "work index for od table",
+            f"create index if not exists idx_work on {schema}.combined_od(w_geocode);",
+        ),
+    ]
+    if "composite" in kinds:
+        indexes += [
+            (
+                f"composite index for {table} table",
+                f"""create index if not exists {table}_type_index
+                    on {schema}.combined_{table}(job_type, {key}, {col});""",
+            )
+            for table, key, col in [
+                ("rac", "segment", "h_geocode"),
+                ("wac", "segment", "w_geocode"),
+                ("od", "scope", "w_geocode"),
+            ]
+        ]
+    if "brin" in kinds:
+        indexes += [
+            (
+                f"brin index on {table}.{col}",
+                f"""create index if not exists {table}_{col}_brin
+                    on {schema}.combined_{table} using brin({col});""",
+            )
+            for table, col in [
+                ("rac", "h_geocode"),
+                ("wac", "w_geocode"),
+                ("od", "w_geocode"),
+            ]
+        ]
+    build_indexes(db_name, indexes, jobs, maintenance_work_mem, parallel_workers)
+
+
+def refresh_where(years: list = None, states: list = None, job_types: list = None, prefix: str = ""):
+    """The filter for rows being refreshed in a rollup or od_flows table, and its
+    params. The filter is "" (refresh everything) when none of them are given."""
+    params = {
+        "years": list(years or []),
+        "states": list(states or []),
+        "job_types": list(job_types or []),
+    }
+    clauses = []
+    if years is not None:
+        clauses.append(f"{prefix}year = ANY(%(years)s)")
+    if states is not None:
+        clauses.append(f"{prefix}state = ANY(%(states)s)")
+    if job_types is not None:
+        clauses.append(f"{prefix}job_type = ANY(%(job_types)s)")
+    return (f"where {' and '.join(clauses)}" if clauses else ""), params
+
+
+def refresh_table(
+    db_name: str,
+    schema: str,
+    table: str,
+    select: str,
+    group_by: str,
+    index_columns: list,
+    years: list = None,
+    states: list = None,
+    job_types: list = None,
+):
+    """Builds or refreshes schema.table, an aggregate of select (whose combined table
+    is aliased a) grouped by group_by, in one transaction.
+
+    A table that doesn't exist yet, or predates the year column, is built in full
+    and indexed on index_columns. Otherwise only the rows for the given years,
+    states and job types are deleted and inserted again (all of them if none are
+    given). Returns the number of rows written."""
+    name = f"{schema}.{table}"
+    cursor, conn = db_connect(db_name)
+    cursor.execute("select to_regclass(%s)", (name,))
+    exists = cursor.fetchone()[0] is not None
+
+    start = time.perf_counter()
+    cursor.execute("BEGIN;")
+    if exists and not has_column(cursor, schema, table, "year"):
+        cursor.execute(f"drop table {name}")
+        exists = False
+    if not exists:
+        print(f"building {name}...")
+        cursor.execute(f"create table {name} as {select} group by {group_by}")
+        rows = cursor.rowcount
+        cursor.execute(f"create index {table}_index on {name}({', '.join(index_columns)})")
+    else:
+        print(f"refreshing {name}...")
+        where, params = refresh_where(years, states, job_types)
+        cursor.execute(f"delete from {name} {where}", params)
+        where, params = refresh_where(years, states, job_types, "a.")
+        cursor.execute(f"insert into {name} {select} {where} group by {group_by}", params)
+        rows = cursor.rowcount
+    cursor.execute("COMMIT;")
+    metrics.record(
+        "insert_select",
+        target=name,
+        rows=rows,
+        seconds=round(time.perf_counter() - start, 3),
     )
-    conn.autocommit = True
-    cursor = conn.cursor()
-    return cursor, conn
+    print(f"{name} done in {time.perf_counter() - start:.1f}s")
+    cursor.close()
+    conn.close()
+    return rows
+
+
+def region_fips(db_name: str, counties: list, schema: str):
+    """Returns the county FIPS codes for the counties list, looked up in xwalk.
+
+    A county FIPS code is the first 5 digits of every block geocode in it, so this
+    small list is all the loader needs to flag regional rows as they're copied in."""
+    cursor, conn = db_connect(db_name)
+    cursor.execute(
+        f"select distinct cty, ctyname from {schema}.xwalk where ctyname = ANY(%(counties)s)",
+        {"counties": counties},
+    )
+    rows = cursor.fetchall()
+    cursor.close()
+    conn.close()
+    found = {ctyname.strip() for _, ctyname in rows}
+    missing = [county for county in counties if county not in found]
+    if missing:
+        print(f"these counties aren't in {schema}.xwalk, so they won't be flagged: {missing}")
+    return sorted(cty.strip() for cty, _ in rows)
 
 
-def build_index(db_name: str, counties: list, year: int, schema: str):
-    """Build an index to speed up later queries"""
+def local_flag(db_name: str, year: int, counties: list, schema: str):
+    """Recomputes the regional identifier column (dvrpc_reg) for the counties
+    list passed into the class (default is dvrpc counties). For OD, the the flag
+    is set for either/both home/work blocks where the block is in self.counties,
+    and home_reg/work_reg say which end it was.
+
+    The flags are normally set as rows are loaded, so this is only a fallback
+    (e.g. after changing COUNTIES). Each table gets one UPDATE, and rows whose
+    flags are already right aren't rewritten."""
     cursor, conn = db_connect(db_name)
-    d = {"rac": "h_geocode", "wac": "w_geocode"}
-    for key, value in d.items():
-        print(f"building index for {key} table...")
-        q = f"""create index if not exists {key}_index on {schema}.combined_{key}({value});"""
+    keyed = keyed_geocodes(cursor, schema)
+    cty = "cty::int8" if keyed else "cty"
+    region = f"(select {cty} from {schema}.xwalk where ctyname = ANY(%(counties)s))"
+    for table in ["rac", "wac"]:
+        census_block_col = "h_geocode" if table == "rac" else "w_geocode"
+        county = geocode_prefix(census_block_col, 5, keyed)
+        print(f"updating dvrpc_reg column in {schema}.{table}...")
+        q = f"""update {schema}.combined_{table}
+                set dvrpc_reg = {county} in {region}
+                where dvrpc_reg is distinct from {county} in {region}
+            """
+        start = time.perf_counter()
         cursor.execute(q, {"counties": counties})
-    print("building index for geography crosswalk...")
+        metrics.record(
+            "update",
+            target=f"combined_{table}",
+            rows=cursor.rowcount,
+            seconds=round(time.perf_counter() - start, 3),
+        )
+
+    print(f"updating dvrpc_reg, home_reg and work_reg columns in {schema}.od...")
+    home = f"{geocode_prefix('h_geocode', 5, keyed)} in {region}"
+    work = f"{geocode_prefix('w_geocode', 5, keyed)} in {region}"
+    q = f"""update {schema}.combined_od
+            set home_reg = {home},
+                work_reg = {work},
+                dvrpc_reg = {home} or {work}
+            where home_reg is distinct from {home}
+               or work_reg is distinct from {work}
+               or dvrpc_reg is distinct from ({home} or {work})
+        """
+    start = time.perf_counter()
+    cursor.execute(q, {"counties": counties})
+    metrics.record(
+        "update",
+        target="combined_od",
+        rows=cursor.rowcount,
+        seconds=round(time.perf_counter() - start, 3),
+    )
+
+    cursor.close()
+    conn.close()
+
+
+def drop_partition(
+    db_name: str, schema: str, table: str, state: str, value: str = None, year: int = None
+):
+    """Detaches and drops a state's partition of a partitioned combined table, or just
+    one job_type (rac/wac) or scope (od) of it when value is given. Much cheaper than
+    a DELETE. The matching load_manifest rows are removed so the next run reloads them.
+
+    Tables partitioned by year (see PayLode) need the year: the state's partition of
+    that year is dropped, or the whole year when state is None.
+    """
+    cursor, conn = db_connect(db_name)
+    names = [f"combined_{table}"]
+    if year is not None:
+        names.append(f"{names[-1]}_{year}")
+    if state is not None:
+        names.append(f"{names[-1]}_{state}")
+    if value is not None:
+        names.append(f"{names[-1]}_{value.lower()}")
+    if len(names) < 2:
+        raise Exception("drop_partition needs a state, a year or both")
+    parent, child = names[-2:]
+    print(f"dropping partition {schema}.{child}...")
+    cursor.execute(f"alter table {schema}.{parent} detach partition {schema}.{child}")
+    cursor.execute(f"drop table {schema}.{child}")
+
+    scopes = ["od_main", "od_aux"] if table == "od" else [table]
+    q = f"""delete from {schema}.load_manifest
+            where scope = ANY(%(scopes)s)"""
+    if state is not None:
+        q += " and state = %(state)s"
+    if year is not None:
+        q += " and year = %(year)s"
+    if value is not None:
+        q += " and (job_type = %(value)s or scope = %(value)s)"
+    cursor.execute(q, {"state": state, "scopes": scopes, "value": value, "year": year})
+    cursor.close()
+    conn.close()
+
+
+def schema_exists(cursor, schema: str):
+    """True if the schema is in the db cursor is connected to"""
+    cursor.execute("select 1 from pg_namespace where nspname = %s", (schema,))
+    return cursor.fetchone() is not None
+
+
+def has_column(cursor, schema: str, table: str, column: str):
+    """True if schema.table has the column"""
+    cursor.execute(
+        """
+        select 1 from information_schema.columns
+        where table_schema = %(schema)s and table_name = %(table)s and column_name = %(column)s
+        """,
+        {"schema": schema, "table": table, "column": column},
+    )
+    return cursor.fetchone() is not None
+
+
+def keyed_geocodes(cursor, schema: str):
+    """True if schema's block geocodes are int8 (the keyed profile) rather than text"""
+    cursor.execute(
+        """
+        select data_type from information_schema.columns
+        where table_schema = %(schema)s and table_name = 'xwalk' and column_name = %(column)s
+        """,
+        {"schema": schema, "column": xwalk_columns[0]},
+    )
+    row = cursor.fetchone()
+    return row is not None and row[0] == "bigint"
+
+
+def geocode_prefix(column: str, digits: int, keyed: bool):
+    """SQL for the first digits of a block geocode column, e.g. 5 for its county.
+
+    Text geocodes are sliced. int8 ones are divided down to the prefix, which stays
+    an integer (cheap to compare, group and join on) but loses a leading zero."""
+    if not keyed:
+        return f"left({column}, {digits})"
+    return f"({column} / {10 ** (15 - digits)})"
+
+
+def geocode_text(expression: str, digits: int, keyed: bool):
+    """A geocode (or geocode_prefix) expression as zero-padded text"""
+    if not keyed:
+        return expression
+    return f"lpad({expression}::text, {digits}, '0')"
+
+
+def create_geocode_views(cursor, schema: str):
+    """Creates a {table}_text view over each table whose geocodes are int8, with the
+    geocodes as the char(15) text they'd be in the other profiles, so queries and
+    tools written against those keep working. Tables with text geocodes get none."""
     cursor.execute(
-        f"""create index if not exists xwalk_index on {schema}.xwalk(tabblk{year})"""
+        """
+        select table_name, column_name, data_type from information_schema.columns
+        where table_schema = %(schema)s
+        and table_name in ('combined_od', 'combined_wac', 'combined_rac', 'xwalk')
+        order by table_name, ordinal_position
+        """,
+        {"schema": schema},
     )
-    print("building index for od table...")
+    tables = {}
+    for table, column, data_type in cursor.fetchall():
+        tables.setdefault(table, []).append((column, data_type))
+    for table, columns in tables.items():
+        if not any(c in geocode_columns and t == "bigint" for c, t in columns):
+            continue
+        select = ", ".join(
+            f"{geocode_text(c, 15, True)}::char(15) as {c}"
+            if c in geocode_columns and t == "bigint"
+            else c
+            for c, t in columns
+        )
+        cursor.execute(
+            f"create or replace view {schema}.{table}_text as select {select} from {schema}.{table}"
+        )
+
+
+def copy_grants(cursor, source: str, target: str):
+    """Repeats the grants on schema source and its tables on target, so readers keep
+    their access after a swap. Tables missing from target are skipped."""
     cursor.execute(
-        f"create index if not exists idx_home on {schema}.combined_od(h_geocode);"
+        """
+        select case when a.grantee = 0 then 'public' else a.grantee::regrole::text end,
+               a.privilege_type
+        from pg_namespace n, aclexplode(n.nspacl) a
+        where n.nspname = %(schema)s and a.grantee <> n.nspowner
+        """,
+        {"schema": source},
     )
+    for grantee, privilege in cursor.fetchall():
+        cursor.execute(f"grant {privilege} on schema {target} to {grantee}")
     cursor.execute(
-        f"create index if not exists idx_work on {schema}.combined_od(w_geocode);"
+        """
+        select c.relname,
+               case when a.grantee = 0 then 'public' else a.grantee::regrole::text end,
+               a.privilege_type
+        from pg_class c
+        join pg_namespace n on n.oid = c.relnamespace, aclexplode(c.relacl) a
+        where n.nspname = %(schema)s and a.grantee <> c.relowner
+        and to_regclass(%(target)s || '.' || c.relname) is not null
+        """,
+        {"schema": source, "target": target},
     )
+    for table, grantee, privilege in cursor.fetchall():
+        cursor.execute(f"grant {privilege} on {target}.{table} to {grantee}")
+
+
+def swap_schema(db_name: str, schema: str, shadow: str):
+    """Makes shadow the live schema: schema is renamed {schema}_previous and shadow
+    takes its name, in one short transaction, so readers see either the old data or
+    the new and never a half loaded table. Grants on the live schema and its tables
+    are copied over first. An older {schema}_previous is dropped in the same
+    transaction, so it's still there to swap back to if the swap fails."""
+    previous = f"{schema}_previous"
+    cursor, conn = db_connect(db_name)
+    if not schema_exists(cursor, shadow):
+        cursor.close()
+        conn.close()
+        raise Exception(f"there's no {shadow} schema to swap in")
+    live = schema_exists(cursor, schema)
+    print(f"swapping {shadow} in as {schema}...")
+    start = time.perf_counter()
+    cursor.execute("BEGIN;")
+    try:
+        # don't queue up behind a long query and block every reader behind us
+        cursor.execute("set local lock_timeout = '10s'")
+        if live:
+            cursor.execute(f"drop schema if exists {previous} cascade")
+            copy_grants(cursor, schema, shadow)
+            cursor.execute(f"alter schema {schema} rename to {previous}")
+        cursor.execute(f"alter schema {shadow} rename to {schema}")
+        cursor.execute("COMMIT;")
+    except Exception:
+        cursor.execute("ROLLBACK;")
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+    elapsed = time.perf_counter() - start
+    print(f"{schema} is live, the old version is kept as {previous} ({elapsed:.2f}s)")
+    metrics.record("swap", target=schema, seconds=round(elapsed, 3))
+
+
+def swap_back(db_name: str, schema: str):
+    """Rolls a swap back: {schema}_previous becomes live again and the newer data
+    becomes {schema}_previous, so running it twice undoes it."""
+    previous = f"{schema}_previous"
+    swapping = f"{schema}_swapping"
+    cursor, conn = db_connect(db_name)
+    if not schema_exists(cursor, previous):
+        cursor.close()
+        conn.close()
+        raise Exception(f"there's no {previous} schema to roll back to")
+    cursor.execute("BEGIN;")
+    try:
+        cursor.execute("set local lock_timeout = '10s'")
+        cursor.execute(f"alter schema {schema} rename to {swapping}")
+        cursor.execute(f"alter schema {previous} rename to {schema}")
+        cursor.execute(f"alter schema {swapping} rename to {previous}")
+        cursor.execute("COMMIT;")
+    except Exception:
+        cursor.execute("ROLLBACK;")
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+    print(f"rolled {schema} back, the newer version is now {previous}")
+
+
+def build_regional_index(
+    db_name: str,
+    schema: str,
+    jobs: int = 1,
+    maintenance_work_mem: str = None,
+    parallel_workers: int = None,
+    kinds: list = (),
+):
+    """Build an index to speed up later queries
+
+    With "partial" in kinds, also builds geocode indexes covering only the regional
+    rows (where dvrpc_reg), which are much smaller than the full geocode indexes."""
+    indexes = [
+        (
+            f"regional index for {table} table",
+            f"""create index if not exists regional_{table}_index on {schema}.combined_{table}(dvrpc_reg);""",
+        )
+        for table in ["rac", "wac", "od"]
+    ]
+    if "partial" in kinds:
+        indexes += [
+            (
+                f"partial regional index on {table}.{col}",
+                f"""create index if not exists regional_{table}_{col} on {schema}.combined_{table}({col})
+                    where dvrpc_reg;""",
+            )
+            for table, col in [
+                ("rac", "h_geocode"),
+                ("wac", "w_geocode"),
+                ("od", "h_geocode"),
+                ("od", "w_geocode"),
+            ]
+        ]
+    build_indexes(db_name, indexes, jobs, maintenance_work_mem, parallel_workers)
+
+
+def statement_stats(db_name: str, schema: str, limit: int = 20):
+    """Server-side timings of the slowest statements that touched schema, from
+    pg_stat_statements. Returns [] if that extension isn't installed in the db."""
+    cursor, conn = db_connect(db_name)
+    cursor.execute("select 1 from pg_extension where extname = 'pg_stat_statements'")
+    if cursor.fetchone() is None:
+        cursor.close()
+        conn.close()
+        return []
+    cursor.execute(
+        """
+        select query, calls, total_exec_time, rows
+        from pg_stat_statements
+        where query ilike %(pattern)s
+        order by total_exec_time desc
+        limit %(limit)s
+        """,
+        {"pattern": f"%{schema}.%", "limit": limit},
+    )
+    stats = [
+        {"query": " ".join(query.split())[:200], "calls": calls, "ms": round(ms, 1), "rows": rows}
+        for query, calls, ms, rows in cursor.fetchall()
+    ]
     cursor.close()
     conn.close()
+    return stats
 
 
-def local_flag(db_name: str, year: int, counties: list, schema: str):
-    """Sets the regional identifies column (dvrpc_reg) to true for the counties
-    list passed into the class (default is dvrpc counties). For OD, the the flag
-    is set for either/both home/work blocks where the block is in self.counties."""
+def table_sizes(db_name: str, schema: str):
+    """Returns {table: (heap bytes, index bytes, total bytes)} for the loder tables,
+    counting every partition of a partitioned table."""
     cursor, conn = db_connect(db_name)
-    tables = ["rac", "wac", "od"]
-    cols = ["w_geocode", "h_geocode"]
-    for table in tables:
-        init_q = f"update {schema}.combined_{table} SET dvrpc_reg = false"
-        cursor.execute(init_q)
-        if table == "rac" or table == "wac":
-            census_block_col = cols[1] if table == "rac" else cols[0]
-            q = f"""update {schema}.combined_{table}
-                    set dvrpc_reg = case
-                      when {schema}.xwalk.ctyname = ANY(%(counties)s) then true
-                      else false
-                    end
-                    from {schema}.xwalk
-                    where {schema}.combined_{table}.{census_block_col} = xwalk.tabblk{year}
-                    and xwalk.ctyname = ANY(%(counties)s)
-                """
-            print(f"updating dvrpc_reg column in {schema}.{table}...")
-            cursor.execute(q, {"counties": counties})
-
-        elif table == "od":
-            for col in cols:
-                print(f"updating dvrpc_reg column in {table} for column {col}...")
-                q = f"""update {schema}.combined_{table}
-                        set dvrpc_reg = case
-                          when {schema}.xwalk.ctyname = ANY(%(counties)s) then true
-                          else false
-                        end                
-                        from {schema}.xwalk
-                        where {schema}.combined_{table}.{col} = {schema}.xwalk.tabblk{year}
-                        and xwalk.ctyname = ANY(%(counties)s)
-                    """
-                cursor.execute(q, {"counties": counties})
-
+    sizes = {}
+    for table in ["combined_od", "combined_wac", "combined_rac", "xwalk"]:
+        cursor.execute(
+            """
+            select coalesce(sum(pg_relation_size(relid)), 0),
+                   coalesce(sum(pg_indexes_size(relid)), 0),
+                   coalesce(sum(pg_total_relation_size(relid)), 0)
+            from pg_partition_tree(to_regclass(%(table)s))
+            """,
+            {"table": f"{schema}.{table}"},
+        )
+        sizes[table] = tuple(int(value) for value in cursor.fetchone())
     cursor.close()
     conn.close()
+    return sizes
+
+
+def print_sizes(before: dict, after: dict):
+    """Prints a before/after size table from two table_sizes() results"""
+    mb = 1024**2
+    print(f"{'table':<14}{'heap MB':>20}{'index MB':>20}{'total MB':>20}")
+    for table in before:
+        cells = [
+            f"{before[table][i] / mb:,.0f} -> {after[table][i] / mb:,.0f}"
+            for i in range(3)
+        ]
+        print(f"{table:<14}" + "".join(f"{cell:>20}" for cell in cells))
 
 
-def build_regional_index(db_name: str, schema: str):
-    """Build an index to speed up later queries"""
+def migrate_to_compact(db_name: str, schema: str):
+    """Converts existing tables to the compact profile's column types in place:
+    int4 counts, date createdate, text xwalk names and float8 coordinates.
+
+    Each table is rewritten once (one ALTER TABLE with every column change), and
+    the sizes before and after are printed. Columns that already have their compact
+    type are left alone, so running it again (or after a partial run) is safe.
+    The {table}_text views are dropped and recreated in the same transaction as the
+    ALTERs, so a failure leaves the schema as it was. Postgres can't reorder existing
+    columns, so migrated tables keep their old column order; only new tables get the
+    alignment-friendly order from config."""
+    before = table_sizes(db_name, schema)
     cursor, conn = db_connect(db_name)
-    tables = ["rac", "wac", "od"]
-    for table in tables:
-        print(f"building regional index for {table} table...")
-        q = f"""create index if not exists regional_{table}_index on {schema}.combined_{table}(dvrpc_reg);"""
-        cursor.execute(q)
+    cursor.execute(
+        """
+        select table_name, column_name, data_type from information_schema.columns
+        where table_schema = %(schema)s
+        and table_name in ('combined_od', 'combined_wac', 'combined_rac', 'xwalk')
+        """,
+        {"schema": schema},
+    )
+    types = {(table, column): data_type for table, column, data_type in cursor.fetchall()}
+    # (column, its compact type as information_schema names it, the alter that gets it there)
+    date = ("createdate", "date", "createdate type date using to_date(createdate, 'YYYYMMDD')")
+    migrations = {
+        "combined_od": [date],  # od counts are already int
+        "combined_wac": [(c, "integer", f"{c} type int4 using {c}::int4") for c in wac_columns[1:-1]]
+        + [date],
+        "combined_rac": [(c, "integer", f"{c} type int4 using {c}::int4") for c in rac_columns[1:-1]]
+        + [date],
+        "xwalk": [
+            (c, "text", f"{c} type text using rtrim({c})") for c in xwalk_columns if c.endswith("name")
+        ]
+        + [
+            ("blklatdd", "double precision", "blklatdd type float8"),
+            ("blklondd", "double precision", "blklondd type float8"),
+            date,
+        ],
+    }
+    cursor.execute("BEGIN;")
+    try:
+        for table, columns in migrations.items():
+            if not any(key[0] == table for key in types):
+                print(f"there's no {schema}.{table} to migrate")
+                continue
+            changes = [
+                change
+                for column, compact, change in columns
+                if types.get((table, column), compact) != compact
+            ]
+            if not changes:
+                print(f"{schema}.{table} already has the compact profile's column types")
+                continue
+            print(f"migrating {schema}.{table} to the compact profile...")
+            alters = ",\n".join(f"alter column {change}" for change in changes)
+            # a view on the table would block changing its column types
+            cursor.execute(f"drop view if exists {schema}.{table}_text")
+            cursor.execute(f"alter table {schema}.{table}\n{alters}")
+        create_geocode_views(cursor, schema)
+        cursor.execute("COMMIT;")
+    except Exception:
+        cursor.execute("ROLLBACK;")
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+    print_sizes(before, table_sizes(db_name, schema))
+
+
+def migrate_to_keyed(db_name: str, schema: str):
+    """Converts existing tables' block geocodes to int8 in place (the keyed profile's
+    one difference from compact; run migrate_to_compact too for the rest), then
+    creates the {table}_text views. Sizes before and after are printed.
+
+    Each table is rewritten and its indexes rebuilt, so this takes a while on a big
+    schema. Postgres can't move the converted columns to the front, so they pad a
+    little more than in new keyed tables."""
+    before = table_sizes(db_name, schema)
+    cursor, conn = db_connect(db_name)
+    migrations = {
+        "combined_od": ["w_geocode", "h_geocode"],
+        "combined_wac": ["w_geocode"],
+        "combined_rac": ["h_geocode"],
+        "xwalk": [xwalk_columns[0]],
+    }
+    for table, columns in migrations.items():
+        print(f"migrating {schema}.{table} to int8 geocodes...")
+        alters = ",\n".join(f"alter column {c} type int8 using {c}::int8" for c in columns)
+        cursor.execute(f"drop view if exists {schema}.{table}_text")
+        cursor.execute(f"alter table {schema}.{table}\n{alters}")
+    create_geocode_views(cursor, schema)
     cursor.close()
     conn.close()
+    print_sizes(before, table_sizes(db_name, schema))
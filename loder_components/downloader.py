@@ -0,0 +1,362 @@
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import requests
+from .stream import CHUNK_SIZE
+from .metrics import metrics
+
+SPOOL_SIZE = 16 * 1024 * 1024  # compressed bytes kept in RAM before spilling to disk
+SPLIT_SIZE = 64 * 1024 * 1024  # files at least this big are fetched in resumable ranges
+PART_SIZE = 16 * 1024 * 1024  # bytes per range request
+DEFAULT_PARTIAL_DIR = os.path.join(tempfile.gettempdir(), "loder-partial")
+
+MISSING_STATUSES = {404, 410}
+# worth another try: timeouts, rate limiting and server errors
+RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+
+class DownloadError(Exception):
+    """A download that failed for good (not a missing file)"""
+
+
+class _Retry(Exception):
+    """A failed attempt that's worth retrying"""
+
+    def __init__(self, message: str, wait: float = 0) -> None:
+        super().__init__(message)
+        self.wait = wait
+
+
+class _Changed(Exception):
+    """The file changed on the server halfway through a ranged download"""
+
+
+class OwnedFile(io.FileIO):
+    """A downloaded file on disk that's deleted when it's closed, unless keep() was called"""
+
+    def __init__(self, path: str) -> None:
+        super().__init__(path, "r")
+        self.owned = True
+
+    def keep(self):
+        self.owned = False
+
+    def close(self):
+        super().close()
+        if self.owned:
+            self.owned = False
+            try:
+                os.remove(self.name)
+            except OSError:
+                pass
+
+
+@dataclass
+class Fetched:
+    """What Downloader.get found at a url.
+
+    status is "ok", "missing" (404/410) or "not_modified" (304). For "ok", fileobj
+    holds the body, rewound; path is set when that's an OwnedFile on disk."""
+
+    status: str
+    fileobj: object = None
+    path: str = None
+    bytes: int = None
+    sha256: str = None
+    etag: str = None
+    last_modified: str = None
+
+
+class Downloader:
+    """Downloads files over HTTP with retries, and big ones in parallel byte ranges.
+
+    Connection errors, timeouts, short bodies and 408/425/429/5xx answers are retried
+    with exponential backoff (honouring Retry-After); only 404/410 count as missing,
+    anything else raises DownloadError once the retries run out.
+
+    Files of at least split_size from servers that accept ranges are fetched in
+    part_size pieces by up to parts threads, written in place into a file in the
+    partial folder. Finished pieces are noted in a {key}.json next to it, so an
+    interrupted download picks up where it stopped, on this run's retries or the
+    next run, as long as the server's ETag/Last-Modified still match (resumed
+    requests carry If-Range, so a file that changed in between starts over).
+    Smaller files stream in one request into a spooled temp file.
+
+    Every download opens with a GET for the first split_size bytes: a smaller file
+    comes back whole in that one response, and a bigger one's response is kept as
+    its first pieces while the rest are fetched alongside it, so no request is
+    wasted finding out how big a file is.
+
+    Attributes
+    ----------
+        parts : int
+            parallel range requests per file (1 still resumes, just without splitting)
+        retries : int
+            extra attempts per request before giving up
+        backoff : float
+            seconds before the first retry; doubled for each one after
+        split_size : int
+            files this big or bigger are fetched in ranges
+        part_size : int
+            bytes per range request
+        partial_dir : str
+            where ranged downloads are assembled
+        timeout : tuple
+            (connect, read) timeouts in seconds for every request
+    """
+
+    def __init__(
+        self,
+        parts: int = 4,
+        retries: int = 5,
+        backoff: float = 1.0,
+        split_size: int = SPLIT_SIZE,
+        part_size: int = PART_SIZE,
+        partial_dir: str = DEFAULT_PARTIAL_DIR,
+        timeout: tuple = (30, 120),
+    ) -> None:
+        self.parts = max(parts, 1)
+        self.retries = max(retries, 0)
+        self.backoff = backoff
+        self.split_size = split_size
+        self.part_size = part_size
+        self.partial_dir = partial_dir
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def __session(self):
+        """One requests.Session per thread, so range requests reuse their connections"""
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def __request(self, url: str, headers: dict = None):
+        """Sends one GET, turning statuses worth retrying into _Retry"""
+        r = self.__session().get(url, headers=headers, stream=True, timeout=self.timeout)
+        if r.status_code in RETRY_STATUSES:
+            wait = r.headers.get("Retry-After", "")
+            r.close()
+            raise _Retry(f"HTTP {r.status_code}", float(wait) if wait.isdigit() else 0)
+        return r
+
+    def __retry(self, what: str, attempt):
+        """Calls attempt() until it works, backing off between tries"""
+        for tries in range(self.retries + 1):
+            try:
+                return attempt()
+            except (_Retry, requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                if tries == self.retries:
+                    raise DownloadError(f"{what} failed after {tries + 1} tries: {e}") from e
+                wait = max(self.backoff * 2**tries, getattr(e, "wait", 0))
+                metrics.record("download_retry", request=what, attempt=tries + 1, error=str(e))
+                print(f"{what} failed ({e}), retrying in {wait:g}s")
+                time.sleep(wait)
+
+    def get(self, url: str, headers: dict = None, folder: str = None):
+        """Downloads url. Returns a Fetched.
+
+        headers can carry If-None-Match/If-Modified-Since. With folder, the body is
+        always written to disk there (and ranged downloads are assembled there)
+        instead of being spooled."""
+        head = {**(headers or {}), "Range": f"bytes=0-{self.split_size - 1}"}
+        r = self.__retry(url, lambda: self.__request(url, head))
+        if r.status_code == 304:
+            r.close()
+            return Fetched("not_modified")
+        if r.status_code in MISSING_STATUSES:
+            r.close()
+            return Fetched("missing")
+        if r.status_code not in (200, 206):
+            r.close()
+            raise DownloadError(f"{url} answered HTTP {r.status_code}")
+        etag = r.headers.get("ETag")
+        last_modified = r.headers.get("Last-Modified")
+        size = int(r.headers.get("Content-Length") or 0)
+        if r.status_code == 206:
+            # Content-Range: bytes 0-{end}/{size}
+            size = int(r.headers.get("Content-Range", "").rpartition("/")[2] or 0)
+        if r.status_code == 200 or size <= self.split_size:
+            # the server sent the whole file (it ignored the range, or it's small)
+            return self.__stream(url, r, size, etag, last_modified, folder)
+        if r.headers.get("Content-Encoding"):
+            r.close()
+            return self.__stream(url, None, 0, etag, last_modified, folder)
+        return self.__ranged(url, size, etag, last_modified, folder or self.partial_dir, r)
+
+    def __stream(self, url: str, first, size: int, etag: str, last_modified: str, folder: str):
+        """Reads a whole body in one request, starting over if it's cut short.
+        first is the response already opened for it, if any"""
+        if folder is None:
+            out = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+            path = None
+        else:
+            os.makedirs(folder, exist_ok=True)
+            fd, path = tempfile.mkstemp(dir=folder, suffix=".part")
+            out = os.fdopen(fd, "w+b")
+        responses = [first] if first is not None else []
+
+        def attempt():
+            r = responses.pop() if responses else self.__request(url)
+            with r:
+                if r.status_code not in (200, 206):
+                    raise DownloadError(f"{url} answered HTTP {r.status_code}")
+                out.seek(0)
+                out.truncate()
+                digest = hashlib.sha256()
+                received = 0
+                for chunk in r.iter_content(CHUNK_SIZE):
+                    digest.update(chunk)
+                    received += len(chunk)
+                    out.write(chunk)
+            if size and received != size and not r.headers.get("Content-Encoding"):
+                raise _Retry(f"got {received:,} of {size:,} bytes")
+            return digest, received
+
+        try:
+            digest, received = self.__retry(url, attempt)
+        except BaseException:
+            out.close()
+            if path:
+                os.remove(path)
+            raise
+        if path:
+            out.close()
+            out = OwnedFile(path)
+        out.seek(0)
+        return Fetched("ok", out, path, received, digest.hexdigest(), etag, last_modified)
+
+    def __ranged(self, url: str, size: int, etag: str, last_modified: str, folder: str, first):
+        """Fetches url in byte ranges into a partial file, resuming an earlier attempt.
+
+        first is the open response to the opening GET; the pieces it covers are read
+        from it on this thread while the others download in parallel."""
+        os.makedirs(folder, exist_ok=True)
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        path = os.path.join(folder, f"{key}.part")
+        state_path = os.path.join(folder, f"{key}.json")
+        # If-Range needs a strong validator
+        validator = etag if etag and not etag.startswith("W/") else last_modified
+        state = {"url": url, "bytes": size, "etag": etag, "last_modified": last_modified}
+
+        done = set()
+        try:
+            with open(state_path) as f:
+                saved = json.load(f)
+            if (
+                validator
+                and all(saved.get(k) == v for k, v in state.items())
+                and os.path.getsize(path) == size
+            ):
+                done = {tuple(piece) for piece in saved["done"]}
+        except (OSError, ValueError, KeyError):
+            pass
+        if done:
+            have = sum(end - start + 1 for start, end in done)
+            print(f"resuming {url} with {have:,} of {size:,} bytes already downloaded")
+        else:
+            with open(path, "wb") as f:
+                f.truncate(size)
+
+        pieces = [
+            (start, min(start + self.part_size, size) - 1)
+            for start in range(0, size, self.part_size)
+        ]
+        todo = [piece for piece in pieces if piece not in done]
+        # the opening response covers bytes 0 to split_size - 1
+        head_end = int(first.headers.get("Content-Range", "").partition("-")[2].partition("/")[0] or -1)
+        head = [piece for piece in todo if piece[1] <= head_end]
+        lock = threading.Lock()
+
+        def save():
+            tmp = f"{state_path}.tmp"
+            with open(tmp, "w") as f:
+                json.dump({**state, "done": sorted(done)}, f)
+            os.replace(tmp, state_path)
+
+        def fetch(piece):
+            start, end = piece
+            offset = start
+
+            def attempt():
+                nonlocal offset
+                headers = {"Range": f"bytes={offset}-{end}"}
+                if validator:
+                    headers["If-Range"] = validator
+                with self.__request(url, headers) as r, open(path, "r+b") as f:
+                    if r.status_code == 200:
+                        raise _Changed(f"{url} changed on the server while it was downloading")
+                    if r.status_code != 206:
+                        raise DownloadError(f"{url} answered HTTP {r.status_code} to a range request")
+                    f.seek(offset)
+                    for chunk in r.iter_content(CHUNK_SIZE):
+                        chunk = chunk[: end + 1 - offset]
+                        f.write(chunk)
+                        offset += len(chunk)
+                if offset <= end:
+                    raise _Retry(f"got {offset - start:,} of {end - start + 1:,} bytes")
+
+            self.__retry(f"{url} bytes {start}-{end}", attempt)
+            with lock:
+                done.add(piece)
+                save()
+
+        def read_head():
+            """Writes the opening response's pieces, returning the ones it didn't finish"""
+            left = list(head)
+            if not left:
+                first.close()  # resuming, and those pieces were done already
+                return left
+            try:
+                with first, open(path, "r+b") as f:
+                    offset = 0
+                    for chunk in first.iter_content(CHUNK_SIZE):
+                        while chunk and left:
+                            start, end = left[0]
+                            if offset < start:
+                                skip = min(start - offset, len(chunk))  # already downloaded
+                                chunk, offset = chunk[skip:], offset + skip
+                                continue
+                            part = chunk[: end + 1 - offset]
+                            f.seek(offset)
+                            f.write(part)
+                            chunk, offset = chunk[len(part) :], offset + len(part)
+                            if offset > end:
+                                with lock:
+                                    done.add(left.pop(0))
+                                    save()
+                        if not left:
+                            break
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                print(f"{url} dropped after {len(head) - len(left)} of {len(head)} pieces ({e}), fetching the rest in ranges")
+            return left
+
+        try:
+            with ThreadPoolExecutor(max_workers=min(self.parts, max(len(todo), 1))) as executor:
+                futures = [executor.submit(fetch, piece) for piece in todo if piece not in head]
+                futures += [executor.submit(fetch, piece) for piece in read_head()]
+                for future in futures:
+                    future.result()
+        except _Changed as e:
+            # start over next time rather than mixing two versions of the file
+            for stale in [state_path, path]:
+                try:
+                    os.remove(stale)
+                except OSError:
+                    pass
+            raise DownloadError(str(e)) from e
+
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+        os.remove(state_path)
+        return Fetched("ok", OwnedFile(path), path, size, digest.hexdigest(), etag, last_modified)
+
+
+downloader = Downloader()  # used when nobody passes their own
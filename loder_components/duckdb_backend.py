@@ -0,0 +1,513 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from .config import table_profiles, manifest_table, xwalk_columns
+from .metrics import metrics
+
+# the same steps as db_update, for a single-file DuckDB database instead of a
+# Postgres server. functions here take the .duckdb file's path where db_update
+# takes a db name, so loder.py can call either module the same way.
+
+# the table each kind of file goes into, and the geocode column(s) flagged against the region
+layouts = {
+    "od_main": ("combined_od", ["h_geocode", "w_geocode"]),
+    "od_aux": ("combined_od", ["h_geocode", "w_geocode"]),
+    "wac": ("combined_wac", ["w_geocode"]),
+    "rac": ("combined_rac", ["h_geocode"]),
+    "xwalk": ("xwalk", []),
+}
+
+
+# duckdb names a file's catalog after its stem, so a schema named like the file
+# (lodes.duckdb with schema lodes) makes "lodes.xwalk" ambiguous. files are
+# attached under this name instead, whatever they're called
+CATALOG = "loder_file"
+
+
+def duckdb_connect(path: str):
+    """Opens (or creates) a DuckDB file. Returns (cursor, conn) like db_connect"""
+    try:
+        import duckdb
+    except ImportError:
+        raise ImportError("the duckdb backend needs duckdb: pip install duckdb")
+    conn = duckdb.connect()
+    conn.execute(f"attach '{path.replace(chr(39), chr(39) * 2)}' as {CATALOG}")
+    conn.execute(f"use {CATALOG}")
+    cursor = conn.cursor()
+    # a cursor starts in the default (in-memory) catalog
+    cursor.execute(f"use {CATALOG}")
+    return cursor, conn
+
+
+def _in_region(column: str, region: list, keyed: bool = False):
+    """SQL that's true when a geocode's county FIPS prefix is in region. keyed is
+    for int8 geocodes (the keyed profile), whose county is geocode // 10^10"""
+    if not region:
+        return "false"
+    if keyed:
+        return f"({column} // 10000000000) in ({', '.join(str(int(code)) for code in region)})"
+    codes = ", ".join(f"'{code}'" for code in region)
+    return f"left({column}, 5) in ({codes})"
+
+
+def duckdb_ddl(ddl: str):
+    """Translates a config.table_profiles DDL for DuckDB, which reads a bare numeric
+    as DECIMAL(18,3): that would round the xwalk coordinates to 3 places. They
+    become double, like in the compact profile, and the job counts integer."""
+    lines = []
+    for line in ddl.strip().splitlines():
+        name, *rest = line.strip().split()
+        if rest and rest[0].rstrip(",") == "numeric":
+            rest[0] = rest[0].replace("numeric", "double" if name.startswith("blkl") else "integer")
+        lines.append(" ".join([name] + rest))
+    return "\n    " + "\n    ".join(lines) + "\n    "
+
+
+class DuckDBSink:
+    """Loads LODES files into a DuckDB file, instead of Postgres.
+
+    Tables are created from the same config.table_profiles DDL (translated by
+    duckdb_ddl), and each downloaded .csv.gz is ingested by DuckDB's own (parallel)
+    csv reader with one INSERT ... SELECT from read_csv, which also adds the
+    per-file constants and the regional flags. load_manifest works as it does in Postgres: every file loads in
+    one transaction with its manifest row, and unchanged files are skipped.
+
+    DuckDB allows one writer per file, so loads from the pipeline's workers take
+    turns; each one is already spread over all cores by DuckDB.
+
+    Needs duckdb (pip install duckdb).
+
+    Attributes
+    ----------
+        path : str
+            the .duckdb file (created if it doesn't exist)
+        schema : str
+            schema to put the tables in
+        profile : str
+            "standard", "compact" or "keyed" column types (see config.table_profiles)
+    """
+
+    def __init__(self, path: str, schema: str = "main", profile: str = "standard") -> None:
+        self.path = path
+        self.schema = schema
+        self.profile = profile
+        self.cursor, self.conn = duckdb_connect(path)
+        self.lock = threading.Lock()
+        self.types = {}
+
+    def close(self):
+        self.cursor.close()
+        self.conn.close()
+
+    def create_tables(self):
+        """Sets up the schema and tables, like PayLode does in Postgres"""
+        ddl = table_profiles[self.profile]
+        self.cursor.execute(f"create schema if not exists {self.schema}")
+        for table, key in [
+            ("combined_od", "od"),
+            ("combined_wac", "wac"),
+            ("combined_rac", "rac"),
+            ("xwalk", "xwalk"),
+        ]:
+            self.cursor.execute(
+                f"create table if not exists {self.schema}.{table} ({duckdb_ddl(ddl[key])})"
+            )
+        self.cursor.execute(
+            f"create table if not exists {self.schema}.load_manifest ({manifest_table})"
+        )
+        self.__add_year()
+
+    def __add_year(self):
+        """Adds the year column to combined tables made before multi-year loading,
+        filled in with the one year their load_manifest rows have"""
+        years = [
+            row[0]
+            for row in self.cursor.execute(
+                f"""
+                SELECT DISTINCT year FROM {self.schema}.load_manifest
+                WHERE scope <> 'xwalk' AND status = 'loaded'
+                """
+            ).fetchall()
+        ]
+        for table in ["combined_od", "combined_wac", "combined_rac"]:
+            if "year" in self.__column_types(table):
+                continue
+            if len(years) > 1:
+                raise Exception(
+                    f"{self.schema}.{table} has no year column but load_manifest has {years}, add it by hand"
+                )
+            print(f"adding a year column to {self.schema}.{table}...")
+            default = f"default {years[0]}" if years else ""
+            self.cursor.execute(f"alter table {self.schema}.{table} add column year smallint {default}")
+            self.cursor.execute(f"alter table {self.schema}.{table} alter column year drop default")
+            self.types.pop(table)
+
+    def manifest(self, state: str):
+        """Returns a state's load_manifest rows (for every year), keyed by url"""
+        rows = self.cursor.execute(
+            f"""
+            SELECT url, status, checksum, etag, last_modified, row_filter
+            FROM {self.schema}.load_manifest
+            WHERE state = ?
+            """,
+            [state],
+        ).fetchall()
+        return {
+            url: {
+                "status": status,
+                "checksum": checksum,
+                "etag": etag,
+                "last_modified": last_modified,
+                "row_filter": row_filter,
+            }
+            for url, status, checksum, etag, last_modified, row_filter in rows
+        }
+
+    def __column_types(self, table: str):
+        """Returns {column: data_type} for a table, lowercased"""
+        if table not in self.types:
+            rows = self.cursor.execute(
+                """
+                select column_name, data_type from information_schema.columns
+                where table_schema = ? and table_name = ?
+                """,
+                [self.schema, table],
+            ).fetchall()
+            self.types[table] = {name.lower(): data_type for name, data_type in rows}
+        return self.types[table]
+
+    def __where(self, task, state: str):
+        """Filter for the rows one file puts in its table"""
+        if task.table in ["rac", "wac"]:
+            return (
+                f"state = '{state}' AND job_type = '{task.job_type}' AND segment = '{task.segment}'"
+                f" AND year = {task.year}"
+            )
+        elif task.table in ["od_main", "od_aux"]:
+            return (
+                f"state = '{state}' AND job_type = '{task.job_type}' AND scope = '{task.table}'"
+                f" AND year = {task.year}"
+            )
+        return f"st_usps = '{state.upper()}'"
+
+    def __select(self, task, state: str, columns: list, region: list):
+        """Columns to insert, the select list that fills them from read_csv's strings,
+        and the condition for a row touching the region"""
+        table, geocodes = layouts[task.table]
+        types = self.__column_types(table)
+        select = []
+        for column in columns:
+            data_type = types[column]
+            if data_type == "DATE":
+                select.append(f"strptime({column}, '%Y%m%d')::date")
+            elif data_type == "VARCHAR":
+                select.append(column)
+            else:
+                select.append(f"cast({column} as {data_type})")
+
+        if task.table in ["rac", "wac"]:
+            extra = {
+                "state": f"'{state}'",
+                "job_type": f"'{task.job_type}'",
+                "segment": f"'{task.segment}'",
+                "year": str(task.year),
+                "dvrpc_reg": _in_region(geocodes[0], region),
+            }
+            local = extra["dvrpc_reg"]
+        elif task.table in ["od_main", "od_aux"]:
+            home, work = (_in_region(column, region) for column in geocodes)
+            extra = {
+                "job_type": f"'{task.job_type}'",
+                "state": f"'{state}'",
+                "scope": f"'{task.table}'",
+                "year": str(task.year),
+                "home_reg": home,
+                "work_reg": work,
+                "dvrpc_reg": f"({home}) or ({work})",
+            }
+            local = extra["dvrpc_reg"]
+        else:
+            extra = {}
+            local = "true"
+        return columns + list(extra), select + list(extra.values()), local
+
+    def __record(
+        self,
+        task,
+        state: str,
+        status: str,
+        row_filter: str,
+        row_count: int = None,
+        dropped_rows: int = None,
+    ):
+        """Upserts a file's row in load_manifest"""
+        self.cursor.execute(
+            f"""
+            INSERT INTO {self.schema}.load_manifest
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, now(), ?, ?)
+            ON CONFLICT (url) DO UPDATE SET
+                bytes = excluded.bytes,
+                row_count = excluded.row_count,
+                checksum = excluded.checksum,
+                etag = excluded.etag,
+                last_modified = excluded.last_modified,
+                status = excluded.status,
+                loaded_at = excluded.loaded_at,
+                dropped_rows = excluded.dropped_rows,
+                row_filter = excluded.row_filter;
+            """,
+            [
+                task.url,
+                state,
+                task.year,
+                task.job_type,
+                task.segment,
+                task.table,
+                task.bytes,
+                row_count,
+                task.checksum,
+                task.etag,
+                task.last_modified,
+                status,
+                dropped_rows,
+                row_filter,
+            ],
+        )
+
+    def write(
+        self,
+        task,
+        state: str,
+        fileobj,
+        region: list,
+        columns: list,
+        row_filter: str = None,
+    ):
+        """Ingests one downloaded .csv.gz. Returns False if it was skipped as unchanged.
+
+        With a row_filter (see PayLode), only rows touching the region are kept.
+        read_csv needs a path, so cached files are read in place and spooled
+        downloads are written out to a temporary file first."""
+        with self.lock:
+            previous = self.manifest(state).get(task.url)
+            if (
+                previous
+                and previous["status"] == "loaded"
+                and previous["checksum"] == task.checksum
+                and previous["row_filter"] == row_filter
+            ):
+                print(f"skipping {task.url}, already loaded and unchanged")
+                return False
+
+            print(f"processing the {state} csv from {task.url} into {self.path}...")
+            name = getattr(fileobj, "name", None)
+            tmp = None
+            if not (isinstance(name, str) and os.path.exists(name)):
+                fd, tmp = tempfile.mkstemp(suffix=".csv.gz")
+                with os.fdopen(fd, "wb") as f:
+                    fileobj.seek(0)
+                    shutil.copyfileobj(fileobj, f)
+                name = tmp
+
+            table = layouts[task.table][0]
+            targets, select, local = self.__select(task, state, columns, region)
+            # name every column ourselves and read them as strings, so geocodes
+            # keep their leading zeros and the headers' capitalisation doesn't matter
+            csv_columns = ", ".join(f"'{column}': 'VARCHAR'" for column in columns)
+            start = time.perf_counter()
+            self.cursor.execute("BEGIN TRANSACTION;")
+            try:
+                # a 'failed' row can sit over the rows of the last good load
+                if previous is not None:
+                    self.cursor.execute(
+                        f"DELETE FROM {self.schema}.{table} WHERE {self.__where(task, state)};"
+                    )
+                source = f"""read_csv(?, header = true, delim = ',', quote = '"',
+                    compression = 'gzip', columns = {{{csv_columns}}})"""
+                row_count = self.cursor.execute(
+                    f"""
+                    INSERT INTO {self.schema}.{table} ({", ".join(targets)})
+                    SELECT {", ".join(select)}
+                    FROM {source}
+                    {f"WHERE {local}" if row_filter else ""}
+                    """,
+                    [name],
+                ).fetchone()[0]
+                dropped = 0
+                if row_filter:
+                    # the insert only reports what it kept
+                    total = self.cursor.execute(f"SELECT count(*) FROM {source}", [name]).fetchone()[0]
+                    dropped = total - row_count
+                    print(f"dropped {dropped:,} of {total:,} rows outside the region from {task.url}")
+                self.__record(task, state, "loaded", row_filter, row_count, dropped)
+                self.cursor.execute("COMMIT;")
+                metrics.record(
+                    "duckdb_insert",
+                    url=task.url,
+                    table=task.table,
+                    state=state,
+                    rows=row_count,
+                    dropped_rows=dropped,
+                    seconds=round(time.perf_counter() - start, 3),
+                )
+                return True
+            except Exception:
+                self.cursor.execute("ROLLBACK;")
+                self.__record(task, state, "failed", row_filter)
+                raise
+            finally:
+                if tmp is not None:
+                    os.remove(tmp)
+
+    def region(self, counties: list):
+        return region_fips(self.path, counties, self.schema, self.cursor)
+
+
+def region_fips(db_name: str, counties: list, schema: str, cursor=None):
+    """Returns the county FIPS codes for the counties list, looked up in xwalk.
+
+    db_name is the path of the .duckdb file."""
+    conn = None
+    if cursor is None:
+        cursor, conn = duckdb_connect(db_name)
+    rows = cursor.execute(
+        f"select distinct cty, ctyname from {schema}.xwalk where list_contains(?, trim(ctyname))",
+        [list(counties)],
+    ).fetchall()
+    if conn is not None:
+        cursor.close()
+        conn.close()
+    found = {ctyname.strip() for _, ctyname in rows}
+    missing = [county for county in counties if county not in found]
+    if missing:
+        print(f"these counties aren't in {schema}.xwalk, so they won't be flagged: {missing}")
+    return sorted(cty.strip() for cty, _ in rows)
+
+
+def local_flag(db_name: str, year: int, counties: list, schema: str):
+    """Recomputes dvrpc_reg (and home_reg/work_reg for od) from xwalk, like
+    db_update.local_flag. Rows whose flags are already right aren't rewritten."""
+    region = region_fips(db_name, counties, schema)
+    cursor, conn = duckdb_connect(db_name)
+    keyed = cursor.execute(
+        """
+        select data_type = 'BIGINT' from information_schema.columns
+        where table_schema = ? and table_name = 'xwalk' and column_name = ?
+        """,
+        [schema, xwalk_columns[0]],
+    ).fetchone() == (True,)
+    for table in ["rac", "wac"]:
+        census_block_col = "h_geocode" if table == "rac" else "w_geocode"
+        flag = _in_region(census_block_col, region, keyed)
+        print(f"updating dvrpc_reg column in {schema}.{table}...")
+        start = time.perf_counter()
+        rows = cursor.execute(
+            f"""update {schema}.combined_{table} set dvrpc_reg = {flag}
+                where dvrpc_reg is distinct from ({flag})"""
+        ).fetchone()[0]
+        metrics.record(
+            "update",
+            target=f"combined_{table}",
+            rows=rows,
+            seconds=round(time.perf_counter() - start, 3),
+        )
+
+    print(f"updating dvrpc_reg, home_reg and work_reg columns in {schema}.od...")
+    home = _in_region("h_geocode", region, keyed)
+    work = _in_region("w_geocode", region, keyed)
+    start = time.perf_counter()
+    rows = cursor.execute(
+        f"""update {schema}.combined_od
+            set home_reg = {home},
+                work_reg = {work},
+                dvrpc_reg = ({home}) or ({work})
+            where home_reg is distinct from ({home})
+               or work_reg is distinct from ({work})
+               or dvrpc_reg is distinct from (({home}) or ({work}))"""
+    ).fetchone()[0]
+    metrics.record(
+        "update",
+        target="combined_od",
+        rows=rows,
+        seconds=round(time.perf_counter() - start, 3),
+    )
+    cursor.close()
+    conn.close()
+
+
+def build_indexes(db_name: str, indexes: list):
+    """Runs CREATE INDEX statements one at a time (DuckDB builds each one in parallel)"""
+    cursor, conn = duckdb_connect(db_name)
+    for label, q in indexes:
+        print(f"building {label}...")
+        start = time.perf_counter()
+        cursor.execute(q)
+        metrics.record("index", target=label, seconds=round(time.perf_counter() - start, 3))
+    cursor.close()
+    conn.close()
+
+
+def build_index(
+    db_name: str,
+    counties: list,
+    year: int,
+    schema: str,
+    jobs: int = 1,
+    maintenance_work_mem: str = None,
+    parallel_workers: int = None,
+    kinds: list = (),
+):
+    """Builds the geocode indexes (and composite ones if asked) in a DuckDB file.
+
+    jobs, maintenance_work_mem and parallel_workers are Postgres settings and are
+    ignored. DuckDB keeps min/max zonemaps on every column by itself, so brin has
+    nothing to add and is skipped."""
+    indexes = [
+        ("index for rac table", f"create index if not exists rac_index on {schema}.combined_rac(h_geocode);"),
+        ("index for wac table", f"create index if not exists wac_index on {schema}.combined_wac(w_geocode);"),
+        (
+            "index for geography crosswalk",
+            f"create index if not exists xwalk_index on {schema}.xwalk({xwalk_columns[0]});",
+        ),
+        ("home index for od table", f"create index if not exists idx_home on {schema}.combined_od(h_geocode);"),
+        ("work index for od table", f"create index if not exists idx_work on {schema}.combined_od(w_geocode);"),
+    ]
+    if "composite" in kinds:
+        indexes += [
+            (
+                f"composite index for {table} table",
+                f"""create index if not exists {table}_type_index
+                    on {schema}.combined_{table}(job_type, {key}, {col});""",
+            )
+            for table, key, col in [
+                ("rac", "segment", "h_geocode"),
+                ("wac", "segment", "w_geocode"),
+                ("od", "scope", "w_geocode"),
+            ]
+        ]
+    if "brin" in kinds:
+        print("duckdb has zonemaps instead of brin indexes, skipping them")
+    build_indexes(db_name, indexes)
+
+
+def build_regional_index(
+    db_name: str,
+    schema: str,
+    jobs: int = 1,
+    maintenance_work_mem: str = None,
+    parallel_workers: int = None,
+    kinds: list = (),
+):
+    """Builds the dvrpc_reg indexes. DuckDB has no partial indexes, so that kind is skipped"""
+    indexes = [
+        (
+            f"regional index for {table} table",
+            f"create index if not exists regional_{table}_index on {schema}.combined_{table}(dvrpc_reg);",
+        )
+        for table in ["rac", "wac", "od"]
+    ]
+    if "partial" in kinds:
+        print("duckdb doesn't support partial indexes, skipping them")
+    build_indexes(db_name, indexes)
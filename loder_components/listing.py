@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+from .cache import DEFAULT_CACHE_DIR
+from .downloader import downloader as default_downloader, DownloadError
+
+DEFAULT_LISTING_DIR = os.path.join(DEFAULT_CACHE_DIR, "listings")
+DEFAULT_MAX_AGE = 24 * 3600  # LEHD adds files a few times a year at most
+
+# apache's index pages give sizes like 512, 4.0K or 1.2M (powers of 1024)
+_units = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+_href = re.compile(r'<a\s[^>]*href="([^"?]+\.csv\.gz)"', re.IGNORECASE)
+_size = re.compile(r"^(\d+(?:\.\d+)?)([KMGT]?)$")
+_tag = re.compile(r"<[^>]+>")
+
+
+def parse_listing(html: str):
+    """Returns {file name: size in bytes} for the .csv.gz links on a directory page.
+
+    Each entry's size is read from the end of its line (or table row) when the page
+    has one, like apache's index pages do; otherwise it's None."""
+    files = {}
+    for row in re.split(r"\n|<tr", html):
+        match = _href.search(row)
+        if match is None:
+            continue
+        name = match.group(1).rsplit("/", 1)[-1]
+        text = _tag.sub(" ", row[match.end() :]).replace("&nbsp;", " ").split()
+        size = _size.match(text[-1]) if text else None
+        files[name] = int(float(size.group(1)) * _units[size.group(2)]) if size else None
+    return files
+
+
+class Listings:
+    """LEHD's directory listings (e.g. LODES8/pa/od/), cached on disk.
+
+    A listing says which files exist and about how big they are, so a load can skip
+    the job type/segment combinations a state doesn't have instead of requesting
+    each one. Listings are kept for max_age seconds, then revalidated with
+    If-None-Match/If-Modified-Since so an unchanged one costs a 304.
+
+    Attributes
+    ----------
+        path : str
+            directory the cached listings live in (created if needed)
+        max_age : float
+            seconds a cached listing is used without asking the server
+        offline : bool
+            never touch the network; listings that were never cached are unknown
+        downloader : Downloader
+            fetches the listing pages (with retries)
+    """
+
+    def __init__(
+        self,
+        path: str = DEFAULT_LISTING_DIR,
+        max_age: float = DEFAULT_MAX_AGE,
+        offline: bool = False,
+        downloader=None,
+    ) -> None:
+        self.path = path
+        self.max_age = max_age
+        self.offline = offline
+        self.downloader = downloader or default_downloader
+        self.listings = {}  # url: files, for listings already read this run
+        os.makedirs(self.path, exist_ok=True)
+
+    def __entry_path(self, url: str):
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.path, f"{key}.json")
+
+    def __read_entry(self, url: str):
+        try:
+            with open(self.__entry_path(url)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def __write_entry(self, url: str, entry: dict):
+        """Atomically replaces the cached listing for a url"""
+        fd, tmp = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp, self.__entry_path(url))
+
+    def files(self, url: str):
+        """Returns {file name: bytes (or None)} for the directory at url, {} if the
+        directory doesn't exist, or None if it's unknown: offline and never cached,
+        the listing couldn't be fetched, or the page has no .csv.gz links we can read
+        (so every file under it is requested, as if there were no listings)."""
+        if url in self.listings:
+            return self.listings[url]
+        entry = self.__read_entry(url)
+        fresh = entry is not None and time.time() - entry["fetched_at"] < self.max_age
+        if self.offline or fresh:
+            files = entry["files"] if entry is not None else None
+            self.listings[url] = files
+            return files
+
+        headers = {}
+        if entry is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        try:
+            fetched = self.downloader.get(url, headers)
+        except DownloadError as e:
+            print(f"couldn't read the listing at {url}, requesting every file under it: {e}")
+            self.listings[url] = None
+            return None
+        if fetched.status == "not_modified" and entry is not None:
+            files = entry["files"]
+        else:
+            files = {}
+            if fetched.status == "ok":
+                with fetched.fileobj:
+                    files = parse_listing(fetched.fileobj.read().decode("utf-8", "replace"))
+                if not files:
+                    # a page we can't parse isn't proof the directory is empty
+                    print(f"found no .csv.gz files in the listing at {url}, requesting every file under it")
+                    self.listings[url] = None
+                    return None
+            entry = {"url": url, "etag": fetched.etag, "last_modified": fetched.last_modified}
+        entry["files"] = files
+        entry["fetched_at"] = time.time()
+        self.__write_entry(url, entry)
+        self.listings[url] = files
+        return files
@@ -0,0 +1,235 @@
+import contextlib
+import cProfile
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+import uuid
+
+
+class Metrics:
+    """Structured timings for every file and stage of a run, with opt-in profiling.
+
+    Each record() becomes one JSON line (event name, run id, pid, timestamp and
+    whatever fields the caller passes) in the metrics file, so a run can be broken
+    down into download, decompress, COPY, UPDATE, INSERT ... SELECT and index time
+    afterwards. write_prometheus() sums them up into a node_exporter textfile.
+
+    Stages run through stage() can also be profiled: cProfile stats (including the
+    pipeline's worker threads) are dumped to {profile_dir}/{stage}.prof, and
+    tracemalloc's top allocations to {profile_dir}/{stage}.tracemalloc.txt.
+
+    Everything is off until configure() is called; the LODER_METRICS,
+    LODER_PROMETHEUS, LODER_PROFILE, LODER_TRACEMALLOC and LODER_PROFILE_DIR
+    environment variables configure it at import.
+
+    Attributes
+    ----------
+        path : str
+            JSON lines file events are appended to (None to keep them in memory only)
+        prometheus : str
+            textfile write_prometheus() writes to
+        profile : set
+            stage names to run under cProfile ("all" for every stage)
+        trace : set
+            stage names to run under tracemalloc ("all" for every stage)
+        profile_dir : str
+            where profiles are written
+    """
+
+    def __init__(self) -> None:
+        self.events = []
+        self.lock = threading.Lock()
+        self.active = []  # stages currently being cProfiled
+        self.thread_profiles = []
+        self.configure()
+
+    def configure(
+        self,
+        path: str = None,
+        prometheus: str = None,
+        profile: list = (),
+        trace: list = (),
+        profile_dir: str = "profiles",
+    ):
+        self.path = path
+        self.prometheus = prometheus
+        self.profile = set(profile)
+        self.trace = set(trace)
+        self.profile_dir = profile_dir
+        # shared with worker processes, so their events can be told apart from other runs'
+        self.run_id = os.environ.setdefault("LODER_RUN_ID", uuid.uuid4().hex[:12])
+
+    def configure_from_env(self):
+        def names(variable):
+            return [name for name in os.getenv(variable, "").split(",") if name]
+
+        self.configure(
+            os.getenv("LODER_METRICS"),
+            os.getenv("LODER_PROMETHEUS"),
+            names("LODER_PROFILE"),
+            names("LODER_TRACEMALLOC"),
+            os.getenv("LODER_PROFILE_DIR", "profiles"),
+        )
+
+    def record(self, event: str, **fields):
+        """Logs one event as a JSON line"""
+        entry = {
+            "ts": round(time.time(), 3),
+            "run": self.run_id,
+            "pid": os.getpid(),
+            "event": event,
+            **fields,
+        }
+        with self.lock:
+            self.events.append(entry)
+            if self.path:
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(entry, default=str) + "\n")
+
+    def __wants(self, names: set, stage: str):
+        return stage in names or "all" in names
+
+    @contextlib.contextmanager
+    def stage(self, name: str, **fields):
+        """Times a block as a "stage" event. Yields a dict whose items are added to it"""
+        profiler = None
+        if self.__wants(self.profile, name):
+            profiler = cProfile.Profile()
+            with self.lock:
+                self.active.append(name)
+            profiler.enable()
+        tracing = self.__wants(self.trace, name) and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        extra = {}
+        start = time.perf_counter()
+        try:
+            yield extra
+        finally:
+            seconds = time.perf_counter() - start
+            if tracing:
+                snapshot = tracemalloc.take_snapshot()
+                extra["traced_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 1024**2, 1)
+                tracemalloc.stop()
+                self.__dump_snapshot(name, snapshot)
+            if profiler is not None:
+                profiler.disable()
+                self.__dump_profile(name, profiler)
+            self.record("stage", stage=name, seconds=round(seconds, 3), **fields, **extra)
+
+    @contextlib.contextmanager
+    def worker(self):
+        """Profiles a worker thread while a profiled stage is running (cProfile only
+        sees the thread that enabled it)"""
+        if not self.active:
+            yield
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # another profiler already covers every thread
+            yield
+            return
+        try:
+            yield
+        finally:
+            profiler.disable()
+            with self.lock:
+                self.thread_profiles.append(profiler)
+
+    def __dump_profile(self, name: str, profiler):
+        with self.lock:
+            self.active.remove(name)
+            threads, self.thread_profiles = self.thread_profiles, []
+        stats = pstats.Stats(profiler)
+        for thread in threads:
+            stats.add(thread)
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(self.profile_dir, f"{name}.prof")
+        stats.dump_stats(path)
+        print(f"wrote the {name} profile to {path}")
+
+    def __dump_snapshot(self, name: str, snapshot):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(self.profile_dir, f"{name}.tracemalloc.txt")
+        with open(path, "w") as f:
+            for stat in snapshot.statistics("lineno")[:50]:
+                f.write(f"{stat}\n")
+        print(f"wrote the {name} allocations to {path}")
+
+    def run_events(self):
+        """This run's events, from every process when they share a metrics file"""
+        if not self.path or not os.path.exists(self.path):
+            return list(self.events)
+        events = []
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get("run") == self.run_id:
+                    events.append(entry)
+        return events
+
+    def write_prometheus(self, path: str = None):
+        """Writes this run's totals as a Prometheus textfile (for node_exporter's
+        textfile collector), replacing the file atomically"""
+        path = path or self.prometheus
+        if not path:
+            return
+        totals = {}
+
+        def add(metric: str, labels: dict, value):
+            if value is None:
+                return
+            key = (metric, tuple(sorted(labels.items())))
+            totals[key] = totals.get(key, 0) + value
+
+        for e in self.run_events():
+            table = {"table": e.get("table", "")}
+            if e["event"] == "stage":
+                add("loder_stage_seconds", {"stage": e["stage"]}, e["seconds"])
+            elif e["event"] == "download":
+                add("loder_files_total", {**table, "status": e["status"]}, 1)
+                add("loder_download_bytes_total", table, e.get("bytes"))
+                add("loder_phase_seconds_total", {**table, "phase": "download"}, e["seconds"])
+            elif e["event"] == "download_retry":
+                add("loder_download_retries_total", {}, 1)
+            elif e["event"] == "load":
+                add("loder_phase_seconds_total", {**table, "phase": "queued"}, e["queued_seconds"])
+            elif e["event"] == "copy":
+                add("loder_rows_total", table, e.get("rows"))
+                add("loder_dropped_rows_total", table, e.get("dropped_rows"))
+                add("loder_decompressed_bytes_total", table, e.get("decompressed_bytes"))
+                for phase in ["decompress", "stamp", "copy"]:
+                    add("loder_phase_seconds_total", {**table, "phase": phase}, e[f"{phase}_seconds"])
+            elif e["event"] in ["duckdb_insert", "parquet"]:
+                add("loder_rows_total", table, e.get("rows"))
+                add("loder_dropped_rows_total", table, e.get("dropped_rows"))
+                add("loder_phase_seconds_total", {**table, "phase": e["event"]}, e["seconds"])
+            elif e["event"] in ["update", "insert_select", "index"]:
+                add("loder_statement_seconds_total", {"kind": e["event"], "target": e["target"]}, e["seconds"])
+            elif e["event"] == "commit":
+                add("loder_phase_seconds_total", {"table": "", "phase": "commit"}, e["seconds"])
+            elif e["event"] == "pool":
+                add("loder_db_connections_total", {"kind": "opened"}, e["opened"])
+                add("loder_db_connections_total", {"kind": "reused"}, e["reused"])
+
+        lines = [f"loder_run_timestamp_seconds {time.time():.0f}"]
+        for (metric, labels), value in sorted(totals.items()):
+            label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+            lines.append(f"{metric}{{{label_text}}} {value:g}")
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp, path)
+        print(f"wrote prometheus metrics to {path}")
+
+
+metrics = Metrics()
+metrics.configure_from_env()
@@ -0,0 +1,164 @@
+import csv
+import os
+from concurrent.futures import ThreadPoolExecutor
+from .config import od_columns, xwalk_columns
+from .db_update import db_connect, keyed_geocodes, geocode_prefix, geocode_text, refresh_table
+
+# block geocodes are state(2) + county(3) + tract(6) + block(4), and a block group
+# is the tract plus the first digit of the block, so these levels are just prefixes
+# and need no join. that also covers od_aux homes in states whose xwalk isn't loaded.
+prefix_levels = {"cty": 5, "trct": 11, "bgrp": 12}
+# these come from xwalk, so blocks outside the loaded states end up as null
+xwalk_levels = ["zcta", "cbsa"]
+
+
+def _level_sql(schema: str, level: str, keyed: bool = False):
+    """Returns (home expr, work expr, joins) for grouping combined_od to a level.
+
+    keyed is true when the geocodes are int8 (the keyed profile); the codes still
+    come out as zero-padded text, like they do from char(15) geocodes."""
+    if level in prefix_levels:
+        n = prefix_levels[level]
+        home, work = (
+            geocode_text(geocode_prefix(f"a.{column}", n, keyed), n, keyed)
+            for column in ["h_geocode", "w_geocode"]
+        )
+        return home, work, ""
+    if level in xwalk_levels:
+        joins = f"""
+            left join {schema}.xwalk h on a.h_geocode = h.{xwalk_columns[0]}
+            left join {schema}.xwalk w on a.w_geocode = w.{xwalk_columns[0]}
+        """
+        return f"h.{level}", f"w.{level}", joins
+    raise Exception(f"level must be one of {list(prefix_levels) + xwalk_levels}")
+
+
+def build_od_flows(
+    db_name: str,
+    schema: str,
+    years: list = None,
+    levels: list = ("trct", "cty"),
+    states: list = None,
+    job_types: list = None,
+    jobs: int = 1,
+):
+    """Builds OD flow tables aggregated to a geography, e.g. {schema}.od_flows_by_trct.
+
+    Each row is one home -> work pair at that level for a state file, year, scope
+    and job_type, with home_reg/work_reg (true if any block on that end is regional)
+    and the summed s000..si03 counts. Like the rollups, a table that exists already
+    only has the given years/states/job_types deleted and rebuilt.
+    """
+    sums = ", ".join(f"sum(a.{col}) as {col}" for col in od_columns[2:-1])
+
+    def build(level: str):
+        cursor, conn = db_connect(db_name)
+        keyed = keyed_geocodes(cursor, schema)
+        cursor.close()
+        conn.close()
+        home, work, joins = _level_sql(schema, level, keyed)
+        select = f"""
+            select a.state, a.year, a.scope, a.job_type, {home} as h_{level}, {work} as w_{level},
+                bool_or(a.home_reg) as home_reg, bool_or(a.work_reg) as work_reg, {sums}
+            from {schema}.combined_od a
+            {joins}
+        """
+        refresh_table(
+            db_name,
+            schema,
+            f"od_flows_by_{level}",
+            select,
+            "1, 2, 3, 4, 5, 6",
+            ["year", "job_type", f"h_{level}", f"w_{level}"],
+            years,
+            states,
+            job_types,
+        )
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        for future in [pool.submit(build, level) for level in levels]:
+            future.result()
+
+
+def flow_contents(db_name: str, schema: str, level: str):
+    """The (year, job_type) pairs that od_flows_by_{level} has flows for"""
+    cursor, conn = db_connect(db_name)
+    cursor.execute(f"select distinct year, job_type from {schema}.od_flows_by_{level} order by 1, 2")
+    pairs = [tuple(row) for row in cursor.fetchall()]
+    cursor.close()
+    conn.close()
+    return pairs
+
+
+def export_od_matrix(
+    db_name: str,
+    schema: str,
+    level: str,
+    job_type: str,
+    path: str,
+    column: str = "s000",
+    scopes: list = ("od_main", "od_aux"),
+    regional: bool = False,
+    year: int = None,
+):
+    """Writes an od_flows_by_{level} table as a sparse home x work matrix.
+
+    The matrix is saved as a scipy CSR .npz at path (load it with
+    scipy.sparse.load_npz), and row/column i of it is the geography code on line i
+    of the "<path without .npz>_index.csv" written next to it. Rows are homes,
+    columns are workplaces, and both use the same index. Needs numpy and scipy
+    (pip install numpy scipy).
+
+    Parameters
+    ----------
+        column : str
+            which count to export (s000 is all jobs)
+        scopes : list
+            od_main, od_aux or both
+        regional : bool
+            only flows with a home or work end in the region
+        year : int
+            only this year's flows (default every year loaded, summed)
+    """
+    try:
+        import numpy as np
+        from scipy import sparse
+    except ImportError:
+        raise ImportError("exporting od matrices needs numpy and scipy: pip install numpy scipy")
+
+    if column not in od_columns[2:-1]:
+        raise Exception(f"column must be one of {od_columns[2:-1]}")
+    cursor, conn = db_connect(db_name)
+    regional_filter = "and (home_reg or work_reg)" if regional else ""
+    year_filter = "and year = %(year)s" if year is not None else ""
+    cursor.execute(
+        f"""
+        select h_{level}, w_{level}, sum({column})
+        from {schema}.od_flows_by_{level}
+        where job_type = %(job_type)s and scope = ANY(%(scopes)s)
+        and h_{level} is not null and w_{level} is not null
+        {regional_filter}
+        {year_filter}
+        group by 1, 2
+        """,
+        {"job_type": job_type, "scopes": list(scopes), "year": year},
+    )
+    rows = cursor.fetchall()
+    cursor.close()
+    conn.close()
+
+    codes = sorted({h for h, _, _ in rows} | {w for _, w, _ in rows})
+    index = {code: i for i, code in enumerate(codes)}
+    home = np.fromiter((index[h] for h, _, _ in rows), dtype=np.int32, count=len(rows))
+    work = np.fromiter((index[w] for _, w, _ in rows), dtype=np.int32, count=len(rows))
+    counts = np.fromiter((n for _, _, n in rows), dtype=np.int64, count=len(rows))
+    matrix = sparse.csr_matrix((counts, (home, work)), shape=(len(codes), len(codes)))
+    sparse.save_npz(path, matrix, compressed=True)
+
+    index_path = f"{os.path.splitext(path)[0]}_index.csv"
+    with open(index_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["index", level])
+        writer.writerows(enumerate(codes))
+    print(f"wrote {len(codes)}x{len(codes)} {level} matrix with {len(rows)} flows to {path}")
+    return matrix, codes
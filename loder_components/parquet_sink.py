@@ -0,0 +1,149 @@
+import os
+from .batches import layouts, batch_schema, read_batches, flag, BLOCK_SIZE
+
+
+class ParquetSink:
+    """Writes LODES files as hive-partitioned Parquet, alongside or instead of Postgres.
+
+    Each source file becomes one Parquet file, streamed batch by batch from the
+    downloaded .csv.gz (pyarrow inflates it, and batches.read_batches parses and
+    validates it), so memory stays at about one batch. Counts are int32, geocodes
+    are dictionary encoded, and the regional flags are added as in the db. The
+    batch parse engine can also hand its batches straight to open(), so a file
+    that's loaded into Postgres too is only parsed once. Layout:
+
+        {path}/combined_wac/year=2021/state=pa/job_type=JT00/segment=S000/part-0.parquet
+        {path}/combined_od/year=2021/state=pa/job_type=JT00/scope=od_main/part-0.parquet
+        {path}/xwalk/state=pa/part-0.parquet
+
+    Needs pyarrow (pip install pyarrow).
+
+    Attributes
+    ----------
+        path : str
+            folder to write the datasets into
+        block_size : int
+            bytes of csv parsed per batch
+    """
+
+    def __init__(self, path: str, block_size: int = BLOCK_SIZE) -> None:
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ImportError("the parquet sink needs pyarrow: pip install pyarrow")
+        self.path = path
+        self.block_size = block_size
+
+    def file_path(self, task, state: str):
+        """Where the Parquet file for a LoadTask goes"""
+        table = layouts[task.table][0]
+        if task.table in ["rac", "wac"]:
+            parts = [
+                f"year={task.year}",
+                f"state={state}",
+                f"job_type={task.job_type}",
+                f"segment={task.segment}",
+            ]
+        elif task.table in ["od_main", "od_aux"]:
+            parts = [
+                f"year={task.year}",
+                f"state={state}",
+                f"job_type={task.job_type}",
+                f"scope={task.table}",
+            ]
+        else:
+            parts = [f"state={state}"]
+        return os.path.join(self.path, table, *parts, "part-0.parquet")
+
+    def exists(self, task, state: str):
+        return os.path.exists(self.file_path(task, state))
+
+    def open(self, task, state: str):
+        """Returns a ParquetFile to write a LoadTask's flagged batches into"""
+        _, _, geocodes = layouts[task.table]
+        return ParquetFile(self.file_path(task, state), batch_schema(task.table), geocodes)
+
+    def write(self, task, state: str, fileobj, region: list, region_only: bool = False):
+        """Streams one downloaded .csv.gz into its Parquet file. Returns the row count.
+
+        With region_only, rows that don't touch the region (dvrpc_reg false) are
+        left out. Existing files aren't rewritten, so delete the dataset after
+        turning it on or off."""
+        import pyarrow as pa
+
+        source = pa.CompressedInputStream(pa.PythonFile(fileobj, mode="r"), "gzip")
+        dropped = 0
+        region_only = region_only and task.table != "xwalk"
+        out = self.open(task, state)
+        try:
+            for batch in read_batches(task.table, source, self.block_size, task.url):
+                batch = flag(task.table, batch, region)
+                if region_only:
+                    kept = batch.filter(batch.column("dvrpc_reg"))
+                    dropped += batch.num_rows - kept.num_rows
+                    batch = kept
+                out.write(batch)
+        except BaseException:
+            out.abort()
+            raise
+        out.commit()
+        if region_only:
+            print(f"dropped {dropped:,} of {out.rows + dropped:,} rows outside the region from {task.url}")
+        return out.rows
+
+    def region(self, counties: list):
+        """Returns the county FIPS codes for the counties list from the xwalk dataset"""
+        import pyarrow.parquet as pq
+
+        xwalk = pq.read_table(os.path.join(self.path, "xwalk"), columns=["cty", "ctyname"])
+        found = {
+            name: cty
+            for cty, name in zip(xwalk.column("cty").to_pylist(), xwalk.column("ctyname").to_pylist())
+            if name in counties
+        }
+        missing = [county for county in counties if county not in found]
+        if missing:
+            print(f"these counties aren't in the xwalk parquet, so they won't be flagged: {missing}")
+        return sorted(set(found.values()))
+
+
+class ParquetFile:
+    """One Parquet file being written. Batches go to a hidden temp file next to it,
+    which commit() moves into place (so readers of the dataset never see a
+    half-written file) and abort() throws away.
+
+    Attributes
+    ----------
+        path : str
+            where the file ends up
+        schema : pyarrow.Schema
+            schema of the batches
+        geocodes : list
+            columns to dictionary encode
+    """
+
+    def __init__(self, path: str, schema, geocodes: list) -> None:
+        import pyarrow.parquet as pq
+
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.tmp = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp")
+        self.writer = pq.ParquetWriter(
+            self.tmp, schema, use_dictionary=geocodes, compression="zstd"
+        )
+        self.rows = 0
+
+    def write(self, batch):
+        self.writer.write_batch(batch)
+        self.rows += batch.num_rows
+
+    def commit(self):
+        self.writer.close()
+        os.replace(self.tmp, self.path)
+
+    def abort(self):
+        self.writer.close()
+        try:
+            os.remove(self.tmp)
+        except OSError:
+            pass
@@ -0,0 +1,184 @@
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from .downloader import downloader as default_downloader
+from .metrics import metrics
+
+_DONE = object()  # sentinel telling a copy worker to stop
+NOT_MODIFIED = object()  # fetch result for a file that hasn't changed since it was loaded
+
+
+@dataclass
+class LoadTask:
+    """One source file and the constants that get stamped onto its rows.
+
+    The download fields are filled in by whoever fetches the file."""
+
+    url: str
+    table: str  # od_main, od_aux, wac, rac, or xwalk
+    job_type: str
+    segment: str
+    year: int = None  # None for xwalk, which is the same for every year
+    bytes: int = None
+    checksum: str = None  # sha256 of the compressed file
+    etag: str = None
+    last_modified: str = None
+    listed_bytes: int = None  # the size in LEHD's directory listing, when it was checked
+
+
+def download(task: LoadTask, headers: dict = None, downloader=None):
+    """Downloads a file (see Downloader.get for retries, ranges and resuming),
+    filling in the task's download fields.
+
+    Returns None if the URL doesn't exist (404/410), or NOT_MODIFIED if conditional
+    headers were sent and the server answered 304. Raises DownloadError if it still
+    fails after retrying."""
+    fetched = (downloader or default_downloader).get(task.url, headers)
+    if fetched.status == "not_modified":
+        return NOT_MODIFIED
+    if fetched.status == "missing":
+        return None
+    task.bytes = fetched.bytes
+    task.checksum = fetched.sha256
+    task.etag = fetched.etag
+    task.last_modified = fetched.last_modified
+    return fetched.fileobj
+
+
+def run_pipeline(
+    tasks: list,
+    connect,
+    load,
+    download_jobs: int = 1,
+    copy_jobs: int = 1,
+    fetch=download,
+    finish=None,
+):
+    """Runs tasks through a pool of download workers feeding a pool of COPY workers.
+
+    Downloaded files wait in a queue that holds at most copy_jobs items, so download
+    workers block (backpressure) instead of piling files up when Postgres falls behind.
+
+    Parameters
+    ----------
+        tasks : list
+            LoadTasks to fetch and load
+        connect : callable
+            returns a (cursor, conn) pair; each copy worker opens its own connection.
+            None for loads that don't touch a db (load then gets a None cursor)
+        load : callable
+            load(cursor, task, fileobj) copies one downloaded file into the db
+        download_jobs : int
+            number of download threads
+        copy_jobs : int
+            number of COPY threads (and db connections)
+        fetch : callable
+            fetch(task) returns a readable file of compressed bytes, None if missing,
+            or NOT_MODIFIED if the file doesn't need loading again
+        finish : callable
+            finish(cursor) runs once per copy worker after its last file, before its
+            connection is closed (e.g. to commit a batch of files)
+
+    Returns
+    -------
+        (missing, failed, unchanged) : the tasks whose URLs didn't exist, (task, exception)
+        pairs for files that couldn't be downloaded or loaded, and the tasks fetch
+        reported as NOT_MODIFIED
+    """
+    todo = queue.Queue()
+    for task in tasks:
+        todo.put(task)
+    ready = queue.Queue(maxsize=max(copy_jobs, 1))
+    missing, failed, unchanged = [], [], []
+    lock = threading.Lock()
+
+    def record_download(task, status, start):
+        metrics.record(
+            "download",
+            url=task.url,
+            table=task.table,
+            status=status,
+            bytes=task.bytes,
+            seconds=round(time.perf_counter() - start, 3),
+        )
+
+    def download_worker():
+        with metrics.worker():
+            while True:
+                try:
+                    task = todo.get_nowait()
+                except queue.Empty:
+                    return
+                start = time.perf_counter()
+                try:
+                    fileobj = fetch(task)
+                except Exception as e:
+                    record_download(task, "failed", start)
+                    with lock:
+                        failed.append((task, e))
+                    continue
+                if fileobj is None:
+                    record_download(task, "missing", start)
+                    with lock:
+                        missing.append(task)
+                elif fileobj is NOT_MODIFIED:
+                    record_download(task, "not_modified", start)
+                    with lock:
+                        unchanged.append(task)
+                else:
+                    record_download(task, "ok", start)
+                    ready.put((task, fileobj, time.perf_counter()))
+
+    def copy_worker(cursor, conn):
+        try:
+            with metrics.worker():
+                while True:
+                    item = ready.get()
+                    if item is _DONE:
+                        return
+                    task, fileobj, queued = item
+                    start = time.perf_counter()
+                    try:
+                        load(cursor, task, fileobj)
+                    except Exception as e:
+                        with lock:
+                            failed.append((task, e))
+                    finally:
+                        fileobj.close()
+                        metrics.record(
+                            "load",
+                            url=task.url,
+                            table=task.table,
+                            queued_seconds=round(start - queued, 3),
+                            seconds=round(time.perf_counter() - start, 3),
+                        )
+        finally:
+            if finish is not None:
+                finish(cursor)
+            if conn is not None:
+                cursor.close()
+                conn.close()
+
+    downloaders = [
+        threading.Thread(target=download_worker, daemon=True)
+        for _ in range(max(download_jobs, 1))
+    ]
+    # connect up front so a bad connection fails the run instead of stalling it
+    connections = [
+        connect() if connect else (None, None) for _ in range(max(copy_jobs, 1))
+    ]
+    copiers = [
+        threading.Thread(target=copy_worker, args=connection, daemon=True)
+        for connection in connections
+    ]
+    for t in downloaders + copiers:
+        t.start()
+    for t in downloaders:
+        t.join()
+    for _ in copiers:
+        ready.put(_DONE)
+    for t in copiers:
+        t.join()
+
+    return missing, failed, unchanged
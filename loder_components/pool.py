@@ -0,0 +1,145 @@
+import os
+import threading
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+
+# session settings for bulk loading. synchronous_commit=off means a COMMIT doesn't
+# wait for its WAL flush: a crash can lose the last few commits, but never leaves a
+# half-loaded file, and load_manifest is committed with each file so a re-run
+# picks up whatever was lost
+BULK_SETTINGS = {
+    "synchronous_commit": "off",
+    "work_mem": "64MB",
+    "maintenance_work_mem": "512MB",
+    "statement_timeout": "4h",
+}
+
+
+def parse_settings(pairs: list):
+    """Turns ["work_mem=256MB", ...] into a settings dict"""
+    settings = {}
+    for pair in pairs:
+        name, sep, value = pair.partition("=")
+        if not sep or not name.strip():
+            raise ValueError(f"settings look like name=value, got {pair!r}")
+        settings[name.strip()] = value.strip()
+    return settings
+
+
+class PooledConnection:
+    """A connection borrowed from a ConnectionPool. close() hands it back instead of
+    closing it; everything else goes to the psycopg2 connection."""
+
+    def __init__(self, pool, key: tuple, conn) -> None:
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+
+    def close(self):
+        if self.conn is not None:
+            self.pool.release(self.key, self.conn)
+            self.conn = None
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+class ConnectionPool:
+    """Keeps psycopg2 connections open for the whole run, one idle list per db and schema.
+
+    Every connection is opened in autocommit with the session settings passed as
+    startup options, so they're its defaults: when a connection comes back, any
+    open transaction is rolled back and RESET ALL puts every setting (including
+    ones a caller SET, like an index build's maintenance_work_mem) back to them.
+    Worker processes forked from this one start with an empty pool; the parent's
+    sockets are never used or closed in the child.
+
+    Attributes
+    ----------
+        connect_args : dict
+            psycopg2.connect keyword arguments besides dbname and options
+        settings : dict
+            session settings for every new connection (BULK_SETTINGS by default)
+        max_idle : int
+            connections kept open per db and schema; more are closed when returned
+    """
+
+    def __init__(self, connect_args: dict, settings: dict = None, max_idle: int = 16) -> None:
+        self.connect_args = connect_args
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.opened = 0
+        self.reused = 0
+        self.configure(settings, max_idle)
+        os.register_at_fork(after_in_child=self.__forget)
+
+    def configure(self, settings: dict = None, max_idle: int = None):
+        """Changes the settings for new connections. Idle ones are closed so nothing
+        keeps the old settings"""
+        self.close_all()
+        self.settings = dict(BULK_SETTINGS if settings is None else settings)
+        if max_idle is not None:
+            self.max_idle = max_idle
+
+    def __forget(self):
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.opened = 0
+        self.reused = 0
+
+    def __options(self, schema: str):
+        settings = {"search_path": schema, **self.settings}
+        options = []
+        for name, value in settings.items():
+            # libpq splits options on spaces, so escape any inside a value
+            value = str(value).replace(" ", "\\ ")
+            options.append(f"-c {name}={value}")
+        return " ".join(options)
+
+    def connect(self, db: str, schema: str):
+        """Returns (cursor, conn), reusing an idle connection when there is one"""
+        key = (db, schema)
+        conn = None
+        with self.lock:
+            idle = self.idle.get(key, [])
+            while idle and conn is None:
+                conn = idle.pop()
+                if conn.closed:
+                    conn = None
+            if conn is not None:
+                self.reused += 1
+        if conn is None:
+            conn = psycopg2.connect(dbname=db, options=self.__options(schema), **self.connect_args)
+            conn.autocommit = True
+            with self.lock:
+                self.opened += 1
+        return conn.cursor(), PooledConnection(self, key, conn)
+
+    def release(self, key: tuple, conn):
+        """Takes a connection back, cleaned up for the next user"""
+        if not conn.closed:
+            try:
+                with conn.cursor() as cursor:
+                    if conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+                        cursor.execute("ROLLBACK")
+                    cursor.execute("RESET ALL")
+            except psycopg2.Error:
+                conn.close()
+        if conn.closed:
+            return
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close_all(self):
+        """Closes every idle connection. Returns (connections opened, times one was reused)"""
+        with self.lock:
+            idle, self.idle = self.idle, {}
+            counts = (self.opened, self.reused)
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+        return counts
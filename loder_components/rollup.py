@@ -0,0 +1,71 @@
+from concurrent.futures import ThreadPoolExecutor
+from .config import wac_columns, rac_columns, xwalk_columns
+from .db_update import refresh_table
+
+# xwalk geography columns that rollups can be built for
+rollup_levels = ["bgrp", "trct", "cty", "zcta", "cbsa"]
+
+
+def build_rollups(
+    db_name: str,
+    schema: str,
+    years: list = None,
+    levels: list = rollup_levels,
+    states: list = None,
+    job_types: list = None,
+    jobs: int = 1,
+):
+    """Builds wac/rac job totals by xwalk geography, e.g. {schema}.wac_by_trct.
+
+    Each rollup table has state, year, job_type, segment, the geography code and
+    name, dvrpc_reg (true if any block in it is regional) and the sum of every count
+    column. They're plain tables rather than materialized views so that a reload
+    of some years, states or job types can refresh just those rows: when any of
+    them are given, only the matching rows are deleted and rebuilt. A rollup table
+    that doesn't exist yet (or predates the year column) is built in full.
+
+    Parameters
+    ----------
+        years : list
+            only refresh these years (default all)
+        levels : list
+            xwalk columns to roll up to (see rollup_levels)
+        states : list
+            only refresh these states (default all)
+        job_types : list
+            only refresh these job types (default all)
+        jobs : int
+            number of rollup tables to build at once, each on its own connection
+    """
+
+    def build(table: str, level: str):
+        columns = wac_columns if table == "wac" else rac_columns
+        geocode = columns[0]
+        sums = ", ".join(f"sum(a.{col}) as {col}" for col in columns[1:-1])
+        select = f"""
+            select a.state, a.year, a.job_type, a.segment, b.{level},
+                min(b.{level}name) as {level}name, bool_or(a.dvrpc_reg) as dvrpc_reg, {sums}
+            from {schema}.combined_{table} a
+            inner join {schema}.xwalk b
+            on a.{geocode} = b.{xwalk_columns[0]}
+        """
+        refresh_table(
+            db_name,
+            schema,
+            f"{table}_by_{level}",
+            select,
+            "1, 2, 3, 4, 5",
+            ["year", "job_type", "segment", level],
+            years,
+            states,
+            job_types,
+        )
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        futures = [
+            pool.submit(build, table, level)
+            for table in ["wac", "rac"]
+            for level in levels
+        ]
+        for future in futures:
+            future.result()
@@ -0,0 +1,491 @@
+import csv
+import datetime
+import importlib
+import queue
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+import zlib
+
+CHUNK_SIZE = 1024 * 1024  # bytes pulled from the network per read
+GZIP_WBITS = 16 + zlib.MAX_WBITS  # tells zlib to expect a gzip header
+READ_AHEAD = 4  # inflated blocks a ReadAhead keeps ready
+
+# in-process inflaters with zlib's decompressobj API (pip install isal / zlib-ng)
+zlib_modules = {"isal": "isal.isal_zlib", "zlib-ng": "zlib_ng.zlib_ng", "zlib": "zlib"}
+# command line inflaters, fed through a pipe
+gzip_commands = {
+    "igzip": ["igzip", "-dc"],
+    "pigz": ["pigz", "-dc"],
+    "gzip": ["gzip", "-dc"],
+}
+# what "auto" picks from, fastest first. plain gzip is only used when asked for
+AUTO_GZIP_BACKENDS = ["isal", "zlib-ng", "igzip", "pigz", "zlib"]
+GZIP_BACKENDS = AUTO_GZIP_BACKENDS + ["gzip"]
+
+
+def _zlib_module(backend: str):
+    try:
+        return importlib.import_module(zlib_modules[backend])
+    except ImportError:
+        return None
+
+
+def gzip_backends():
+    """The gzip backends installed here, in GZIP_BACKENDS order (zlib is always one)"""
+    found = []
+    for backend in GZIP_BACKENDS:
+        if backend in zlib_modules:
+            installed = _zlib_module(backend) is not None
+        else:
+            installed = shutil.which(gzip_commands[backend][0]) is not None
+        if installed:
+            found.append(backend)
+    return found
+
+
+def pick_gzip_backend(backend: str = "auto"):
+    """Checks a backend name, turning "auto" into the fastest one installed"""
+    available = gzip_backends()
+    if backend == "auto":
+        return next(b for b in AUTO_GZIP_BACKENDS if b in available)
+    if backend not in GZIP_BACKENDS:
+        raise ValueError(f"gzip backend must be auto or one of {GZIP_BACKENDS}, got {backend!r}")
+    if backend not in available:
+        raise Exception(f"the {backend} gzip backend isn't installed here (found {available})")
+    return backend
+
+
+def open_gzip(chunks, backend: str = "zlib", read_ahead: bool = True):
+    """Returns a file-like stream of the inflated bytes of chunks (compressed bytes, in order).
+
+    backend is one of GZIP_BACKENDS (see pick_gzip_backend). With read_ahead, the
+    inflating happens on a background thread (see ReadAhead). Whatever comes back
+    has compressed_bytes, decompressed_bytes, seconds (time read() spent waiting)
+    and inflate_seconds, and should be closed when done with."""
+    if backend in gzip_commands:
+        stream = PipeGzipStream(chunks, gzip_commands[backend])
+    else:
+        stream = GzipStream(chunks, _zlib_module(backend))
+    return ReadAhead(stream) if read_ahead else stream
+
+
+class GzipStream:
+    """File-like adapter that inflates a gzipped byte stream as it is read.
+
+    Wraps an iterator of compressed chunks (e.g. requests' iter_content) so that
+    psycopg2's copy_expert can pull decompressed bytes on demand. Only one
+    compressed chunk and one read() worth of output are held in memory at a time.
+
+    Attributes
+    ----------
+        chunks : iterable
+            compressed bytes, in order
+        zlib_module : module
+            what inflates: zlib, or a faster module with the same API (isal_zlib, zlib_ng)
+    """
+
+    def __init__(self, chunks, zlib_module=None) -> None:
+        self.chunks = iter(chunks)
+        self.zlib = zlib_module or zlib
+        self.decompressor = self.zlib.decompressobj(GZIP_WBITS)
+        self.pending = b""
+        self.in_member = False
+        self.compressed_bytes = 0
+        self.decompressed_bytes = 0
+        self.seconds = 0.0  # spent inflating
+
+    def __next_chunk(self):
+        """Returns the next non-empty compressed chunk, or None at the end."""
+        for chunk in self.chunks:
+            if chunk:
+                self.compressed_bytes += len(chunk)
+                return chunk
+        return None
+
+    def read(self, size: int = -1) -> bytes:
+        """Returns up to size decompressed bytes (everything left if size < 0)."""
+        out = bytearray()
+        while size < 0 or len(out) < size:
+            if not self.pending:
+                self.pending = self.__next_chunk()
+                if self.pending is None:
+                    self.pending = b""
+                    if self.in_member:
+                        raise EOFError("compressed stream ended in the middle of a gzip member")
+                    break
+            limit = 0 if size < 0 else size - len(out)
+            start = time.perf_counter()
+            out += self.decompressor.decompress(self.pending, limit)
+            self.seconds += time.perf_counter() - start
+            self.in_member = True
+            if self.decompressor.eof:
+                # concatenated gzip members are legal, start a fresh decompressor
+                self.pending = self.decompressor.unused_data
+                self.decompressor = self.zlib.decompressobj(GZIP_WBITS)
+                self.in_member = False
+            else:
+                self.pending = self.decompressor.unconsumed_tail
+        self.decompressed_bytes += len(out)
+        return bytes(out)
+
+    @property
+    def inflate_seconds(self):
+        return self.seconds
+
+    def close(self):
+        pass
+
+
+class PipeGzipStream:
+    """File-like adapter that inflates through a command line gzip (igzip, pigz).
+
+    The command runs in its own process (started by the first read), so inflating
+    overlaps with whatever reads this. A thread feeds it the compressed chunks
+    while read() takes its stdout.
+
+    Attributes
+    ----------
+        chunks : iterable
+            compressed bytes, in order
+        command : list
+            the command to run, reading gzip on stdin and writing the data to stdout
+    """
+
+    def __init__(self, chunks, command: list) -> None:
+        self.chunks = iter(chunks)
+        self.command = command
+        self.process = None
+        self.compressed_bytes = 0
+        self.decompressed_bytes = 0
+        self.seconds = 0.0  # spent waiting on the pipe
+        self.error = None
+        self.finished = False
+
+    def __start(self):
+        self.stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(
+            self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self.stderr
+        )
+        self.feeder = threading.Thread(target=self.__feed, daemon=True)
+        self.feeder.start()
+
+    def __feed(self):
+        try:
+            for chunk in self.chunks:
+                self.compressed_bytes += len(chunk)
+                self.process.stdin.write(chunk)
+        except BrokenPipeError:
+            pass  # the command stopped early, its exit status says why
+        except Exception as e:
+            self.error = e
+        finally:
+            try:
+                self.process.stdin.close()
+            except OSError:
+                pass
+
+    def __finish(self):
+        self.finished = True
+        self.feeder.join()
+        code = self.process.wait()
+        if self.error is not None:
+            raise self.error
+        if code != 0:
+            self.stderr.seek(0)
+            message = self.stderr.read().decode("utf-8", "replace").strip()
+            raise Exception(f"{self.command[0]} failed with exit code {code}: {message}")
+
+    def read(self, size: int = -1) -> bytes:
+        """Returns up to size decompressed bytes (everything left if size < 0)."""
+        if self.process is None:
+            self.__start()
+        start = time.perf_counter()
+        data = self.process.stdout.read(size)
+        self.seconds += time.perf_counter() - start
+        self.decompressed_bytes += len(data)
+        if not data and not self.finished:
+            self.__finish()
+        return data
+
+    @property
+    def inflate_seconds(self):
+        return self.seconds
+
+    def close(self):
+        """Stops the command if it's still running"""
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        self.process.stdout.close()
+        self.stderr.close()
+
+
+class IterStream:
+    """File-like view of a generator of byte strings, for handing to copy_expert.
+
+    Subclasses implement chunks(); read() hands out its output in whatever sizes
+    the reader asks for. seconds adds up the time spent producing it, including
+    reading the source."""
+
+    def __init__(self) -> None:
+        self.out = b""
+        self.pos = 0
+        self.chunks_iter = None
+        self.seconds = 0.0
+
+    def chunks(self):
+        raise NotImplementedError
+
+    def read(self, size: int = -1) -> bytes:
+        """Returns up to size bytes (everything left if size < 0)."""
+        start = time.perf_counter()
+        if self.chunks_iter is None:
+            self.chunks_iter = self.chunks()
+        pieces = [self.out[self.pos :]]
+        have = len(pieces[0])
+        for chunk in self.chunks_iter:
+            pieces.append(chunk)
+            have += len(chunk)
+            if size >= 0 and have >= size:
+                break
+        data = b"".join(pieces)
+        if size < 0:
+            size = len(data)
+        self.out, self.pos = data, size
+        self.seconds += time.perf_counter() - start
+        return data[:size]
+
+
+class ReadAhead(IterStream):
+    """Reads a stream on a background thread, a few blocks ahead of the reader.
+
+    Wrapped around a GzipStream, the next blocks are inflated while the reader's
+    thread stamps rows and feeds COPY (zlib and its faster stand-ins let go of the
+    GIL while they inflate). At most depth blocks of CHUNK_SIZE wait in memory.
+    seconds is the time the reader spent waiting on the thread; the source's own
+    counters (compressed_bytes, decompressed_bytes, inflate_seconds) are passed
+    through.
+
+    Attributes
+    ----------
+        source : file-like
+            what to read ahead of, e.g. a GzipStream
+        depth : int
+            blocks to keep ready
+    """
+
+    def __init__(self, source, depth: int = READ_AHEAD) -> None:
+        super().__init__()
+        self.source = source
+        self.blocks = queue.Queue(maxsize=depth)
+        self.stopped = False
+        self.thread = None  # started by the first read
+
+    def __put(self, item):
+        while not self.stopped:
+            try:
+                self.blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def __fill(self):
+        try:
+            while not self.stopped:
+                block = self.source.read(CHUNK_SIZE)
+                self.__put(block)
+                if not block:
+                    return
+        except Exception as e:
+            self.__put(e)
+
+    def chunks(self):
+        self.thread = threading.Thread(target=self.__fill, daemon=True)
+        self.thread.start()
+        while True:
+            block = self.blocks.get()
+            if isinstance(block, Exception):
+                raise block
+            if not block:
+                return
+            yield block
+
+    @property
+    def compressed_bytes(self):
+        return self.source.compressed_bytes
+
+    @property
+    def decompressed_bytes(self):
+        return self.source.decompressed_bytes
+
+    @property
+    def inflate_seconds(self):
+        return self.source.inflate_seconds
+
+    def close(self):
+        """Stops the thread (if the reader gave up early) and closes the source"""
+        self.stopped = True
+        self.source.close()
+        if self.thread is not None:
+            self.thread.join()
+
+
+class StampedCsv(IterStream):
+    """File-like adapter that appends per-file fields to every row of a csv stream.
+
+    Lets COPY load straight into the combined tables: the constants a file implies
+    (state, job_type, ...) and the regional flags are added to each line as it
+    passes through, instead of via a temp table and an INSERT ... SELECT. Lines are
+    only sliced, never parsed, so this stays cheap per row. The header line is
+    passed through untouched for COPY's HEADER option to skip.
+
+    Attributes
+    ----------
+        source : file-like
+            decompressed csv bytes, e.g. a GzipStream
+        constants : list
+            values appended to every row, in order
+        geocode_fields : list
+            positions of the geocode columns to flag; one true/false is appended for
+            each, checked against region by its 5-digit county prefix
+        region : list
+            county FIPS codes that count as local
+        any_flag : bool
+            also append one flag that's true if any of the geocode fields is local
+        region_only : bool
+            drop rows where none of the geocode fields is local (counted in dropped)
+    """
+
+    def __init__(
+        self,
+        source,
+        constants: list = (),
+        geocode_fields: list = (),
+        region: list = (),
+        any_flag: bool = False,
+        region_only: bool = False,
+    ) -> None:
+        super().__init__()
+        self.source = source
+        self.suffix = b"".join(b"," + str(value).encode("utf-8") for value in constants)
+        self.geocode_fields = list(geocode_fields)
+        self.region = {code.encode("utf-8") for code in region}
+        self.any_flag = any_flag
+        self.region_only = region_only and bool(self.geocode_fields)
+        self.rows = 0
+        self.dropped = 0
+
+    def __stamp(self, line: bytes):
+        """Returns the line with its constants and flags, or None if it's filtered out"""
+        flags = []
+        for index in self.geocode_fields:
+            field = line[:5] if index == 0 else line.split(b",", index + 1)[index][:5]
+            flags.append(field in self.region)
+        if self.region_only and not any(flags):
+            self.dropped += 1
+            return None
+        if self.any_flag:
+            flags.append(any(flags))
+        self.rows += 1
+        return line + self.suffix + b"".join(b",t" if flag else b",f" for flag in flags) + b"\n"
+
+    def chunks(self):
+        """Yields the stamped lines (header first, unchanged), each ending in a newline."""
+        rest = b""
+        header = True
+        while True:
+            block = self.source.read(CHUNK_SIZE)
+            if not block:
+                break
+            lines = (rest + block).split(b"\n")
+            rest = lines.pop()
+            for line in lines:
+                line = line.rstrip(b"\r")
+                if header:
+                    header = False
+                    yield line + b"\n"
+                elif line:
+                    stamped = self.__stamp(line)
+                    if stamped is not None:
+                        yield stamped
+        rest = rest.rstrip(b"\r")
+        if rest and not header:
+            stamped = self.__stamp(rest)
+            if stamped is not None:
+                yield stamped
+
+
+PG_EPOCH = datetime.date(2000, 1, 1)
+
+
+def _pack(fmt: str, cast):
+    return lambda value: struct.pack(fmt, cast(value))
+
+
+def _date(value: str):
+    value = value.replace("-", "")
+    day = datetime.date(int(value[:4]), int(value[4:6]), int(value[6:8]))
+    return struct.pack(">i", (day - PG_EPOCH).days)
+
+
+# binary COPY encoders, keyed by information_schema.columns.data_type
+binary_encoders = {
+    "smallint": _pack(">h", int),
+    "integer": _pack(">i", int),
+    "bigint": _pack(">q", int),
+    "real": _pack(">f", float),
+    "double precision": _pack(">d", float),
+    "boolean": lambda value: b"\x01" if value in ("t", "true", "1") else b"\x00",
+    "date": _date,
+    "character": lambda value: value.encode("utf-8"),
+    "character varying": lambda value: value.encode("utf-8"),
+    "text": lambda value: value.encode("utf-8"),
+}
+
+
+class BinaryCopy(IterStream):
+    """Re-encodes stamped csv rows as COPY's binary format.
+
+    Postgres then skips parsing text for every field. It only works for column
+    types with a simple binary form (ints, floats, bools, dates, text), so numeric
+    columns from the standard profile need the compact profile or csv COPY.
+
+    Attributes
+    ----------
+        source : StampedCsv
+            rows to encode, header first
+        types : list
+            data_type of each column, in the same order as the csv fields
+    """
+
+    def __init__(self, source: StampedCsv, types: list) -> None:
+        super().__init__()
+        unsupported = [t for t in types if t not in binary_encoders]
+        if unsupported:
+            raise Exception(
+                f"binary COPY can't encode {sorted(set(unsupported))} columns, use the compact profile or csv"
+            )
+        self.source = source
+        self.encoders = [binary_encoders[t] for t in types]
+
+    def chunks(self):
+        yield b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+        lines = (line.decode("utf-8") for line in self.source.chunks())
+        next(lines, None)  # header
+        count = struct.pack(">h", len(self.encoders))
+        for row in csv.reader(lines):
+            fields = [count]
+            for encode, value in zip(self.encoders, row):
+                if value == "":
+                    fields.append(b"\xff\xff\xff\xff")  # NULL
+                else:
+                    data = encode(value)
+                    fields.append(struct.pack(">i", len(data)) + data)
+            yield b"".join(fields)
+        yield struct.pack(">h", -1)
@@ -0,0 +1,28 @@
+import os
+import sys
+import pytest
+
+# the repo root isn't an installed package, so make loder_components and
+# benchmarks importable however pytest is started
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.generate import generate, county_codes  # noqa: E402
+
+STATE = "pa"
+# the first synthetic county counts as local, the others don't
+REGION = [f"42{county_codes(2)[0]}"]
+
+
+@pytest.fixture(scope="session")
+def lodes_dir(tmp_path_factory):
+    """Small synthetic LODES files, laid out like the LEHD site"""
+    out = tmp_path_factory.mktemp("lodes")
+    manifest = generate(str(out), states=[STATE], year=2021, counties=2, per_county=60)
+    return out, manifest
+
+
+@pytest.fixture(scope="session")
+def lodes_files(lodes_dir):
+    """{table: path} for the one file of each kind (od_main, od_aux, rac, wac, xwalk)"""
+    out, manifest = lodes_dir
+    return {entry["table"]: os.path.join(out, rel) for rel, entry in manifest.items()}
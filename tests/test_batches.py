@@ -0,0 +1,122 @@
+import csv
+import gzip
+import io
+import pytest
+from loder_components.stream import BinaryCopy, StampedCsv
+from conftest import REGION, STATE
+from test_stream import binary_rows, source
+
+pytest.importorskip("pyarrow")
+
+from loder_components.batches import ArrowCopy, ValidationError, encode_binary, layouts  # noqa: E402
+
+# the column types of the compact tables, for binary COPY
+pg_types = {
+    "w_geocode": "character",
+    "h_geocode": "character",
+    "createdate": "date",
+    "state": "character",
+    "job_type": "character",
+    "segment": "character",
+    "scope": "character varying",
+    "year": "smallint",
+    "dvrpc_reg": "boolean",
+    "home_reg": "boolean",
+    "work_reg": "boolean",
+}
+
+
+def stamping(table: str):
+    """(constants, geocode fields, any_flag, flag columns) the way PayLode stamps a table"""
+    if table in ["rac", "wac"]:
+        constants = {"state": STATE, "job_type": "JT00", "segment": "S000", "year": 2021}
+        return constants, [0], False, ["dvrpc_reg"]
+    if table in ["od_main", "od_aux"]:
+        constants = {"job_type": "JT00", "state": STATE, "scope": table, "year": 2021}
+        return constants, [1, 0], True, ["home_reg", "work_reg", "dvrpc_reg"]
+    return {}, [], False, []
+
+
+def csv_rows(stream, columns: list):
+    """The rows as {column: value}, since the engines order the flags and constants differently"""
+    rows = list(csv.reader(io.StringIO(b"".join(stream.chunks()).decode("utf-8"))))
+    out = []
+    for row in rows[1:]:
+        # pyarrow writes booleans as true/false, the text engine as t/f, and
+        # coordinates without the source's trailing zeros
+        row = {c: {"true": "t", "false": "f"}.get(v, v) for c, v in zip(columns, row)}
+        for c in ["blklatdd", "blklondd"]:
+            if row.get(c):
+                row[c] = float(row[c])
+        out.append(row)
+    return out
+
+
+def read(path: str):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("table", ["od_main", "od_aux", "rac", "wac", "xwalk"])
+@pytest.mark.parametrize("region_only", [False, True])
+def test_csv_parity(lodes_files, table, region_only):
+    data = read(lodes_files[table])
+    constants, fields, any_flag, flags = stamping(table)
+    text = StampedCsv(source(data), list(constants.values()), fields, REGION, any_flag, region_only)
+    arrow = ArrowCopy(source(data), table, constants, REGION, region_only)
+    columns = layouts[table][1] + list(constants) + flags
+    assert sorted(arrow.columns) == sorted(columns)
+    assert csv_rows(arrow, arrow.columns) == csv_rows(text, columns)
+    assert (arrow.rows, arrow.dropped) == (text.rows, text.dropped)
+
+
+@pytest.mark.parametrize("table", ["od_main", "od_aux", "rac", "wac"])
+def test_binary_parity(lodes_files, table):
+    data = read(lodes_files[table])
+    constants, fields, any_flag, flags = stamping(table)
+    columns = layouts[table][1] + list(constants) + flags
+    text = StampedCsv(source(data), list(constants.values()), fields, REGION, any_flag)
+    expected = binary_rows(
+        b"".join(BinaryCopy(text, [pg_types.get(c, "integer") for c in columns]).chunks()), len(columns)
+    )
+
+    arrow = ArrowCopy(source(data), table, constants, REGION)
+    types = [pg_types.get(c, "integer") for c in arrow.columns]
+    rows = binary_rows(b"".join(arrow.binary(types).chunks()), len(types))
+    assert [dict(zip(arrow.columns, row)) for row in rows] == [dict(zip(columns, row)) for row in expected]
+
+
+def test_encode_binary_falls_back_to_rows_for_mixed_widths():
+    import pyarrow as pa
+
+    batch = pa.RecordBatch.from_arrays(
+        [pa.array(["a", "bcd", ""]), pa.array([1, 2, 3], pa.int32())], ["name", "n"]
+    )
+    data = b"PGCOPY\n\xff\r\n\x00" + b"\0" * 8 + encode_binary(batch, ["text", "integer"]) + b"\xff\xff"
+    assert binary_rows(data, 2) == [
+        [b"a", b"\0\0\0\1"],
+        [b"bcd", b"\0\0\0\2"],
+        [None, b"\0\0\0\3"],
+    ]
+
+
+header = b"w_geocode,h_geocode,S000,SA01,SA02,SA03,SE01,SE02,SE03,SI01,SI02,SI03,createdate\n"
+good = b"420010001001000,420010001001001,1,1,0,0,1,0,0,0,1,0,20231016\n"
+
+
+@pytest.mark.parametrize(
+    "bad",
+    [
+        b"42001000100100,420010001001001,1,1,0,0,1,0,0,0,1,0,20231016\n",  # short geocode
+        b"420010001001000,420010001001001,-1,1,0,0,1,0,0,0,1,0,20231016\n",  # negative count
+        b"420010001001000,420010001001001,x,1,0,0,1,0,0,0,1,0,20231016\n",  # not a number
+        b"420010001001000,420010001001001,,1,0,0,1,0,0,0,1,0,20231016\n",  # empty
+        b"420010001001000,420010001001001,1,1,0,0,1,0,0,0,1,0,2023101\n",  # short createdate
+    ],
+)
+def test_validation_errors(bad):
+    stream = ArrowCopy(
+        source(gzip.compress(header + good * 3 + bad)), "od_main", {"year": 2021}, url="x.csv.gz"
+    )
+    with pytest.raises(ValidationError, match="x.csv.gz"):
+        b"".join(stream.chunks())
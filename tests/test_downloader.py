@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+import pytest
+import requests
+from benchmarks.serve import QuietHandler, serve
+from loder_components.downloader import Downloader, DownloadError
+
+SPLIT = 1_000_000
+PART = 256_000
+
+
+@pytest.fixture
+def site(tmp_path, monkeypatch):
+    """Serves a big and a small file, logging each GET's Range header. Set
+    site["fail"] to answer that many requests with a 503 first."""
+    root = tmp_path / "site"
+    root.mkdir()
+    data = os.urandom(3_000_000)
+    (root / "big.gz").write_bytes(data)
+    (root / "small.gz").write_bytes(data[:1000])
+    state = {"data": data, "ranges": [], "fail": 0}
+    do_get = QuietHandler.do_GET
+
+    def logged(self):
+        state["ranges"].append(self.headers.get("Range"))
+        if state["fail"]:
+            state["fail"] -= 1
+            self.send_error(503)
+            return
+        do_get(self)
+
+    monkeypatch.setattr(QuietHandler, "do_GET", logged)
+    server = serve(str(root))
+    state["url"] = f"http://127.0.0.1:{server.server_address[1]}"
+    yield state
+    server.shutdown()
+
+
+def downloader(tmp_path, **kwargs):
+    options = dict(parts=4, retries=3, backoff=0.01, split_size=SPLIT, part_size=PART)
+    options.update(kwargs)
+    return Downloader(partial_dir=str(tmp_path / "partial"), **options)
+
+
+def test_small_file_is_one_request(site, tmp_path):
+    fetched = downloader(tmp_path).get(f"{site['url']}/small.gz")
+    assert fetched.status == "ok"
+    assert fetched.fileobj.read() == site["data"][:1000]
+    assert fetched.sha256 == hashlib.sha256(site["data"][:1000]).hexdigest()
+    assert site["ranges"] == [f"bytes=0-{SPLIT - 1}"]
+
+
+def test_ranged_download_uses_the_opening_response(site, tmp_path):
+    fetched = downloader(tmp_path).get(f"{site['url']}/big.gz")
+    assert fetched.status == "ok"
+    assert fetched.bytes == len(site["data"])
+    assert fetched.fileobj.read() == site["data"]
+    assert fetched.sha256 == hashlib.sha256(site["data"]).hexdigest()
+    # the opening GET covers the pieces that end before SPLIT, the rest are ranges
+    pieces = -(-len(site["data"]) // PART)
+    assert len(site["ranges"]) == 1 + pieces - SPLIT // PART
+    path = fetched.path
+    fetched.fileobj.close()
+    assert not os.path.exists(path)
+
+
+def test_ranged_download_resumes(site, tmp_path):
+    url = f"{site['url']}/big.gz"
+    data = site["data"]
+    partial = tmp_path / "partial"
+    partial.mkdir()
+    key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    # an earlier run got the first and last pieces
+    last = (len(data) // PART * PART, len(data) - 1)
+    body = bytearray(len(data))
+    body[:PART] = data[:PART]
+    body[last[0] :] = data[last[0] :]
+    (partial / f"{key}.part").write_bytes(bytes(body))
+    (partial / f"{key}.json").write_text(
+        json.dumps(
+            {
+                "url": url,
+                "bytes": len(data),
+                "etag": None,
+                "last_modified": requests.head(url).headers["Last-Modified"],
+                "done": [[0, PART - 1], list(last)],
+            }
+        )
+    )
+    site["ranges"].clear()
+    site["fail"] = 2  # and the retries still resume
+
+    fetched = downloader(tmp_path).get(url)
+    assert fetched.fileobj.read() == data
+    assert f"bytes={last[0]}-{last[1]}" not in site["ranges"]
+    assert not (partial / f"{key}.json").exists()
+
+
+def test_partial_from_another_version_is_discarded(site, tmp_path):
+    url = f"{site['url']}/big.gz"
+    partial = tmp_path / "partial"
+    partial.mkdir()
+    key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    (partial / f"{key}.part").write_bytes(b"\0" * len(site["data"]))
+    (partial / f"{key}.json").write_text(
+        json.dumps(
+            {
+                "url": url,
+                "bytes": len(site["data"]),
+                "etag": None,
+                "last_modified": "Mon, 01 Jan 2001 00:00:00 GMT",
+                "done": [[0, PART - 1]],
+            }
+        )
+    )
+    fetched = downloader(tmp_path).get(url)
+    assert fetched.fileobj.read() == site["data"]
+
+
+def test_missing_not_modified_and_giving_up(site, tmp_path):
+    d = downloader(tmp_path)
+    assert d.get(f"{site['url']}/nope.gz").status == "missing"
+
+    fetched = d.get(f"{site['url']}/small.gz")
+    headers = {"If-Modified-Since": fetched.last_modified}
+    assert d.get(f"{site['url']}/small.gz", headers).status == "not_modified"
+    assert d.get(f"{site['url']}/big.gz", headers).status == "not_modified"
+
+    site["fail"] = 10
+    with pytest.raises(DownloadError, match="503"):
+        d.get(f"{site['url']}/small.gz")
@@ -0,0 +1,111 @@
+import os
+import pytest
+from benchmarks.generate import generate
+from benchmarks.serve import serve
+from loder_components.db_setup import PayLode
+from loder_components.downloader import Downloader
+from conftest import REGION, STATE
+
+# a throwaway Postgres db the tests may fill (HOST, PORT, UN and PW as for loder.py)
+TEST_DB = os.getenv("LODER_TEST_DB")
+
+
+@pytest.fixture
+def site(tmp_path):
+    """Serves a fresh copy of the synthetic files, which the tests may replace"""
+    root = tmp_path / "site"
+    manifest = generate(str(root), states=[STATE], year=2021, counties=2, per_county=60)
+    wac = next(rel for rel, entry in manifest.items() if entry["table"] == "wac")
+    server = serve(str(root))
+    yield {
+        "url": f"http://127.0.0.1:{server.server_address[1]}",
+        "wac": str(root / wac),
+        "rows": manifest[wac]["rows"],
+    }
+    server.shutdown()
+
+
+def replace(path: str, data: bytes):
+    """Rewrites a served file with a later mtime, so it doesn't answer a 304"""
+    mtime = os.stat(path).st_mtime
+    with open(path, "wb") as f:
+        f.write(data)
+    os.utime(path, (mtime + 60, mtime + 60))
+
+
+def load(site, tmp_path, **kwargs):
+    return PayLode(
+        "True",
+        2021,
+        STATE,
+        "lodes8",
+        TEST_DB or "loder_test",
+        [],
+        pick_or_all="all",
+        schema="reload_test",
+        tables=["wac"],
+        region=REGION,
+        lodes_url=site["url"],
+        downloader=Downloader(partial_dir=str(tmp_path / "partial"), retries=0),
+        **kwargs,
+    )
+
+
+def fail_then_rerun(site, tmp_path, count, **kwargs):
+    """Loads wac, fails to reload a broken copy, then reloads the good one. The
+    failed reload must neither lose the old rows nor leave them to be doubled."""
+    load(site, tmp_path, **kwargs)
+    assert count() == site["rows"]
+
+    with open(site["wac"], "rb") as f:
+        good = f.read()
+    replace(site["wac"], good[: len(good) // 2])
+    with pytest.raises(RuntimeError):
+        load(site, tmp_path, **kwargs)
+    assert count() == site["rows"]
+
+    replace(site["wac"], good)
+    load(site, tmp_path, **kwargs)
+    assert count() == site["rows"]
+
+
+@pytest.mark.skipif(TEST_DB is None, reason="set LODER_TEST_DB to a Postgres db the tests may fill")
+def test_failed_reload_then_rerun_postgres(site, tmp_path):
+    from loder_components.db_update import db_connect
+
+    def count():
+        cursor, conn = db_connect(TEST_DB, "reload_test")
+        cursor.execute("select count(*) from reload_test.combined_wac")
+        (rows,) = cursor.fetchone()
+        cursor.close()
+        conn.close()
+        return rows
+
+    cursor, conn = db_connect(TEST_DB)
+    cursor.execute("drop schema if exists reload_test cascade")
+    cursor.close()
+    conn.close()
+    try:
+        fail_then_rerun(site, tmp_path, count)
+    finally:
+        cursor, conn = db_connect(TEST_DB)
+        cursor.execute("drop schema if exists reload_test cascade")
+        cursor.close()
+        conn.close()
+
+
+def test_failed_reload_then_rerun_duckdb(site, tmp_path):
+    pytest.importorskip("duckdb")
+    from loder_components.duckdb_backend import duckdb_connect
+
+    # named like the schema, which duckdb would otherwise take for the file's catalog
+    path = str(tmp_path / "reload_test.duckdb")
+
+    def count():
+        cursor, conn = duckdb_connect(path)
+        try:
+            return cursor.execute("select count(*) from reload_test.combined_wac").fetchone()[0]
+        finally:
+            conn.close()
+
+    fail_then_rerun(site, tmp_path, count, sink="duckdb", duckdb_path=path)
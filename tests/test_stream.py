@@ -0,0 +1,140 @@
+import datetime
+import gzip
+import io
+import struct
+import pytest
+from loder_components.stream import (
+    BinaryCopy,
+    CHUNK_SIZE,
+    StampedCsv,
+    binary_encoders,
+    open_gzip,
+)
+from conftest import REGION
+
+
+def source(data: bytes, backend: str = "zlib"):
+    f = io.BytesIO(data)
+    return open_gzip(iter(lambda: f.read(CHUNK_SIZE), b""), backend)
+
+
+def stamped_lines(stamped):
+    return b"".join(stamped.chunks()).decode("utf-8").splitlines()
+
+
+def binary_rows(data: bytes, width: int):
+    """Splits a PGCOPY stream into rows of field bytes (None for NULL)"""
+    assert data[:11] == b"PGCOPY\n\xff\r\n\x00"
+    pos, rows = 19, []
+    while True:
+        (count,) = struct.unpack(">h", data[pos : pos + 2])
+        pos += 2
+        if count == -1:
+            assert pos == len(data)
+            return rows
+        assert count == width
+        row = []
+        for _ in range(count):
+            (length,) = struct.unpack(">i", data[pos : pos + 4])
+            pos += 4
+            row.append(None if length == -1 else data[pos : pos + length])
+            pos += max(length, 0)
+        rows.append(row)
+
+
+@pytest.mark.parametrize(
+    "pg_type, value, expected",
+    [
+        ("smallint", "2021", struct.pack(">h", 2021)),
+        ("integer", "-7", struct.pack(">i", -7)),
+        ("bigint", "420010001001000", struct.pack(">q", 420010001001000)),
+        ("bigint", "010010001001000", struct.pack(">q", 10010001001000)),
+        ("real", "1.5", struct.pack(">f", 1.5)),
+        ("double precision", "39.8444219", struct.pack(">d", 39.8444219)),
+        ("boolean", "t", b"\x01"),
+        ("boolean", "true", b"\x01"),
+        ("boolean", "f", b"\x00"),
+        ("date", "20231016", struct.pack(">i", (datetime.date(2023, 10, 16) - datetime.date(2000, 1, 1)).days)),
+        ("date", "1999-12-31", struct.pack(">i", -1)),
+        ("character", "420010001001000", b"420010001001000"),
+        ("character varying", "JT00", b"JT00"),
+        ("text", "Adams County, PA", b"Adams County, PA"),
+    ],
+)
+def test_binary_encoders(pg_type, value, expected):
+    assert binary_encoders[pg_type](value) == expected
+
+
+def test_binary_copy_rows_and_nulls():
+    data = gzip.compress(b"a,b,c\n1,,20210101\n-2,x,\n")
+    rows = binary_rows(
+        b"".join(BinaryCopy(StampedCsv(source(data)), ["integer", "text", "date"]).chunks()), 3
+    )
+    assert rows == [
+        [struct.pack(">i", 1), None, struct.pack(">i", 7671)],
+        [struct.pack(">i", -2), b"x", None],
+    ]
+
+
+def test_binary_copy_rejects_numeric():
+    with pytest.raises(Exception, match="numeric"):
+        BinaryCopy(StampedCsv(source(gzip.compress(b"a\n"))), ["numeric"])
+
+
+def test_stamped_csv_appends_constants_and_flags():
+    data = gzip.compress(
+        b"w_geocode,h_geocode,s000\r\n"
+        + f"{REGION[0]}0001001000,420990001001000,3\r\n".encode()
+        + f"420990001001000,{REGION[0]}0001001000,4".encode()  # no trailing newline
+    )
+    stamped = StampedCsv(source(data), ["pa", "JT00"], [1, 0], REGION, any_flag=True)
+    assert stamped_lines(stamped) == [
+        "w_geocode,h_geocode,s000",
+        f"{REGION[0]}0001001000,420990001001000,3,pa,JT00,f,t,t",
+        f"420990001001000,{REGION[0]}0001001000,4,pa,JT00,t,f,t",
+    ]
+    assert (stamped.rows, stamped.dropped) == (2, 0)
+
+
+@pytest.mark.parametrize("table, fields", [("wac", [0]), ("rac", [0]), ("od_main", [1, 0])])
+def test_stamped_csv_region_only(lodes_files, table, fields):
+    with open(lodes_files[table], "rb") as f:
+        data = f.read()
+    everything = StampedCsv(source(data), [], fields, REGION, any_flag=len(fields) > 1)
+    lines = stamped_lines(everything)[1:]
+    local = [line for line in lines if line.endswith(",t")]
+    assert 0 < len(local) < len(lines)
+
+    regional = StampedCsv(source(data), [], fields, REGION, len(fields) > 1, region_only=True)
+    assert stamped_lines(regional)[1:] == local
+    assert regional.rows == len(local)
+    assert regional.dropped == len(lines) - len(local)
+    # each kept row has a local geocode in one of the flagged fields
+    for line in local:
+        values = line.split(",")
+        assert any(values[i][:5] in REGION for i in fields)
+
+
+def test_stamped_csv_region_only_without_geocodes_keeps_everything(lodes_files):
+    with open(lodes_files["xwalk"], "rb") as f:
+        data = f.read()
+    stamped = StampedCsv(source(data), [], [], REGION, region_only=True)
+    assert len(stamped_lines(stamped)) == stamped.rows + 1
+    assert stamped.dropped == 0
+
+
+def test_gzip_multiple_members_and_truncation():
+    data = gzip.compress(b"a\n1\n") + gzip.compress(b"2\n")
+    stream = source(data)
+    out = b""
+    while True:
+        block = stream.read(CHUNK_SIZE)
+        if not block:
+            break
+        out += block
+    assert out == b"a\n1\n2\n"
+
+    with pytest.raises(Exception):
+        stream = source(data[:-4])
+        while stream.read(CHUNK_SIZE):
+            pass